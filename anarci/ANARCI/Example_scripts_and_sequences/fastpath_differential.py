@@ -0,0 +1,29 @@
+# Differential test of the anchor fast path against the HMM search.
+# Every sequence is numbered with the HMM search. The sequences accepted by the fast path must have identical numbering in
+# every scheme. different lists any that do not. The run times of anarci with and without the fast path are then compared.
+
+import sys
+import time
+
+from anarci import run_anarci, read_fasta
+from anarci.fastpath import compare_fast_path
+
+ncpu = 4
+fasta = sys.argv[1] if len(sys.argv) > 1 else "pdb_sequences.fa.txt.gz"
+sequences = read_fasta( fasta )
+
+failed = False
+for scheme in [ "imgt", "chothia", "kabat", "martin", "aho", "wolfguy" ]:
+    report = compare_fast_path( sequences, scheme=scheme, ncpu=ncpu )
+    print("%-8s accepted %d of %d, identical %d, different %d %s"%(scheme, report["accepted"], report["sequences"],
+          report["identical"], len(report["different"]), " ".join(report["different"][:10])))
+    print("         different chain type %d, different species %d"%(len(report["chain_type_different"]), report["species_different"]))
+    failed = failed or bool( report["different"] ) or bool( report["chain_type_different"] )
+
+# Time the two runs.
+for fast_path in [ False, True ]:
+    start = time.time()
+    run_anarci( sequences, ncpu=ncpu, fast_path=fast_path )
+    print("fast_path=%s: %.1f seconds"%(fast_path, time.time()-start))
+
+sys.exit( 1 if failed else 0 )
@@ -0,0 +1,31 @@
+# Measure the k-mer prefilter against the full HMM search.
+# Sequences rejected by the prefilter are not searched at all. false_rejections lists those that the full search numbers.
+# Routed sequences are first searched against the HMMs of their likely chain types only. misrouted lists those whose route
+# missed the chain type found by the full search (these fall back to searching all HMMs).
+
+import sys
+import time
+
+from anarci import run_anarci, read_fasta
+from anarci.prefilter import evaluate_prefilter
+
+ncpu = 4
+fasta = sys.argv[1] if len(sys.argv) > 1 else "pdb_sequences.fa.txt.gz"
+
+# Receptor sequences plus some that are not (lysozyme, a linker and a tag).
+sequences = read_fasta( fasta ) + read_fasta( "lysozyme.fasta" ) + [ ("linker", "GGGGSGGGGSGGGGS"), ("his_tag", "HHHHHHHHHH") ]
+
+report = evaluate_prefilter( sequences, ncpu=ncpu )
+print("Sequences:          %d"%report["sequences"])
+print("Numbered:           %d"%report["numbered"])
+print("Rejected:           %d"%report["rejected"])
+print("False rejections:   %d %s"%(len(report["false_rejections"]), " ".join(report["false_rejections"][:10])))
+print("Rejection recall:   %.4f"%report["rejection_recall"])
+print("Routing accuracy:   %.4f"%report["routing_accuracy"])
+print("Misrouted:          %d %s"%(len(report["misrouted"]), " ".join(report["misrouted"][:10])))
+
+# Time the two searches.
+for prefilter in [ False, True ]:
+    start = time.time()
+    run_anarci( sequences, ncpu=ncpu, prefilter=prefilter )
+    print("prefilter=%s: %.1f seconds"%(prefilter, time.time()-start))
@@ -23,10 +23,20 @@ HMMER needs a single alignment to build a HMM. We therefore make putative germli
 by combining all the v sequences with all the j sequences. (Each v sequence appears n(j) times).
 
 These are chucked into curated alignments and hmmbuild used to create the HMMs. 
+
+Many alleles have the same amino acid sequence over the aligned region so the full combination has many identical
+putative sequences. The --combine option chooses how the v and j sequences are combined:
+    o all:      Every v sequence with every j sequence (the default).
+    o unique:   Every unique v sequence with every unique j sequence. hmmbuild weights them itself.
+    o weighted: As unique but each sequence is given the weight (#=GS WT) that its copies have in the full combination
+                (Henikoff position based weights). build.py runs hmmbuild with --wgiven for these alignments.
+benchmark_combine.py compares the build time, size and numbering of the strategies.
    
 """
 
 import os, sys
+import argparse
+from collections import Counter
 from subprocess import Popen, PIPE
 from FastaIO import chunkify
 
@@ -269,16 +279,92 @@ def combine_sequences(vsequences, jsequences):
             combined_sequences[("%s_%s_%s"%(vspecies, vallele,jallele)).replace(" ", "_")] = vsequences[v] + jsequences[j]
     return combined_sequences       
 
-def make_putative_alignments( vsequences, jsequences, calignments = None ):
-    all_sequences = {}
+combination_strategies = [ "all", "unique", "weighted" ]
+
+def unique_sequences(sequences):
+    """
+    Keep one allele of each sequence. The first (sorted) allele names it.
+
+    @return: The unique sequences keyed as sequences and the number of alleles with each sequence.
+    """
+    unique, counts = {}, {}
+    first = {}
+    for key in sorted( sequences ):
+        sequence = sequences[key]
+        if sequence not in first:
+            first[sequence] = key
+            unique[key] = sequence
+            counts[key] = 0
+        counts[ first[sequence] ] += 1
+    return unique, counts
+
+def column_weights(sequences, counts):
+    """
+    The contribution of each residue of each sequence to the Henikoff position based weights of an alignment that has 
+    counts[s] copies of each sequence s. In each column a residue contributes 1/(r*n) where r is the number of different 
+    residues in the column and n the number of sequences with that residue. Gaps contribute nothing.
+
+    @return: A dictionary of the sum of the contributions of each sequence and one of its number of residues.
+    """
+    contributions, lengths = dict( (s, 0.0) for s in sequences ), dict( (s, 0) for s in sequences )
+    length = len( list( sequences.values() )[0] )
+    for i in range( length ):
+        residues = Counter()
+        for s in sequences:
+            if sequences[s][i] in acid_set and sequences[s][i] != ".":
+                residues[ sequences[s][i] ] += counts[s]
+        for s in sequences:
+            if sequences[s][i] in residues:
+                contributions[s] += 1.0/( len(residues)*residues[ sequences[s][i] ] )
+                lengths[s] += 1
+    return contributions, lengths
+
+def combine_unique_sequences(vsequences, jsequences, weighted=False):
+    """
+    Combine each unique v sequence with each unique j sequence. 
+
+    If weighted the weight of each combination is the sum of the position based weights that its copies would have in the 
+    full combination (see combine_sequences). The weights are scaled to sum to the number of sequences in the full 
+    combination.
+
+    @return: The combined sequences (as combine_sequences) and their weights (None if not weighted).
+    """
+    vunique, vcounts = unique_sequences( vsequences )
+    junique, jcounts = unique_sequences( jsequences )
+    combined_sequences = combine_sequences( vunique, junique )
+    if not weighted:
+        return combined_sequences, None
+
+    # The weight of a combination is a sum over its columns so the v and j parts can be counted separately. In the full 
+    # combination each v sequence appears once with each j sequence (and each j once with each v).
+    nv, nj = sum( vcounts.values() ), sum( jcounts.values() )
+    vcontributions, vlengths = column_weights( vunique, dict( (v, vcounts[v]*nj) for v in vunique ) )
+    jcontributions, jlengths = column_weights( junique, dict( (j, jcounts[j]*nv) for j in junique ) )
+    weights = {}
+    for v in vunique:
+        vspecies, vallele = v
+        for j in junique:
+            _, jallele = j
+            weight = ( vcontributions[v] + jcontributions[j] )/max( 1, vlengths[v] + jlengths[j] )
+            weights[("%s_%s_%s"%(vspecies, vallele,jallele)).replace(" ", "_")] = weight*vcounts[v]*jcounts[j]
+    scale = nv*nj/sum( weights.values() )
+    return combined_sequences, dict( (s, w*scale) for s, w in weights.items() )
+
+def make_putative_alignments( vsequences, jsequences, calignments = None, combine="all" ):
+    all_sequences, all_weights = {}, {}
     for species, chain_type in vsequences:
         if (species, chain_type) not in jsequences or (species, chain_type) not in vsequences: continue
-        combined_sequences = combine_sequences( vsequences[ (species, chain_type) ], jsequences[ (species, chain_type) ] )
+        if combine == "all":
+            combined_sequences, weights = combine_sequences( vsequences[ (species, chain_type) ], jsequences[ (species, chain_type) ] ), None
+        else:
+            combined_sequences, weights = combine_unique_sequences( vsequences[ (species, chain_type) ], jsequences[ (species, chain_type) ],
+                                                                    weighted=( combine == "weighted" ) )
         all_sequences[ (species, chain_type) ] = combined_sequences
-        output_stockholm( combined_sequences, "%s_%s"%(translations[species], chain_type) )
+        all_weights[ (species, chain_type) ] = weights
+        output_stockholm( combined_sequences, "%s_%s"%(translations[species], chain_type), weights=weights )
 
     # Write just the V and J combinations
-    output_stockholm_all( all_sequences )
+    output_stockholm_all( all_sequences, weights=all_weights )
      
     # Write the V and J combinations and the c-domains
     if calignments:
@@ -332,11 +418,14 @@ def output_python_lookup(all_gene_alignments, path=None):
     with open(filename,'w') as outfile:
         print("all_germlines = "+repr(all_gene_alignments), file=outfile)
 
-def write_stockholm( sequences, ID, outfile):
+def write_stockholm( sequences, ID, outfile, weights=None):
         print("# STOCKHOLM 1.0", file=outfile)
         print("#=GF ID %s"%ID, file=outfile)
         
         pad_length = max(list(map(len, list(sequences.keys()))))+1
+        if weights: # Sequence weights for hmmbuild --wgiven
+            for s in sequences:
+                print("#=GS", s.replace(" ", "_").ljust(pad_length), "WT %.6f"%weights[s], file=outfile)
         for s in sequences:
             print(s.replace(" ", "_").ljust(pad_length), sequences[s].replace(".","-"), file=outfile)
         print("#=GC RF".ljust(pad_length), "x"*len(sequences[s]), file=outfile)
@@ -371,12 +460,13 @@ def output_stockholm_all_and_C(all_sequences, all_C_alignments, path=None):
     return filename      
 
 
-def output_stockholm_all(all_sequences, path=None):
+def output_stockholm_all(all_sequences, path=None, weights=None):
     """
     Output a minimal stockholm alignment file for all sequences. 
     """
     if path is None:
         path = curated_path
+    weights = weights or {}
 
     filename = os.path.join( path, "ALL.stockholm")
     with open( filename, "w") as outfile:
@@ -384,11 +474,11 @@ def output_stockholm_all(all_sequences, path=None):
             sequences = all_sequences[(species, chain_type)]
             l = len(list(sequences.values())[0])
             assert all( [1 if l == len(sequences[s]) else 0 for s in sequences]), "Not all sequences in alignment are the same length"
-            write_stockholm( sequences, "%s_%s"%(translations[species], chain_type), outfile)
+            write_stockholm( sequences, "%s_%s"%(translations[species], chain_type), outfile, weights.get( (species, chain_type) ))
 
     return filename      
 
-def output_stockholm(sequences, name, path=None):
+def output_stockholm(sequences, name, path=None, weights=None):
     """
     Output a minimal stockholm alignment file. 
     """
@@ -401,7 +491,7 @@ def output_stockholm(sequences, name, path=None):
     assert all( [1 if l == len(sequences[s]) else 0 for s in sequences]), "Not all sequences in alignment are the same length"
     
     with open( filename, "w") as outfile:
-        write_stockholm( sequences, name, outfile)
+        write_stockholm( sequences, name, outfile, weights)
 
     
     return filename      
@@ -411,6 +501,13 @@ def main():
     Read in the raw v and j alignments
     Format them and combine the sequences
     """
+    global curated_path
+    parser = argparse.ArgumentParser( description="Format the IMGT germlines into the alignments the HMMs are built from." )
+    parser.add_argument( "--combine", choices=combination_strategies, default="all", help="How the v and j sequences are combined." )
+    parser.add_argument( "--output", default=curated_path, help="The directory to write the alignments and germlines.py to." )
+    args = parser.parse_args()
+    curated_path = args.output
+
     print("\nFormatting alignments\n")
     valignments, jalignments = {},{}
     all_valignments, all_jalignments = {},{}
@@ -468,7 +565,7 @@ def main():
 
     # Combine the alignments to make putative germline alignments (obviously no d gene in there for Hs)
     # Write them to a stockholm alignment file.    
-    combined_sequences  = make_putative_alignments( valignments, jalignments )
+    combined_sequences  = make_putative_alignments( valignments, jalignments, combine=args.combine )
 
     # Write the constant domains each to file.
     #output_C_alignments(ccalignments, 'CC')
@@ -1,24 +1,8 @@
 # Run the pipeline to get the sequences, format them and build the databases
 
-DIR="."
-
-# Rip the sequences from the imgt website. HTML may change in the future. 
-mkdir -p $DIR/IMGT_sequence_files/htmlfiles
-mkdir -p $DIR/IMGT_sequence_files/fastafiles
-python $DIR/RipIMGT.py
-
-# Format the alignments and handle imgt oddities to put into a consistent alignment format
-mkdir -p $DIR/curated_alignments
-mkdir -p $DIR/muscle_alignments
-python $DIR/FormatAlignments.py
-
-# Build the hmms for each species and chain.
-# --hand option required otherwise it will delete columns that are mainly gaps. We want 128 columns otherwise ARNACI will fall over.
-mkdir -p $DIR/HMMs
-hmmbuild --hand $DIR/HMMs/ALL.hmm $DIR/curated_alignments/ALL.stockholm
-#hmmbuild --hand $DIR/HMMs/ALL_AND_C.hmm $DIR/curated_alignments/ALL_AND_C.stockholm
-
-# Turn the output HMMs file into a binary form. This is required for hmmscan that is used in ARNACI.
-hmmpress -f $DIR/HMMs/ALL.hmm 
-#hmmpress -f $DIR/HMMs/ALL_AND_C.hmm
+DIR="$(dirname "$0")"
 
+# The stages (rip the sequences from the imgt website, format the alignments, build the hmms for each species and chain
+# and press them for hmmscan) are run by build.py. Each stage records the hashes of its inputs and outputs and only the
+# stages that are out of date are run. Pass --force to run every stage or --status to see which are out of date.
+python $DIR/build.py "$@"
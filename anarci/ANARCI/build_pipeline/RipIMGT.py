@@ -4,17 +4,31 @@ A program to rip the sequences from genedb and parse them into fasta files
 Ripped from here:
 
 https://www.imgt.org/vquest/refseqh.html     
+
+The pages can also be read from a local mirror so that the germlines can be built offline and reproducibly:
+
+    python RipIMGT.py                                   # Download the pages from IMGT (cached in htmlfiles)
+    python RipIMGT.py --source imgt-2024-01.tar.gz      # Read them from a tarball (or a directory) of pages
+    python RipIMGT.py --archive imgt-2024-01.tar.gz     # Make a mirror of the pages that were used
+
+A mirror holds the pages named as in htmlfiles (e.g. Homo_sapiens_HV.html) or their fasta files (as in fastafiles) in any
+directory of the tree or tarball. An optional VERSION file names the release. Each page is parsed in its own process 
+(--jobs) and a manifest of the sha1 of each page and fasta file (and the source and its version) is written to 
+IMGT_sequence_files/manifest.json.
 """
 
 from html.parser import HTMLParser
 from html.entities import name2codepoint
+from concurrent.futures import ProcessPoolExecutor
 import urllib.request, urllib.parse, urllib.error, os, sys
+import io, json, hashlib, tarfile, argparse
 
 
 # Set globals
 file_path  = os.path.split(__file__)[0]
 html_outpath =  os.path.join( file_path, "IMGT_sequence_files", "htmlfiles" )
 fasta_outpath = os.path.join( file_path, "IMGT_sequence_files", "fastafiles" )
+manifest_file = os.path.join( file_path, "IMGT_sequence_files", "manifest.json" )
 
 # Define where to point the urls to.
 # We have heavy, kappa, lambda, alpha, beta, gamma and delta chains.
@@ -69,14 +83,34 @@ all_tr_species = ["Homo+sapiens",
 
 # Html parser class.
 class GENEDBParser(HTMLParser):
-    currenttag = None
-    currentnamedent = None
-    _data = []
+    """
+    Parse the sequences from a genedb page. The page can be fed in pieces. Sequences are collected as they are parsed and 
+    taken with sequences(). All the state is kept by the instance so a parser is made for each page.
+
+    The text of a tag can be split between pieces so it is collected and parsed when the next tag starts or ends.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.currenttag = None
+        self.currentnamedent = None
+        self._data = []
+        self._text = []
+
     def handle_starttag(self, tag, attrs):
+        self.flush()
         self.currenttag=tag
     def handle_endtag(self, tag):
+        self.flush()
         self.currenttag=None
     def handle_data(self, data):
+        self._text.append( data )
+    def close(self):
+        HTMLParser.close(self)
+        self.flush()
+    def flush(self):
+        if not self._text:
+            return
+        data, self._text = "".join( self._text ), []
         split = data.split("\n")
         start = sum([ 1 if l[0]==">" else 0 for l in split if len(l)])
         if self.currenttag=="pre" and (self.currentnamedent ==">" or start):
@@ -96,7 +130,6 @@ class GENEDBParser(HTMLParser):
                 if name and sequence:
                     self._data.append( (name, sequence) )
             else: # Otherwise it will be done entry by entry
-                print("1")
                 try:
                     name = split[0]
                 except IndexError:
@@ -112,72 +145,290 @@ class GENEDBParser(HTMLParser):
         else:
             self.currentnamedent = chr(int(name))
 
-    def rip_sequences(self,htmlstring):
+    def sequences(self):
         """
-        Method for this subclass that automates the return of data
+        Take the sequences parsed so far.
         """
-        self.reset()
-        self._data = []
-        self.currenttag = None
-        self.currentnamedent = None
-        self.feed(htmlstring)
-        self._data
-        return self._data
-        
-parser = GENEDBParser()
+        data, self._data = self._data, []
+        return data
+
+
+def parse_html(handle, chunk_size=1<<16):
+    """
+    Parse the sequences of a genedb page from a file handle in chunks.
+
+    @return: A list of (name, sequence) tuples.
+    """
+    parser = GENEDBParser()
+    sequences = []
+    for chunk in iter( lambda: handle.read( chunk_size ), "" ):
+        parser.feed( chunk )
+        sequences.extend( parser.sequences() )
+    parser.close()
+    return sequences + parser.sequences()
+
+
+def parse_fasta(handle):
+    """
+    Parse the sequences of a fasta file. The names start with a single ">" as those parsed from the html do (so a fasta
+    file written by write_fasta is written again unchanged).
+    """
+    sequences, name, sequence = [], None, []
+    for line in handle:
+        line = line.strip()
+        if line.startswith(">"):
+            if name is not None:
+                sequences.append( (name, "".join(sequence)) )
+            name, sequence = ">" + line.lstrip(">"), []
+        elif line:
+            sequence.append( line.replace(" ", "") )
+    if name is not None:
+        sequences.append( (name, "".join(sequence)) )
+    return sequences
+
+
+def page_name(species, gene_type):
+    return "%s_%s"%(species.replace("+", "_"), gene_type)
 
 
-def get_html(species, gene_type, force = True):
+###########
+# Sources #
+###########
+# A source gives the page (or fasta file) of a species and gene type. Sources are sent to the worker processes so they
+# only hold names and paths. Each opens what it needs itself.
+
+class IMGTSource(object):
     """
-    Get the html from IMGT
+    Download the pages from genedb. They are kept in htmlfiles and are not downloaded again.
     """
-    filename = os.path.join(html_outpath,"%s_%s.html"%(species.replace("+", "_"), gene_type) )
-    # If html file exists already
-    if os.path.isfile(filename):
-        return filename
-    if urllib.request.urlretrieve( urls[gene_type]%species,  filename ):
-        return filename
-    else:
-        return False
+    missing = "Bad Url"
+
+    def describe(self):
+        return { "source":"imgt", "version":None }
+
+    def open(self, species, gene_type):
+        """
+        @return: The format of the page ("html" or "fasta") and a text handle to it. None if it is not available.
+        """
+        filename = os.path.join(html_outpath,"%s.html"%page_name(species, gene_type) )
+        if not os.path.isfile(filename):
+            try:
+                # Download to a temporary name so that a failed download is not mistaken for a page.
+                urllib.request.urlretrieve( urls[gene_type]%species,  filename + ".part" )
+            except (urllib.error.URLError, OSError):
+                return None
+            os.replace( filename + ".part", filename )
+        return "html", open( filename )
+
+
+class MirrorSource(object):
+    """
+    Read the pages from a local directory.
+    """
+    missing = "Not in the mirror"
+
+    def __init__(self, path):
+        self.path = path
+        self._files = None
+
+    def files(self):
+        # The files of the mirror by name. Wherever they are in the tree.
+        if self._files is None:
+            self._files = {}
+            for directory, _, filenames in os.walk( self.path ):
+                for filename in filenames:
+                    self._files.setdefault( filename, os.path.join( directory, filename ) )
+        return self._files
+
+    def read_version(self):
+        if "VERSION" not in self.files():
+            return None
+        with open( self.files()["VERSION"] ) as f:
+            return f.read().strip()
+
+    def describe(self):
+        return { "source":os.path.abspath( self.path ), "version":self.read_version() }
+
+    def open(self, species, gene_type):
+        name = page_name(species, gene_type)
+        for extension in [ "html", "fasta" ]:
+            if "%s.%s"%(name, extension) in self.files():
+                return extension, open( self.files()["%s.%s"%(name, extension)] )
+        return None
+
+
+class TarballSource(MirrorSource):
+    """
+    Read the pages from a tarball (optionally compressed) of a mirror.
+    """
+    def __init__(self, path):
+        MirrorSource.__init__(self, path)
+        self._tar = None
+
+    def tar(self):
+        if self._tar is None:
+            self._tar = tarfile.open( self.path )
+        return self._tar
+
+    def files(self):
+        if self._files is None:
+            self._files = {}
+            for member in self.tar().getmembers():
+                if member.isfile():
+                    self._files.setdefault( os.path.basename( member.name ), member )
+        return self._files
+
+    def read_version(self):
+        if "VERSION" not in self.files():
+            return None
+        return self.tar().extractfile( self.files()["VERSION"] ).read().decode().strip()
+
+    def describe(self):
+        return { "source":os.path.abspath( self.path ), "version":self.read_version(), "sha1":file_hash( self.path ) }
+
+    def open(self, species, gene_type):
+        name = page_name(species, gene_type)
+        for extension in [ "html", "fasta" ]:
+            if "%s.%s"%(name, extension) in self.files():
+                member = self.tar().extractfile( self.files()["%s.%s"%(name, extension)] )
+                return extension, io.TextIOWrapper( member )
+        return None
+
+    def __getstate__(self): # The open tarball stays in this process.
+        return { "path":self.path, "_files":None, "_tar":None }
+
+
+def get_source(source):
+    """
+    @param source: "imgt" to download from IMGT or the path to a mirror directory or tarball.
+    """
+    if source == "imgt":
+        return IMGTSource()
+    elif os.path.isdir( source ):
+        return MirrorSource( source )
+    elif os.path.isfile( source ) and tarfile.is_tarfile( source ):
+        return TarballSource( source )
+    raise ValueError( "%s is not a directory or a tarball of IMGT pages"%source )
+
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open( filename, "rb" ) as f:
+        for block in iter( lambda: f.read( 1<<20 ), b"" ):
+            sha1.update( block )
+    return sha1.hexdigest()
+
+
+class HashingReader(object):
+    """
+    Wrap a text handle to take the sha1 of what is read from it.
+    """
+    def __init__(self, handle):
+        self.handle = handle
+        self.sha1 = hashlib.sha1()
+    def read(self, size=-1):
+        data = self.handle.read( size )
+        self.sha1.update( data.encode() )
+        return data
+    def __iter__(self):
+        for line in self.handle:
+            self.sha1.update( line.encode() )
+            yield line
+
 
 def write_fasta( sequences, species, gene_type ):
     """
     Write a fasta file containing all sequences
     """
-    filename = os.path.join(fasta_outpath,"%s_%s.fasta"%(species.replace("+", "_"), gene_type) )
+    filename = os.path.join(fasta_outpath,"%s.fasta"%page_name(species, gene_type) )
     with open(filename, "w") as outfile:
         for name, sequence in sequences:
             print(">%s"%name, file=outfile)
             print(sequence, file=outfile)
+    return filename
 
-def ripfasta(species, gene_type, force = True):
+def ripfasta(source, species, gene_type):
     """ 
-    Rip the fasta sequences for a species and gene type from IMGT
-    """
-    htmlfile = get_html(species, gene_type, force)
-    if htmlfile:
-        with open(htmlfile) as infile:
-            sequences = parser.rip_sequences(infile.read())
-        if sequences:
-            write_fasta(sequences, species, gene_type )
-        else:
-            print("Bad parse", end=' ', file=sys.stderr)
-            return 1
-    else:
-        print("Bad Url", end=' ', file=sys.stderr)
-        return 1
+    Rip the fasta sequences for a species and gene type from a source. Run in a worker process.
 
-def main():
+    @return: The species, gene type, an error (None if it was parsed) and its manifest entry.
     """
-    For all V and J gene types (H,K,L,A,B,G,D) parse IMGT database and extract fasta files
+    page = source.open(species, gene_type)
+    if page is None:
+        return species, gene_type, source.missing, None
+    kind, handle = page
+    reader = HashingReader( handle )
+    with handle:
+        sequences = parse_html( reader ) if kind == "html" else parse_fasta( reader )
+    if not sequences:
+        return species, gene_type, "Bad parse", None
+    filename = write_fasta(sequences, species, gene_type )
+    return species, gene_type, None, { "page":"%s.%s"%(page_name(species, gene_type), kind), "page_sha1":reader.sha1.hexdigest(),
+                                       "fasta_sha1":file_hash( filename ), "sequences":len( sequences ) }
+
+def pages():
+    """
+    The species and gene types to rip.
     """
     for gene_type in urls:
         for species in all_species:
             if gene_type[0] in "ABGD" and species not in all_tr_species: continue # we don't want TCRs for all organisms
             if gene_type[0] in "KL" and species == "Vicugna+pacos": continue # alpacas don't have light chains
-            if ripfasta(species, gene_type, force = False):
+            yield species, gene_type
+
+def make_archive(filename, version=None):
+    """
+    Make a mirror tarball of the pages in htmlfiles and the manifest.
+    """
+    mode = "w:gz" if filename.endswith( "gz" ) else "w"
+    with tarfile.open( filename, mode ) as tar:
+        if version:
+            data = ( version + "\n" ).encode()
+            info = tarfile.TarInfo( "VERSION" )
+            info.size = len( data )
+            tar.addfile( info, io.BytesIO( data ) )
+        for species, gene_type in pages():
+            page = os.path.join( html_outpath, "%s.html"%page_name(species, gene_type) )
+            if os.path.isfile( page ):
+                tar.add( page, arcname=os.path.join( "htmlfiles", os.path.basename( page ) ) )
+        if os.path.isfile( manifest_file ):
+            tar.add( manifest_file, arcname="manifest.json" )
+
+def main():
+    """
+    For all V and J gene types (H,K,L,A,B,G,D) parse IMGT database and extract fasta files
+    """
+    parser = argparse.ArgumentParser( description="Parse the IMGT germline pages into fasta files." )
+    parser.add_argument( "--source", default="imgt", help="imgt to download the pages or the path to a mirror directory or tarball of them." )
+    parser.add_argument( "--jobs", "-j", type=int, default=None, help="The number of pages to parse at once. Defaults to the number of cpus." )
+    parser.add_argument( "--archive", help="Make a mirror tarball of the pages that were downloaded (with --source imgt)." )
+    parser.add_argument( "--version", help="The version to record in the archive." )
+    args = parser.parse_args()
+
+    for path in [ html_outpath, fasta_outpath ]:
+        if not os.path.isdir( path ):
+            os.makedirs( path )
+    source = get_source( args.source )
+
+    manifest = dict( source.describe() )
+    manifest["pages"] = {}
+    failed = 0
+    with ProcessPoolExecutor( max_workers=args.jobs ) as pool:
+        futures = [ pool.submit( ripfasta, source, species, gene_type ) for species, gene_type in pages() ]
+        for future in futures:
+            species, gene_type, error, entry = future.result()
+            if error:
+                print(error, end=' ', file=sys.stderr)
                 print("Failed to retrieve %s %s"%(species, gene_type), file=sys.stderr)
+                failed += 1
             else:
                 print("Parsed and saved %s %s"%(species, gene_type))
+                manifest["pages"][ page_name(species, gene_type) ] = entry
+
+    with open( manifest_file, "w" ) as f:
+        json.dump( manifest, f, indent=1, sort_keys=True )
+    if args.archive:
+        make_archive( args.archive, args.version )
          
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Compare the ways FormatAlignments.py can combine the v and j sequences into the alignments the HMMs are built from.
+
+    python benchmark_combine.py                                  # Compare all, unique and weighted
+    python benchmark_combine.py --reference sequences.fasta      # Number these sequences instead of a germline sample
+
+For each strategy the alignments are formatted into a temporary directory, each species and chain alignment is built
+with a single threaded hmmbuild and the HMMs are pressed. The table reports
+    o sequences:  The number of sequences in ALL.stockholm.
+    o alignment:  The size of ALL.stockholm (KB).
+    o hmmbuild:   The total time of the hmmbuilds (seconds).
+    o memory:     The peak memory of the largest hmmbuild (MB).
+    o hmm:        The size of ALL.hmm (KB).
+    o agreement:  The percentage of the reference sequences whose chain type, species and numbering are the same as with
+                  the first strategy.
+    o numbering:  The time to number the reference sequences (seconds).
+
+ANARCI (and hmmer) must be installed. The downloaded germlines (IMGT_sequence_files/fastafiles) are used.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from subprocess import Popen, STDOUT
+
+from build import file_path, bin_path, hmmer_command, hmmbuild_command, BuildError
+from FastaIO import chunkify
+
+strategies = [ "all", "unique", "weighted" ]
+
+
+def run_measured(command, env=None):
+    """
+    Run a command.
+
+    @return: The time it took in seconds and its peak memory in MB (None if it cannot be measured on this platform).
+    """
+    started = time.time()
+    with tempfile.TemporaryFile() as output:
+        process = Popen( command, stdout=output, stderr=STDOUT, cwd=file_path, env=env )
+        memory = None
+        if hasattr( os, "wait4" ): # The resource usage of this process alone.
+            _, status, usage = os.wait4( process.pid, 0 )
+            process.returncode = os.waitstatus_to_exitcode( status )
+            memory = usage.ru_maxrss/1024.0
+        else:
+            process.wait()
+        if process.returncode:
+            output.seek( 0 )
+            raise BuildError( "%s failed:\n%s"%( " ".join( command ), output.read().decode() ) )
+    return time.time() - started, memory
+
+
+def read_stockholm(filename):
+    """
+    @return: The names of the alignments and a list of the (name, sequence) of each sequence without gaps.
+    """
+    names, sequences = [], []
+    with open( filename ) as f:
+        for line in f:
+            if line.startswith( "#=GF ID" ):
+                names.append( line.split()[2] )
+            elif line.strip() and not line.startswith( "#" ) and not line.startswith( "//" ):
+                name, sequence = line.split()
+                sequences.append( ( name, sequence.replace( "-", "" ) ) )
+    return names, sequences
+
+
+def build_strategy(combine, directory, hmmerpath):
+    """
+    Format and build the HMMs of a strategy in a directory.
+
+    @return: A dictionary of the measurements.
+    """
+    env = dict( os.environ )
+    env["PATH"] = os.pathsep.join( [ env.get( "PATH", "" ), bin_path ] )
+    run_measured( [ sys.executable, os.path.join( file_path, "FormatAlignments.py" ), "--combine", combine,
+                    "--output", directory ], env=env )
+    stockholm = os.path.join( directory, "ALL.stockholm" )
+    names, sequences = read_stockholm( stockholm )
+
+    seconds, memory = 0.0, 0.0
+    hmm = os.path.join( directory, "ALL.hmm" )
+    with open( hmm, "wb" ) as outfile:
+        for name in names:
+            part = os.path.join( directory, "%s.hmm"%name )
+            alignment = os.path.join( directory, "%s.stockholm"%name )
+            elapsed, peak = run_measured( hmmbuild_command( alignment, hmmerpath ) + [ "--cpu", "1", part, alignment ] )
+            seconds += elapsed
+            memory = max( memory, peak ) if peak is not None else None
+            with open( part, "rb" ) as f:
+                outfile.write( f.read() )
+    run_measured( [ hmmer_command( "hmmpress", hmmerpath ), "-f", hmm ] )
+    return { "sequences":len( sequences ), "alignment":os.path.getsize( stockholm )/1024.0, "hmmbuild":seconds,
+             "memory":memory, "hmm":os.path.getsize( hmm )/1024.0, "database":hmm, "germlines":sequences }
+
+
+def number(sequences, database, scheme, hmmerpath):
+    """
+    @return: The time to number the sequences and the chain type, species and numbering of the first domain of each.
+    """
+    from anarci import anarci
+    started = time.time()
+    numbered, details, _ = anarci( sequences, scheme=scheme, database=database, hmmerpath=hmmerpath, allowed_species=None )
+    elapsed = time.time() - started
+    results = []
+    for i in range( len( sequences ) ):
+        if not numbered[i]:
+            results.append( None )
+        else:
+            results.append( ( details[i][0]["chain_type"], details[i][0]["species"], numbered[i][0][0] ) )
+    return elapsed, results
+
+
+def main():
+    parser = argparse.ArgumentParser( description="Compare the strategies FormatAlignments.py can combine the v and j sequences with." )
+    parser.add_argument( "--strategies", nargs="+", choices=strategies, default=strategies, help="The strategies to compare. Agreement is with the first." )
+    parser.add_argument( "--reference", help="A fasta file of sequences to number. Defaults to a sample of the putative germlines of the first strategy." )
+    parser.add_argument( "--sample", type=int, default=500, help="The number of putative germlines to number if no reference is given." )
+    parser.add_argument( "--scheme", default="imgt", help="The numbering scheme to compare." )
+    parser.add_argument( "--hmmerpath", default="", help="The directory containing hmmbuild, hmmpress and hmmscan." )
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        results = {}
+        for combine in args.strategies:
+            print( "Building %s"%combine, file=sys.stderr )
+            path = os.path.join( directory, combine )
+            os.makedirs( path )
+            results[combine] = build_strategy( combine, path, args.hmmerpath )
+
+        if args.reference:
+            with open( args.reference ) as f:
+                reference = [ ( record.description.split()[0], record.seq ) for record in chunkify( f ) ]
+        else:
+            germlines = results[ args.strategies[0] ]["germlines"]
+            reference = random.Random( 0 ).sample( germlines, min( args.sample, len( germlines ) ) )
+
+        baseline = None
+        for combine in args.strategies:
+            print( "Numbering %d sequences with %s"%( len( reference ), combine ), file=sys.stderr )
+            results[combine]["numbering"], numbering = number( reference, results[combine]["database"], args.scheme,
+                                                               args.hmmerpath )
+            if baseline is None:
+                baseline = numbering
+            same = sum( 1 for a, b in zip( baseline, numbering ) if a == b )
+            results[combine]["agreement"] = 100.0*same/max( 1, len( reference ) )
+
+        print( "%-10s %10s %10s %10s %10s %10s %10s %10s"%( "strategy", "sequences", "alignment", "hmmbuild", "memory", "hmm",
+                                                            "agreement", "numbering" ) )
+        for combine in args.strategies:
+            r = results[combine]
+            print( "%-10s %10d %10.1f %10.2f %10s %10.1f %9.2f%% %10.2f"%( combine, r["sequences"], r["alignment"], r["hmmbuild"],
+                   "%.1f"%r["memory"] if r["memory"] is not None else "-", r["hmm"], r["agreement"], r["numbering"] ) )
+    finally:
+        shutil.rmtree( directory, ignore_errors=True )
+
+
+if __name__ == "__main__":
+    main()
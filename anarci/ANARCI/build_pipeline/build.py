@@ -0,0 +1,486 @@
+"""
+Build the germlines and HMMs in stages. Only the stages whose inputs have changed are run again.
+
+    python build.py                    # Build whatever is out of date
+    python build.py --status           # Show which stages are out of date
+    python build.py --force format     # Run the format stage (and so everything after it) again
+    python build.py --jobs 8 --verify  # Build the HMMs with 8 hmmbuilds at once and check them against a serial build
+    python build.py --combine weighted # Build from the weighted unique v and j combinations (see FormatAlignments.py)
+    python build.py --source imgt.tgz  # Build from a mirror of the IMGT pages instead of downloading them
+
+The stages are
+    o rip:      Download the IMGT germline pages and parse them into fasta files (RipIMGT.py). The downloaded pages
+                are kept so this is only run if the fasta files are missing or if it is forced. To update a species
+                replace its fasta files (or remove its html pages and force the stage). With --source the pages are
+                read from a local mirror (a directory or tarball) instead and the stage is run when the mirror changes.
+    o format:   Format the germlines into the curated stockholm alignments and germlines.py (FormatAlignments.py).
+    o hmmbuild: Build a HMM from each species and chain alignment. Only the alignments that have changed are built
+                again. The alignments are built in parallel (--jobs, one hmmbuild for each cpu by default). The HMMs
+                are concatenated into ALL.hmm in the order of ALL.stockholm. hmmbuild builds each profile of an
+                alignment file independently so ALL.hmm is the same as one hmmbuild of ALL.stockholm (--verify checks).
+    o hmmpress: Press ALL.hmm for hmmscan.
+    o restrict: Press a database of the HMMs of each species (and of the default species, human and mouse) into
+                HMMs/restricted. anarci uses these when the search is restricted to those species instead of making
+                them itself the first time they are asked for (see restricted_hmm_database).
+    o precompute: Write the lookup tables that depend on the HMMs and germlines (HMM lengths and germline matrices) to
+                HMMs/ALL.precomputed for anarci to map at startup (see lib/python/anarci/precomputed.py).
+
+Each stage records the sha1 of its input and output files and its options in build_state.json. A stage is run if any of
+its inputs, outputs or options differ from those recorded when it last ran.
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import hashlib
+import runpy
+import argparse
+import tempfile
+import importlib.util
+from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+
+file_path = os.path.abspath( os.path.split(__file__)[0] )
+state_file = os.path.join( file_path, "build_state.json" )
+fasta_path = os.path.join( file_path, "IMGT_sequence_files", "fastafiles" )
+html_path = os.path.join( file_path, "IMGT_sequence_files", "htmlfiles" )
+curated_path = os.path.join( file_path, "curated_alignments" )
+muscle_path = os.path.join( file_path, "muscle_alignments" )
+hmm_path = os.path.join( file_path, "HMMs" )
+parts_path = os.path.join( hmm_path, "parts" )
+restricted_path = os.path.join( hmm_path, "restricted" )
+bin_path = os.path.join( os.path.split( file_path )[0], "bin" ) # The muscle binaries shipped with ANARCI
+precomputed_module = os.path.join( os.path.split( file_path )[0], "lib", "python", "anarci", "precomputed.py" )
+
+stage_names = [ "rip", "format", "hmmbuild", "hmmpress", "restrict", "precompute" ]
+
+# The species that anarci searches by default (allowed_species). A database of them is pressed with those of each species.
+default_species = [ "human", "mouse" ]
+
+
+class BuildError(Exception):
+    pass
+
+
+def file_hash(filename):
+    """
+    The sha1 of a file's contents.
+    """
+    sha1 = hashlib.sha1()
+    with open( filename, "rb" ) as f:
+        for block in iter( lambda: f.read( 1<<20 ), b"" ):
+            sha1.update( block )
+    return sha1.hexdigest()
+
+
+def hash_files(filenames):
+    """
+    @return: A dictionary of the sha1 of each file keyed by its path relative to the build directory.
+    """
+    return dict( ( os.path.relpath( f, file_path ), file_hash( f ) ) for f in sorted( filenames ) if os.path.isfile( f ) )
+
+
+def read_state():
+    if not os.path.isfile( state_file ):
+        return { "stages":{}, "hmms":{} }
+    with open( state_file ) as f:
+        return json.load( f )
+
+
+def write_state(state):
+    # Write and rename so that an interrupted build never leaves a corrupt state file.
+    with open( state_file + ".tmp", "w" ) as f:
+        json.dump( state, f, indent=1, sort_keys=True )
+    os.replace( state_file + ".tmp", state_file )
+
+
+def run(command, env=None):
+    """
+    Run a command. Raise a BuildError with its output if it fails.
+    """
+    process = Popen( command, stdout=PIPE, stderr=PIPE, cwd=file_path, env=env )
+    output, error = process.communicate()
+    if process.returncode:
+        raise BuildError( "%s failed:\n%s%s"%( " ".join( command ), output.decode(), error.decode() ) )
+    return output.decode()
+
+
+def hmmer_command(name, hmmerpath):
+    return os.path.join( hmmerpath, name ) if hmmerpath else name
+
+
+################
+# Stage inputs #
+################
+# Each stage is described by the files it reads and the files it writes.
+
+def source_files(source):
+    """
+    The files of a local mirror of the IMGT pages. None for IMGT itself.
+    """
+    if source == "imgt":
+        return []
+    elif os.path.isdir( source ):
+        return [ os.path.join( directory, f ) for directory, _, filenames in os.walk( source ) for f in filenames ]
+    return [ source ]
+
+
+def stage_inputs(name, options):
+    if name == "rip":
+        return [ os.path.join( file_path, "RipIMGT.py" ) ] + source_files( options.source )
+    elif name == "format":
+        return ( glob.glob( os.path.join( fasta_path, "*.fasta" ) ) +
+                 [ os.path.join( file_path, "FormatAlignments.py" ), os.path.join( file_path, "FastaIO.py" ) ] )
+    elif name == "hmmbuild":
+        return glob.glob( os.path.join( curated_path, "*.stockholm" ) )
+    elif name in ( "hmmpress", "restrict" ):
+        return [ os.path.join( hmm_path, "ALL.hmm" ) ]
+    elif name == "precompute":
+        return [ os.path.join( hmm_path, "ALL.hmm" ), os.path.join( curated_path, "germlines.py" ), precomputed_module ]
+
+
+def stage_outputs(name):
+    if name == "rip":
+        return glob.glob( os.path.join( fasta_path, "*.fasta" ) )
+    elif name == "format":
+        return glob.glob( os.path.join( curated_path, "*.stockholm" ) ) + [ os.path.join( curated_path, "germlines.py" ) ]
+    elif name == "hmmbuild":
+        return [ os.path.join( hmm_path, "ALL.hmm" ) ]
+    elif name == "hmmpress":
+        return glob.glob( os.path.join( hmm_path, "ALL.hmm.h3?" ) )
+    elif name == "restrict":
+        return glob.glob( os.path.join( restricted_path, "ALL_*.hmm*" ) )
+    elif name == "precompute":
+        return glob.glob( os.path.join( hmm_path, "ALL.precomputed" ) )
+
+
+def stage_options(name, options):
+    """
+    The options that change the outputs of a stage.
+    """
+    if name == "rip":
+        return { "source":options.source if options.source == "imgt" else os.path.abspath( options.source ) }
+    elif name == "format":
+        return { "combine":options.combine }
+    return {}
+
+
+def out_of_date(state, name, options):
+    """
+    @return: The reason a stage needs to be run or None if it is up to date.
+    """
+    outputs = stage_outputs( name )
+    if name == "rip" and options.source == "imgt": 
+        # Downloaded pages are cached so it is only run again if the fasta files are missing.
+        return None if outputs else "no fasta files"
+    recorded = state["stages"].get( name )
+    if recorded is None:
+        return "never run"
+    if not outputs:
+        return "no outputs"
+    if hash_files( stage_inputs( name, options ) ) != recorded["inputs"]:
+        return "inputs changed"
+    if hash_files( outputs ) != recorded["outputs"]:
+        return "outputs changed"
+    if recorded.get( "options" ) != stage_options( name, options ):
+        return "options changed"
+    return None
+
+
+def record(state, name, started, options):
+    state["stages"][name] = { "inputs":hash_files( stage_inputs( name, options ) ), "outputs":hash_files( stage_outputs( name ) ),
+                              "options":stage_options( name, options ), "seconds":round( time.time() - started, 2 ) }
+    write_state( state )
+
+
+##########
+# Stages #
+##########
+def rip(state, options):
+    for path in [ html_path, fasta_path ]:
+        if not os.path.isdir( path ):
+            os.makedirs( path )
+    # RipIMGT is run in the build directory.
+    source = options.source if options.source == "imgt" else os.path.abspath( options.source )
+    run( [ sys.executable, os.path.join( file_path, "RipIMGT.py" ), "--source", source, "--jobs", str( options.jobs ) ] )
+
+
+def format_alignments(state, options):
+    for path in [ curated_path, muscle_path ]:
+        if not os.path.isdir( path ):
+            os.makedirs( path )
+    # Alignments of species or chains that are no longer in the germlines must not be built.
+    for stockholm in glob.glob( os.path.join( curated_path, "*.stockholm" ) ):
+        os.remove( stockholm )
+    env = dict( os.environ )
+    env["PATH"] = os.pathsep.join( [ env.get( "PATH", "" ), bin_path ] ) # muscle if it is not installed
+    run( [ sys.executable, os.path.join( file_path, "FormatAlignments.py" ), "--combine", options.combine ], env=env )
+
+
+def alignment_order():
+    """
+    The names of the alignments in the order of ALL.stockholm. The HMMs are written to ALL.hmm in this order.
+    """
+    names = []
+    with open( os.path.join( curated_path, "ALL.stockholm" ) ) as f:
+        for line in f:
+            if line.startswith( "#=GF ID" ):
+                names.append( line.split()[2] )
+    return names
+
+
+def hmmbuild_command(stockholm, hmmerpath):
+    """
+    The hmmbuild command for an alignment.
+
+    --hand is required otherwise columns that are mainly gaps are removed. We want 128 columns otherwise ANARCI will fall
+    over. Alignments that give sequence weights (FormatAlignments.py --combine weighted) are built with them.
+    """
+    command = [ hmmer_command( "hmmbuild", hmmerpath ), "--hand" ]
+    with open( stockholm ) as f:
+        if any( line.startswith( "#=GS" ) and " WT " in line for line in f ):
+            command.append( "--wgiven" )
+    return command
+
+
+def build_part(name, hmmerpath, threads=None):
+    """
+    Build the HMM of one species and chain alignment.
+
+    @param threads: The number of threads hmmbuild may use. hmmbuild's default (all cpus) if None.
+    """
+    stockholm = os.path.join( curated_path, "%s.stockholm"%name )
+    hmm = os.path.join( parts_path, "%s.hmm"%name )
+    command = hmmbuild_command( stockholm, hmmerpath )
+    if threads is not None:
+        command += [ "--cpu", str( threads ) ]
+    run( command + [ hmm, stockholm ] )
+    return hmm
+
+
+def run_parallel(function, arguments, jobs):
+    """
+    Call a function with each of a list of arguments in a pool of jobs threads (the work is done by the subprocesses
+    they run). Waits for every call to finish.
+
+    @return: The futures of the calls in the order of the arguments.
+    """
+    with ThreadPoolExecutor( max_workers=max( 1, jobs ) ) as pool:
+        return [ pool.submit( function, *args ) for args in arguments ]
+
+
+def hmmbuild(state, options):
+    if not os.path.isdir( parts_path ):
+        os.makedirs( parts_path )
+    names = alignment_order()
+    built = state.setdefault( "hmms", {} )
+    to_build = []
+    for name in names:
+        hmm = os.path.join( parts_path, "%s.hmm"%name )
+        alignment_hash = file_hash( os.path.join( curated_path, "%s.stockholm"%name ) )
+        previous = built.get( name )
+        if ( not options.rebuild_all and previous and previous["alignment"] == alignment_hash and os.path.isfile( hmm )
+             and file_hash( hmm ) == previous["hmm"] ):
+            continue
+        to_build.append( ( name, alignment_hash ) )
+
+    # Each hmmbuild gets a single thread when several are run at once. Its threads only help the calibration.
+    threads = 1 if options.jobs > 1 else None
+    print( "    hmmbuild %d of %d alignments with %d jobs"%( len( to_build ), len( names ), min( options.jobs, len( to_build ) ) ) )
+    futures = run_parallel( build_part, [ ( name, options.hmmerpath, threads ) for name, _ in to_build ], options.jobs )
+    # Record the parts that were built before raising the first error so that they are not built again.
+    for ( name, alignment_hash ), future in zip( to_build, futures ):
+        if future.exception() is None:
+            built[name] = { "alignment":alignment_hash, "hmm":file_hash( future.result() ) }
+    write_state( state )
+    for future in futures:
+        future.result()
+
+    # Forget the HMMs of alignments that are no longer built.
+    for name in set( built ) - set( names ):
+        del built[name]
+        if os.path.isfile( os.path.join( parts_path, "%s.hmm"%name ) ):
+            os.remove( os.path.join( parts_path, "%s.hmm"%name ) )
+
+    hmm = b"".join( read_bytes( os.path.join( parts_path, "%s.hmm"%name ) ) for name in names )
+    all_hmm = os.path.join( hmm_path, "ALL.hmm" )
+    # Only write ALL.hmm if it has changed. Its modification time tells anarci whether its restricted databases are current.
+    if not os.path.isfile( all_hmm ) or read_bytes( all_hmm ) != hmm:
+        with open( all_hmm, "wb" ) as outfile:
+            outfile.write( hmm )
+    if options.verify:
+        verify( options.hmmerpath )
+
+
+def read_bytes(filename):
+    with open( filename, "rb" ) as f:
+        return f.read()
+
+
+def without_dates(hmm):
+    return [ line for line in hmm.splitlines() if not line.startswith( b"DATE" ) ]
+
+
+def verify(hmmerpath):
+    """
+    Check that ALL.hmm is the same as one serial hmmbuild of ALL.stockholm. Only the DATE lines (the time each HMM was
+    built) may differ.
+    """
+    print( "    verifying ALL.hmm against a serial hmmbuild of ALL.stockholm" )
+    directory = tempfile.mkdtemp()
+    try:
+        serial = os.path.join( directory, "ALL.hmm" )
+        stockholm = os.path.join( curated_path, "ALL.stockholm" )
+        run( hmmbuild_command( stockholm, hmmerpath ) + [ serial, stockholm ] )
+        if without_dates( read_bytes( serial ) ) != without_dates( read_bytes( os.path.join( hmm_path, "ALL.hmm" ) ) ):
+            raise BuildError( "ALL.hmm differs from a serial hmmbuild of ALL.stockholm" )
+    finally:
+        for filename in os.listdir( directory ):
+            os.remove( os.path.join( directory, filename ) )
+        os.rmdir( directory )
+
+
+def hmmpress(state, options):
+    run( [ hmmer_command( "hmmpress", options.hmmerpath ), "-f", os.path.join( hmm_path, "ALL.hmm" ) ] )
+
+
+def read_profiles():
+    """
+    @return: A list of the name and text of each profile of ALL.hmm in order.
+    """
+    profiles, lines = [], []
+    with open( os.path.join( hmm_path, "ALL.hmm" ), "rb" ) as f:
+        for line in f:
+            lines.append( line )
+            if line.startswith( b"NAME " ):
+                name = line.split()[1].decode()
+            elif line.startswith( b"//" ):
+                profiles.append( ( name, b"".join( lines ) ) )
+                lines = []
+    return profiles
+
+
+def restricted_name(names):
+    """
+    The name anarci gives the database of these profiles. As restricted_hmm_database in anarci.py.
+    """
+    dbname = "ALL_%s"%"-".join( names )
+    if len( dbname ) > 128:
+        dbname = "ALL_%s"%hashlib.sha1( dbname.encode() ).hexdigest()
+    return dbname
+
+
+def press_restricted(names, profiles, hmmerpath):
+    hmm = os.path.join( restricted_path, "%s.hmm"%restricted_name( names ) )
+    with open( hmm, "wb" ) as outfile:
+        for name, text in profiles:
+            if name in names:
+                outfile.write( text )
+    run( [ hmmer_command( "hmmpress", hmmerpath ), "-f", hmm ] )
+
+
+def restrict(state, options):
+    if os.path.isdir( restricted_path ):
+        for filename in glob.glob( os.path.join( restricted_path, "ALL_*.hmm*" ) ):
+            os.remove( filename )
+    else:
+        os.makedirs( restricted_path )
+    profiles = read_profiles()
+    species = []
+    for name, _ in profiles:
+        if name.split( "_" )[0] not in species:
+            species.append( name.split( "_" )[0] )
+    # The databases of each species and of the default species. Those of every species are just ALL.hmm.
+    restrictions = [ [ s ] for s in species ]
+    if all( s in species for s in default_species ):
+        restrictions.append( default_species )
+    restrictions = [ r for r in restrictions if len( r ) < len( species ) ]
+    databases = [ [ name for name, _ in profiles if name.split( "_" )[0] in r ] for r in restrictions ]
+    for future in run_parallel( press_restricted, [ ( names, profiles, options.hmmerpath ) for names in databases ], options.jobs ):
+        future.result()
+
+
+def precompute(state, options):
+    # The bundle is written by the module that reads it so that the two always agree on its format. It only uses the 
+    # standard library so it is loaded from its file rather than from an installed anarci.
+    spec = importlib.util.spec_from_file_location( "precomputed", precomputed_module )
+    precomputed = importlib.util.module_from_spec( spec )
+    spec.loader.exec_module( precomputed )
+    germlines = runpy.run_path( os.path.join( curated_path, "germlines.py" ) )["all_germlines"]
+    precomputed.write_bundle( os.path.join( hmm_path, "ALL.precomputed" ), germlines, os.path.join( hmm_path, "ALL.hmm" ) )
+
+
+stages = { "rip":rip, "format":format_alignments, "hmmbuild":hmmbuild, "hmmpress":hmmpress, "restrict":restrict,
+           "precompute":precompute }
+
+
+def build(force=(), hmmerpath="", rebuild_all=False, status=False, jobs=None, verify=False, combine="all", source="imgt"):
+    """
+    Run the stages that are out of date (or forced) in order. Once a stage has run, all later stages are checked again
+    against its new outputs.
+
+    @param force: The names of the stages to run whether or not they are out of date.
+    @param hmmerpath: The directory of hmmbuild and hmmpress. The PATH is searched if it is not given.
+    @param rebuild_all: Build the HMM of every alignment again, not just those that have changed.
+    @param status: Only report which stages are out of date.
+    @param jobs: The number of hmmbuilds (and hmmpresses) to run at once. Defaults to the number of cpus.
+    @param verify: Check that the HMMs are the same as those of one serial hmmbuild of ALL.stockholm.
+    @param combine: How the v and j sequences are combined into the alignments. all, unique or weighted (see 
+                    FormatAlignments.py).
+    @param source: Where the IMGT pages are read from. imgt to download them or the path to a mirror directory or 
+                   tarball (see RipIMGT.py).
+
+    @return: The names of the stages that were run (or would be run with status).
+    """
+    options = argparse.Namespace( hmmerpath=hmmerpath, rebuild_all=rebuild_all, jobs=jobs or os.cpu_count() or 1,
+                                  verify=verify, combine=combine, source=source )
+    state = read_state()
+    ran = []
+    for name in stage_names:
+        reason = "forced" if name in force else out_of_date( state, name, options )
+        if reason is None and status and ran: # Its inputs are only known once the earlier stages have run.
+            print( "%-10s may be out of date after %s"%( name, ran[-1] ) )
+            continue
+        if reason is None:
+            print( "%-10s up to date"%name )
+            continue
+        if status:
+            print( "%-10s out of date (%s)"%( name, reason ) )
+            ran.append( name )
+            continue
+        print( "%-10s running (%s)"%( name, reason ) )
+        started = time.time()
+        stages[name]( state, options )
+        record( state, name, started, options )
+        print( "%-10s done in %.1f seconds"%( name, time.time() - started ) )
+        ran.append( name )
+    return ran
+
+
+def main():
+    parser = argparse.ArgumentParser( description="Build the ANARCI germlines and HMMs. Only stages that are out of date are run." )
+    parser.add_argument( "--force", nargs="*", choices=stage_names, default=[], help="Run these stages even if they are up to date. All stages if none are given." )
+    parser.add_argument( "--status", action="store_true", help="Show which stages are out of date without running them." )
+    parser.add_argument( "--rebuild_all", action="store_true", help="Build the HMM of every alignment, not only those that have changed." )
+    parser.add_argument( "--hmmerpath", default="", help="The directory containing hmmbuild and hmmpress." )
+    parser.add_argument( "--jobs", "-j", type=int, default=None, help="The number of hmmbuilds to run at once. Defaults to the number of cpus." )
+    parser.add_argument( "--verify", action="store_true", help="Check the HMMs against one serial hmmbuild of ALL.stockholm when they are built." )
+    parser.add_argument( "--combine", choices=[ "all", "unique", "weighted" ], default="all", help="How the v and j sequences are combined into the alignments (see FormatAlignments.py)." )
+    parser.add_argument( "--source", default="imgt", help="imgt to download the IMGT pages or the path to a mirror directory or tarball of them (see RipIMGT.py)." )
+    args = parser.parse_args()
+
+    force = args.force
+    if "--force" in sys.argv and not force:
+        force = stage_names
+    try:
+        build( force=force, hmmerpath=args.hmmerpath, rebuild_all=args.rebuild_all, status=args.status, jobs=args.jobs,
+               verify=args.verify, combine=args.combine, source=args.source )
+    except BuildError as e:
+        print( "Error:", e, file=sys.stderr )
+        sys.exit( 1 )
+
+
+if __name__ == "__main__":
+    main()
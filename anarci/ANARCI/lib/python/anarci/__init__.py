@@ -1,3 +1,3 @@
 __version__ = "1.b"
-__all__ = ["anarci", "schemes"]
+__all__ = ["anarci", "schemes", "domains", "matrices", "prefilter", "fastpath", "store", "aio", "batching", "planner", "precomputed"]
 from .anarci import *
@@ -0,0 +1,220 @@
+#    ANARCI - Antibody Numbering and Antigen Receptor ClassIfication
+#    Copyright (C) 2016 Oxford Protein Informatics Group (OPIG)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the BSD 3-Clause License.
+#
+#    You should have received a copy of the BSD 3-Clause Licence
+#    along with this program.  If not, see <https://opensource.org/license/bsd-3-clause/>.
+
+'''
+Asyncio versions of the ANARCI api for use inside async services (e.g. a web service).
+
+    numbered, alignment_details, hit_tables = await anarci_async(sequences, scheme="kabat", timeout=10)
+
+hmmscan is run with asyncio.create_subprocess_exec. The sequences are streamed to its stdin and its output is read from
+its stdout so the event loop is never blocked waiting for it. Parsing the output and numbering are done in a shared
+executor (a thread pool by default, see set_executor). Many concurrent requests therefore overlap without holding a
+thread each while hmmscan runs.
+
+If a call is cancelled or times out its hmmscan process is killed.
+'''
+
+import os
+import io
+import signal
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .anarci import ( HMMscanError, HMM_path, scheme_short_to_long, write_fasta, parse_hmmer_output, check_for_j,
+                      number_sequences_from_alignment, hit_table_columns, get_numberer, grouper, read_fasta,
+                      validate_sequence )
+
+_executor = None
+
+def get_executor():
+    """
+    Get the executor that parsing and numbering are done in. A thread pool is made the first time it is asked for.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor( max_workers=4, thread_name_prefix="anarci" )
+    return _executor
+
+
+def set_executor(executor):
+    """
+    Set the executor that parsing and numbering are done in. e.g. a larger thread pool or a ProcessPoolExecutor.
+    """
+    global _executor
+    _executor = executor
+
+
+async def run_hmmer_async(sequence_list, hmm_database="ALL", hmmerpath="", ncpu=None, bit_score_threshold=80,
+                          hmmer_species=None, lean=False, executor=None):
+    """
+    Run the sequences against an hmm database with hmmscan without blocking the event loop. See run_hmmer.
+
+    The hmmscan process is killed if the coroutine is cancelled (e.g. by a timeout).
+    """
+    if not sequence_list:
+        return []
+    if hmm_database in ["ALL"]:
+        HMM = os.path.join( HMM_path, "%s.hmm"%hmm_database )
+    else:
+        HMM = hmm_database
+    hmmscan = os.path.join( hmmerpath, "hmmscan" ) if hmmerpath else "hmmscan"
+    command = [ hmmscan ]
+    if ncpu is not None:
+        command += [ "--cpu", str(ncpu) ]
+    if lean: # Domains under the threshold are never used. Do not report them.
+        command += [ "--domT", str(bit_score_threshold) ]
+    command += [ HMM, "-" ] # Sequences from stdin. Output to stdout.
+
+    fasta = io.StringIO()
+    write_fasta( sequence_list, fasta )
+
+    # hmmscan is started in its own process group so that it can be killed with anything it starts (e.g. if a wrapper
+    # script is used).
+    process = await asyncio.create_subprocess_exec( *command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, 
+                                                    stderr=asyncio.subprocess.PIPE, start_new_session=( os.name == "posix" ) )
+    try:
+        output, error = await process.communicate( fasta.getvalue().encode() )
+    except BaseException: # Cancelled or timed out. Do not leave hmmscan running.
+        _kill( process )
+        await process.wait()
+        raise
+    if error or process.returncode:
+        raise HMMscanError( error.decode() or "hmmscan exited with status %d"%process.returncode )
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor( executor or get_executor(), _parse, output, bit_score_threshold, hmmer_species, lean )
+
+
+def _kill(process):
+    if process.returncode is not None:
+        return
+    try:
+        if os.name == "posix":
+            os.killpg( process.pid, signal.SIGKILL )
+        else:
+            process.kill()
+    except ProcessLookupError: # It has just finished.
+        pass
+
+
+def _parse(output, bit_score_threshold, hmmer_species, lean):
+    return parse_hmmer_output( io.StringIO( output.decode() ), bit_score_threshold=bit_score_threshold,
+                               hmmer_species=hmmer_species, lean=lean )
+
+
+async def anarci_async(sequences, scheme="imgt", database="ALL", allow=set(["H","K","L","A","B","G","D"]), hmmerpath="",
+                       ncpu=None, assign_germline=False, allowed_species=['human','mouse'], bit_score_threshold=80,
+                       compact=False, lean=False, fast_path=False, timeout=None, executor=None):
+    """
+    Identify and number the domains of sequences without blocking the event loop. The arguments are as for anarci.
+
+    @param timeout:   The number of seconds to allow for the call. asyncio.TimeoutError is raised (and hmmscan is killed)
+                      if it takes longer. None for no limit.
+    @param executor:  The executor to parse and number in. Defaults to the shared executor (see get_executor).
+
+    @return: Three lists. Numbered, Alignment_details and Hit_tables. As anarci.
+    """
+    try:
+        scheme = scheme_short_to_long[scheme.lower()]
+    except KeyError:
+        raise AssertionError("Unrecognised or unimplemented scheme: %s"%scheme)
+
+    coroutine = _anarci_async( sequences, scheme, database, allow, hmmerpath, ncpu, assign_germline, allowed_species,
+                               bit_score_threshold, compact, lean, fast_path, executor or get_executor() )
+    if timeout is None:
+        return await coroutine
+    return await asyncio.wait_for( coroutine, timeout )
+
+
+async def _anarci_async(sequences, scheme, database, allow, hmmerpath, ncpu, assign_germline, allowed_species,
+                        bit_score_threshold, compact, lean, fast_path, executor):
+    loop = asyncio.get_running_loop()
+
+    # Number the canonical domains from their anchors first (see anarci). Only the others are searched.
+    alignments = [ None ]*len( sequences )
+    if fast_path:
+        numberer = get_numberer() if fast_path is True else fast_path
+        results = await loop.run_in_executor( executor, _fast_path, numberer, sequences )
+        for i, result in enumerate( results ):
+            if result is not None:
+                state_vector, details = result
+                if details["chain_type"] in allow and ( allowed_species is None or details["species"] in allowed_species ):
+                    alignments[i] = ( None if lean else [ list(hit_table_columns) ], [ state_vector ], [ details ] )
+    searched = [ i for i in range( len(sequences) ) if alignments[i] is None ]
+
+    realignments = await run_hmmer_async( [ sequences[i] for i in searched ], hmm_database=database, hmmerpath=hmmerpath,
+                                          ncpu=ncpu, bit_score_threshold=bit_score_threshold, hmmer_species=allowed_species,
+                                          lean=lean, executor=executor )
+    for i, alignment in zip( searched, realignments ):
+        alignments[i] = alignment
+
+    # check_for_j searches again (synchronously) for the rare very long CDR3s. It is run with the numbering.
+    def number():
+        check_for_j( sequences, alignments, scheme, lean=lean, hmm_database=database, hmmerpath=hmmerpath )
+        return number_sequences_from_alignment( sequences, alignments, scheme=scheme, allow=allow,
+                                                assign_germline=assign_germline, allowed_species=allowed_species,
+                                                compact=compact, lean=lean )
+    return await loop.run_in_executor( executor, number )
+
+
+def _fast_path(numberer, sequences):
+    return [ numberer.state_vector( sequence ) for _, sequence in sequences ]
+
+
+async def run_anarci_async(seq, concurrency=4, chunksize=100, **kwargs):
+    """
+    Number a list of sequences, a fasta file or a single sequence without blocking the event loop. The sequences are
+    divided into chunks that are numbered concurrently.
+
+    @param seq:         A list or tuple of (Id, Sequence) pairs, a fasta file or a single sequence.
+    @param concurrency: The maximum number of chunks (hmmscan processes) in flight at once.
+    @param chunksize:   The number of sequences in each chunk.
+
+    Other keyword arguments are passed to anarci_async. A timeout applies to the whole run.
+
+    @return: Four lists. Sequences, Numbered, Alignment_details and Hit_tables. As run_anarci.
+    """
+    if isinstance(seq, list) or isinstance(seq, tuple):
+        assert all( len(_) == 2 for _ in seq ), "If list or tuple supplied as input format must be [ ('ID1','seq1'), ('ID2', 'seq2'), ... ]"
+        sequences = list( seq )
+    elif os.path.isfile( seq ): # Fasta file.
+        sequences = read_fasta( seq )
+    else: # Single sequence
+        validate_sequence( seq )
+        sequences = [ ("Input sequence", seq) ]
+
+    timeout = kwargs.pop( "timeout", None )
+    semaphore = asyncio.Semaphore( max( 1, concurrency ) )
+
+    async def number(chunk):
+        async with semaphore:
+            return await anarci_async( chunk, **kwargs )
+
+    async def number_all():
+        tasks = [ asyncio.ensure_future( number( chunk ) ) for chunk in grouper( max( 1, chunksize ), sequences ) ]
+        try:
+            return await asyncio.gather( *tasks )
+        except BaseException: # A chunk failed or the run was cancelled. Stop the other chunks (and their hmmscans).
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather( *tasks, return_exceptions=True )
+            raise
+
+    if timeout is None:
+        results = await number_all()
+    else:
+        results = await asyncio.wait_for( number_all(), timeout )
+
+    numbered, alignment_details, hit_tables = [], [], []
+    for chunk_numbered, chunk_details, chunk_hit_tables in results:
+        numbered.extend( chunk_numbered )
+        alignment_details.extend( chunk_details )
+        hit_tables.extend( chunk_hit_tables )
+    return sequences, numbered, alignment_details, hit_tables
+
@@ -45,19 +45,31 @@ Notes:
 
 import os
 import sys
+import json
 import tempfile
 import gzip
 import math
+import time
+import shutil
+import hashlib
 from functools import partial
 from textwrap import wrap
 from subprocess import Popen, PIPE
-from itertools import groupby, islice
+from itertools import groupby, islice, chain
+from collections import deque
 from multiprocessing import Pool
 
 from Bio.SearchIO.HmmerIO import Hmmer3TextParser as HMMERParser
 
 # Import from the schemes submodule
 from .schemes import *
+from .domains import NumberedDomain, DomainDetails, compact_numbered, expand_numbered, share_numbered, prepare_shared_memory
+from .prefilter import KmerClassifier, get_classifier
+from .fastpath import AnchorNumberer, get_numberer
+from .store import AlignmentStore, open_alignment_store
+from .planner import plan_run, fixed_plan, measure_stage_costs, get_stage_costs
+from .precomputed import get_bundle, state_integer, germline_identities
+from . import __version__
 from .germlines import all_germlines
     
 all_species = list(all_germlines['V']['H'].keys())
@@ -75,6 +87,8 @@ HMM_path =  os.path.join( anarci_path, "dat", "HMMs" )
 
 all_reference_states = list(range( 1, 129)) # These are the IMGT reference states (matches)
 
+hit_table_columns = ['id', 'description', 'evalue', 'bitscore', 'bias', 'query_start', 'query_end' ]
+
 class HMMscanError(Exception):
     def __init__(self, message):
         # Call the base class constructor with the parameters it needs
@@ -101,7 +115,14 @@ def fasta_iter(fasta_name):
     else:
         fh = open(fasta_name, 'r')
     
-    faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
+    for record in _parse_fasta( fh ):
+        yield record
+
+def _parse_fasta(lines):
+    """
+    Yield tuples of header, sequence from the lines of a fasta file.
+    """
+    faiter = (x[1] for x in groupby(lines, lambda line: line[0] == ">"))
     
     for header in faiter:
         try:
@@ -111,6 +132,65 @@ def fasta_iter(fasta_name):
         except StopIteration:
             break
 
+class UnreadableRecord(tuple):
+    """
+    A (name, "") record of the input that could not be read. Its error says why. With capture_errors it is reported as a
+    record that could not be numbered without failing the others of its chunk. Otherwise anarci raises its error.
+    """
+    def __new__(cls, name, error):
+        record = tuple.__new__( cls, ( name, "" ) )
+        record.error = error
+        return record
+
+    def __reduce__(self):
+        return UnreadableRecord, ( self[0], self.error )
+
+def read_records(handle, format=None):
+    """
+    Read (name, sequence) records from an open file (e.g. stdin) one at a time. Nothing is read ahead so inputs of any 
+    size can be streamed.
+
+    @param handle: An open text file of FASTA or NDJSON records. 
+    @param format: "fasta" or "ndjson". If None it is detected from the first character of the input (">" for FASTA). 
+                   Each NDJSON line must be an object with a "sequence" and optionally an "id" (or "name"). Records 
+                   without an id are named by their (zero based) index. A line that is not such an object does not stop
+                   the stream. It is yielded as an UnreadableRecord.
+    """
+    lines = iter( handle )
+    first = ""
+    for first in lines:
+        if first.strip():
+            break
+    if not first.strip():
+        return
+    if format is None:
+        format = "fasta" if first.lstrip().startswith(">") else "ndjson"
+    assert format in ("fasta", "ndjson"), "Unknown record format %s"%format
+
+    lines = chain( [ first ], lines )
+    if format == "fasta":
+        for record in _parse_fasta( lines ):
+            yield record
+    else:
+        n = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads( line )
+            except ValueError:
+                yield UnreadableRecord( str( n ), "Record %d is not valid JSON: %s"%( n, line.strip()[:80] ) )
+                n += 1
+                continue
+            if not isinstance( record, dict ):
+                yield UnreadableRecord( str( n ), "Record %d is not an object"%n )
+            elif not isinstance( record.get( "sequence" ), str ):
+                yield UnreadableRecord( str( record.get( "id", record.get( "name", n ) ) ), 
+                                        "Record %d does not have a sequence"%n )
+            else:
+                yield str( record.get( "id", record.get( "name", n ) ) ), record["sequence"]
+            n += 1
+
 def write_fasta(sequences, f):
     """
     Write a list of sequences to file. 
@@ -162,7 +242,41 @@ def grouper(n, iterable):
             yield list( islice(it,n) )
     return iter(take().__next__, [] )
 
-def anarci_output(numbered, sequences, alignment_details, outfile, sequence_id=None, domain_id=None):
+# Templates for the text output. The residue lines are "<chain class> <index left justified to 5> <insertion> <aa>"
+_residue_templates = dict( (c, "%s %%-5d %%s %%s\n"%chain_type_to_class[c]) for c in chain_type_to_class )
+_hit_template = "# Domain %d of %d\n# Most significant HMM hit\n#|species|chain_type|e-value|score|seqstart_index|seqend_index|\n#|%s|%s|%s|%s|%d|%d|\n"
+_germline_template = "# Most sequence-identical germlines\n#|species|v_gene|v_identity|j_gene|j_identity|\n#|%s|%s|%.2f|%s|%.2f|\n"
+
+def _format_domain(numbering, start, end, details, j, n):
+    """
+    Format a numbered domain in the anarci text format. Returns a list of strings.
+    """
+    bitscore = details["bitscore"]
+    if bitscore is not None: # Domains numbered by the fast path have no score.
+        bitscore = "%.1f"%bitscore
+    lines = [ _hit_template%( j+1, n, details["species"], details["chain_type"], details["evalue"], bitscore, start, end ) ]
+    if 'germlines' in details:
+        (species, vgene), vid = details['germlines'].get('v_gene', [['','unknown'],0])
+        if vgene is None:
+            vgene, vid = 'unknown', 0
+        (_,jgene), jid = details['germlines'].get('j_gene', [['','unknown'],0])
+        if jgene is None:
+            jgene, jid = 'unknown', 0
+        lines.append( _germline_template%(species, vgene, vid, jgene, jid) )
+    lines.append( "# Scheme = %s\n"%details["scheme"] )
+    template = _residue_templates[ details["chain_type"] ]
+    if isinstance( numbering, NumberedDomain ): # Format straight from the arrays.
+        if len( numbering.positions ) == 0:
+            lines.append( "# Warning: %s scheme could not be applied to this sequence.\n"%details["scheme"] )
+        lines.extend( template%(index, alphabet[insertion], chr(aa)) for index, insertion, aa in 
+                      zip( numbering.positions, numbering.insertions, numbering.residues ) )
+    else:
+        if len( numbering ) == 0:
+            lines.append( "# Warning: %s scheme could not be applied to this sequence.\n"%details["scheme"] )
+        lines.extend( template%(index, insertion, aa) for (index, insertion), aa in numbering )
+    return lines
+
+def anarci_output(numbered, sequences, alignment_details, outfile, sequence_id=None, domain_id=None, buffer_size=1<<20):
     """
     Outputs to open file
 
@@ -173,43 +287,102 @@ def anarci_output(numbered, sequences, alignment_details, outfile, sequence_id=N
     Otherwise all domains will be printed.
 
     If domain_id is specified then sequence_id must also be specified. 
+
+    Output is formatted into a buffer and written in blocks of roughly buffer_size characters. The alignment details
+    are not modified.
     """       
     assert (sequence_id is not None) or (sequence_id is None and domain_id is None), "If domain_id is specified, sequence_id must also be specified."
+    buffer, size = [], 0
     for i in range(len(numbered)):
+        block = []
         if sequence_id is None:
-            print("# %s"%sequences[i][0], file=outfile) # print the name
+            block.append( "# %s\n"%sequences[i][0] ) # print the name
         if numbered[i] is not None:
             if sequence_id is not None:
                 if i != sequence_id: continue
-            print("# ANARCI numbered", file=outfile)
+            block.append( "# ANARCI numbered\n" )
             for j in range( len(numbered[i])): # Iterate over domains
                 if domain_id is not None:
                     if j != domain_id: continue
-                print("# Domain %d of %d"%(j+1, len(numbered[i]) ), file=outfile)
-                print("# Most significant HMM hit", file=outfile)
-                print("#|species|chain_type|e-value|score|seqstart_index|seqend_index|", file=outfile)
-                alignment_details[i][j]["evalue"] = str( alignment_details[i][j]["evalue"] )
-                print("#|%s|%s|%s|%.1f|%d|%d|"%tuple( [alignment_details[i][j][field] for field in 
-                                                                     ["species","chain_type","evalue","bitscore"]] 
-                                                                   +[ numbered[i][j][1], numbered[i][j][2]] ), file=outfile)
-                
-                if 'germlines' in alignment_details[i][j]:
-                    print('# Most sequence-identical germlines', file=outfile)
-                    print('#|species|v_gene|v_identity|j_gene|j_identity|', file=outfile)
-                    (species, vgene), vid =alignment_details[i][j]['germlines'].get('v_gene', [['','unknown'],0])
-                    if vgene is None:
-                        vgene, vid = 'unknown', 0
-                    (_,jgene), jid =alignment_details[i][j]['germlines'].get('j_gene', [['','unknown'],0])
-                    if jgene is None:
-                        jgene, jid = 'unknown', 0
-                    print('#|%s|%s|%.2f|%s|%.2f|'%(species, vgene, vid, jgene, jid ), file=outfile)	
-                chain_type = chain_type_to_class[  alignment_details[i][j]["chain_type"] ]
-                print("# Scheme = %s"%alignment_details[i][j]["scheme"], file=outfile)
-                if len( numbered[i][j][0] ) == 0:
-                    print("# Warning: %s scheme could not be applied to this sequence."%alignment_details[i][j]["scheme"], file=outfile)            
-                for (index, insertion), aa in numbered[i][j][0]:
-                    print(chain_type, ("%d"%index).ljust(5), insertion, aa, file=outfile)
-        print("//", file=outfile)
+                domain = numbered[i][j]
+                if isinstance( domain, NumberedDomain ):
+                    block.extend( _format_domain( domain, domain.start, domain.end, alignment_details[i][j], j, len(numbered[i]) ) )
+                else:
+                    block.extend( _format_domain( domain[0], domain[1], domain[2], alignment_details[i][j], j, len(numbered[i]) ) )
+        block.append( "//\n" )
+        block = "".join( block )
+        buffer.append( block )
+        size += len( block )
+        if size >= buffer_size:
+            outfile.write( "".join( buffer ) )
+            buffer, size = [], 0
+    if buffer:
+        outfile.write( "".join( buffer ) )
+
+def stream_anarci_output(results, outfile, buffer_size=1<<20):
+    """
+    Write a stream of anarci results to an open file in the anarci text format.
+
+    @param results: An iterable of (sequences, numbered, alignment_details, ...) tuples. e.g. from iter_anarci.
+    @param outfile: An open file to write to.
+    @param buffer_size: The approximate number of characters written at a time.
+
+    @return: The number of sequences written.
+    """
+    n = 0
+    for chunk in results:
+        anarci_output( chunk[1], chunk[0], chunk[2], outfile, buffer_size=buffer_size )
+        n += len( chunk[0] )
+    return n
+
+def json_anarci_output(results, outfile, run_info=None):
+    """
+    Write a stream of anarci results to an open file as JSON lines. One line is written for each record and the file is
+    flushed after each chunk so that the results can be read as they are made (e.g. in a pipeline).
+
+    Each line is an object with the id and sequence of the record and its domains. Each domain has its chain_type, species,
+    evalue, bitscore, start and end (indices in the sequence), germlines (if assigned) and numbering as a list of 
+    [number, insertion, amino acid] triples. domains is empty if no domain was found. 
+
+    @param results: An iterable of (sequences, numbered, alignment_details, ...) tuples. e.g. from iter_anarci.
+    @param outfile: An open file to write to.
+    @param run_info: The run_info dictionary given to iter_anarci with capture_errors. Records that could not be numbered
+                     are given an error.
+
+    @return: The number of records written.
+    """
+    n, e = 0, 0
+    for chunk in results:
+        sequences, numbered, alignment_details = chunk[:3]
+        errors = {}
+        if run_info is not None: # The errors of this chunk were added before it was yielded.
+            failures = run_info.get( 'errors', [] )
+            while e < len( failures ):
+                errors[ failures[e]["index"] ] = failures[e]["error"]
+                e += 1
+        lines = []
+        for i in range( len(sequences) ):
+            record = { "id":sequences[i][0], "sequence":sequences[i][1], "domains":[] }
+            for j in range( len(numbered[i] or []) ):
+                domain, details = numbered[i][j], alignment_details[i][j]
+                if isinstance( domain, NumberedDomain ):
+                    numbering, start, end = domain, domain.start, domain.end
+                else:
+                    numbering, start, end = domain
+                entry = { "chain_type":details["chain_type"], "species":details.get("species"), 
+                          "evalue":details.get("evalue"), "bitscore":details.get("bitscore"), "start":start, "end":end,
+                          "numbering":[ [ position, insertion.strip(), aa ] for (position, insertion), aa in numbering ] }
+                if details.get("germlines") is not None:
+                    entry["germlines"] = details["germlines"]
+                record["domains"].append( entry )
+            if n+i in errors:
+                record["error"] = errors[n+i]
+            lines.append( json.dumps( record ) )
+        if lines:
+            outfile.write( "\n".join( lines ) + "\n" )
+            outfile.flush()
+        n += len( sequences )
+    return n
 
 def csv_output(sequences, numbered, details, outfileroot):
     '''
@@ -311,18 +484,18 @@ def _domains_are_same(dom1, dom2):
     return True
 
 
-def _parse_hmmer_query(query, bit_score_threshold=80, hmmer_species=None):
+def _parse_hmmer_query(query, bit_score_threshold=80, hmmer_species=None, lean=False):
     """
     
     @param query: hmmer query object from Biopython
     @param bit_score_threshold: the threshold for which to consider a hit a hit. 
+    @param lean: Do not collect the hit table. None is returned in its place.
     
     The function will identify multiple domains if they have been found and provide the details for the best alignment for each domain.
     This allows the ability to identify single chain fvs and engineered antibody sequences as well as the capability in the future for identifying constant domains. 
 
     """
-    hit_table = [ ['id', 'description', 'evalue', 'bitscore', 'bias', 
-                    'query_start', 'query_end' ] ]
+    hit_table = None if lean else [ list(hit_table_columns) ]
 
     # Find the best hit for each domain in the sequence.
 
@@ -355,10 +528,12 @@ def _parse_hmmer_query(query, bit_score_threshold=80, hmmer_species=None):
                     if _domains_are_same( domains[i], hsp ):
                         new = False
                         break      
-                hit_table.append( [ hsp.hit_id, hsp.hit_description, hsp.evalue, hsp.bitscore, hsp.bias, hsp.query_start, hsp.query_end] )
+                hit = [ hsp.hit_id, hsp.hit_description, hsp.evalue, hsp.bitscore, hsp.bias, hsp.query_start, hsp.query_end]
+                if not lean:
+                    hit_table.append( hit )
                 if new: # It is a new domain and this is the best hit. Add it for further processing.
                     domains.append( hsp )
-                    top_descriptions.append(  dict( list(zip(hit_table[0], hit_table[-1])) ) ) # Add the last added to the descriptions list. 
+                    top_descriptions.append(  dict( list(zip(hit_table_columns, hit)) ) ) # Add the last added to the descriptions list. 
 
         # Reorder the domains according to the order they appear in the sequence.         
         ordering = sorted( list(range(len(domains))), key=lambda x: domains[x].query_start)
@@ -460,11 +635,17 @@ def _hmm_alignment_to_states(hsp, n, seq_length):
     return state_vector
 
 
-def parse_hmmer_output(filedescriptor="", bit_score_threshold=80, hmmer_species=None):
+def parse_hmmer_output(filedescriptor="", bit_score_threshold=80, hmmer_species=None, lean=False):
     """
     Parse the output of HMMscan and return top alignment and the score table for each input sequence.
+
+    If lean is True the score table is not collected.
     """
     results  = []
+    if hasattr(filedescriptor, "read"): # An open file or stream (e.g. the output of hmmscan held in memory)
+        for query in HMMERParser( filedescriptor ):
+            results.append(_parse_hmmer_query(query,bit_score_threshold=bit_score_threshold,hmmer_species=hmmer_species, lean=lean ))
+        return results
     if type(filedescriptor) is str:
         openfile = open
     elif type(filedescriptor) is int:
@@ -473,12 +654,161 @@ def parse_hmmer_output(filedescriptor="", bit_score_threshold=80, hmmer_species=
     with openfile(filedescriptor) as inputfile:
         p = HMMERParser( inputfile )
         for query in p:
-            results.append(_parse_hmmer_query(query,bit_score_threshold=bit_score_threshold,hmmer_species=hmmer_species ))
+            results.append(_parse_hmmer_query(query,bit_score_threshold=bit_score_threshold,hmmer_species=hmmer_species, lean=lean ))
 
     return results
 
 
-def run_hmmer(sequence_list,hmm_database="ALL",hmmerpath="", ncpu=None, bit_score_threshold=80, hmmer_species=None):
+## HMM sub-databases ##
+# The profiles of each hmm database, by name (<species>_<chain_type>). Only read when a restricted database is asked for.
+_hmm_profiles = {}
+# The paths of the restricted databases that have been found or built by this process.
+_restricted_hmm_databases = {}
+
+def read_hmm_profiles(hmm_database="ALL"):
+    """
+    Read the profiles of an hmm database.
+
+    @param hmm_database: The hmm database to read.
+    @return: A dictionary of profile name to the text of the profile. In the order of the database.
+    """
+    if hmm_database not in _hmm_profiles:
+        profiles, lines, name = {}, [], None
+        with open( os.path.join( HMM_path, "%s.hmm"%hmm_database ) ) as infile:
+            for line in infile:
+                lines.append( line )
+                if line.startswith( "NAME " ):
+                    name = line.split()[1]
+                elif line.startswith( "//" ):
+                    profiles[name] = "".join( lines )
+                    lines, name = [], None
+        _hmm_profiles[hmm_database] = profiles
+    return _hmm_profiles[hmm_database]
+
+# The checksums of the hmm databases that have been asked for. By path and modification time.
+_database_checksums = {}
+
+def get_database_version(hmm_database="ALL", bit_score_threshold=80, hmmer_species=None, lean=False, restrict=None, 
+                         prefilter=False, fast_path=False):
+    """
+    Identify the alignments made by this version of ANARCI with an hmm database and the options that change them.
+    Used to key the alignments kept in an AlignmentStore.
+
+    @param hmm_database: The hmm database. Its version is the checksum of the hmm file.
+    @param bit_score_threshold: The bit score threshold of the search.
+    @param hmmer_species: The species the hits were limited to.
+    @param lean: The hit tables were not collected (see anarci).
+    @param restrict: The chain types the database was restricted to (see anarci restrict_database). None for all.
+    @param prefilter: The sequences were prefiltered by their k-mers.
+    @param fast_path: Canonical domains were numbered from their anchors without a search.
+    """
+    if hmm_database in ["ALL"]:
+        path = os.path.join( HMM_path, "%s.hmm"%hmm_database )
+    else:
+        path = hmm_database
+    key = ( path, os.path.getmtime( path ) )
+    if key not in _database_checksums:
+        checksum = hashlib.sha1()
+        with open( path, "rb" ) as infile:
+            for block in iter( lambda: infile.read( 1<<20 ), b"" ):
+                checksum.update( block )
+        _database_checksums[key] = checksum.hexdigest()
+    version = "anarci %s|%s %s|%s|%s"%( __version__, os.path.basename( path ), _database_checksums[key], bit_score_threshold,
+                                        ",".join( hmmer_species or [] ) )
+    options = [ option for option, used in [ ("lean", lean), ("prefilter", prefilter), ("fast_path", fast_path) ] if used ]
+    if restrict is not None:
+        options.append( "restrict=%s"%",".join( sorted( restrict ) ) )
+    if options: # Alignments made without options keep the version of earlier stores.
+        version += "|" + " ".join( options )
+    return version
+
+def get_hmm_cache_path():
+    """
+    Get the directory in which restricted hmm databases are kept. 
+    
+    This is $ANARCI_HMM_CACHE if it is set. Otherwise the restricted directory next to the hmms if that can be written to or 
+    ~/.cache/anarci/HMMs if it can not.
+    """
+    if os.environ.get( "ANARCI_HMM_CACHE" ):
+        return os.environ["ANARCI_HMM_CACHE"]
+    if os.access( HMM_path, os.W_OK ):
+        return os.path.join( HMM_path, "restricted" )
+    return os.path.join( os.path.expanduser("~"), ".cache", "anarci", "HMMs" )
+
+def restricted_hmm_database(allow=None, species=None, hmm_database="ALL", hmmerpath=""):
+    """
+    Get a pressed hmm database that only contains the profiles of the given chain types and species. 
+
+    The database is made from hmm_database and pressed with hmmpress the first time it is asked for. It is then kept in the 
+    hmm cache directory (see get_hmm_cache_path) and is remade if hmm_database changes. The databases of each species and 
+    of human and mouse are pressed when ANARCI is built (build_pipeline/build.py) and are used if they are current.
+
+    @param allow: The chain types to include. None for all chain types.
+    @param species: The species to include. None for all species.
+    @param hmm_database: The hmm database to take the profiles from.
+    @param hmmerpath: The path to hmmer binaries if not in the path
+
+    @return: The path to the database or hmm_database if the restriction includes every profile.
+    """
+    profiles = read_hmm_profiles( hmm_database )
+    names = [ name for name in profiles if (allow is None or name.split("_")[1] in allow) and 
+                                           (species is None or name.split("_")[0] in species) ]
+    assert names, "No HMMs found for chain types %s and species %s"%(",".join(sorted(allow or [])), ",".join(species or []))
+    if len( names ) == len( profiles ):
+        return hmm_database
+    
+    key = ( hmm_database, tuple(names) )
+    if key in _restricted_hmm_databases:
+        return _restricted_hmm_databases[key]
+
+    dbname = "%s_%s"%(hmm_database, "-".join( names ))
+    if len( dbname ) > 128: # Keep the file name to a sensible length
+        dbname = "%s_%s"%(hmm_database, hashlib.sha1( dbname.encode() ).hexdigest())
+    source_time = os.path.getmtime( os.path.join( HMM_path, "%s.hmm"%hmm_database ) )
+    prebuilt = os.path.join( HMM_path, "restricted", "%s.hmm"%dbname )
+    cache_path = get_hmm_cache_path()
+    path = os.path.join( cache_path, "%s.hmm"%dbname )
+    if os.path.exists( prebuilt ) and os.path.getmtime( prebuilt ) >= source_time:
+        path = prebuilt
+    elif not ( os.path.exists( path ) and os.path.getmtime( path ) >= source_time ):
+        if not os.path.isdir( cache_path ):
+            os.makedirs( cache_path, exist_ok=True )
+        # Build in a temporary directory and move into place. Other processes may be building the same database.
+        build_path = tempfile.mkdtemp( dir=cache_path )
+        try:
+            build_hmm = os.path.join( build_path, "%s.hmm"%dbname )
+            with open( build_hmm, "w" ) as outfile:
+                for name in names:
+                    outfile.write( profiles[name] )
+            hmmpress = os.path.join( hmmerpath, "hmmpress" ) if hmmerpath else "hmmpress"
+            process = Popen( [ hmmpress, "-f", build_hmm ], stdout=PIPE, stderr=PIPE )
+            _, pr_stderr = process.communicate()
+            if process.returncode:
+                raise HMMscanError(pr_stderr)
+            for extension in [ ".h3f", ".h3i", ".h3m", ".h3p", "" ]: # The hmm file last. It marks a complete database.
+                os.replace( build_hmm + extension, path + extension )
+        finally:
+            shutil.rmtree( build_path, ignore_errors=True )
+
+    _restricted_hmm_databases[key] = path
+    return path
+
+def _restricted_hmm_databases_for(database="ALL", allow=None, allowed_species=None, hmmerpath=""):
+    """
+    Get the restricted databases to use for a chain type and species restriction.
+
+    @return: The database restricted by chain type and species, the database restricted by chain type only and the number
+             of profiles in the full database.
+    """
+    chain_database = restricted_hmm_database( allow, None, database, hmmerpath )
+    species_database = chain_database
+    if allowed_species:
+        species_database = restricted_hmm_database( allow, allowed_species, database, hmmerpath )
+    return species_database, chain_database, len( read_hmm_profiles( database ) )
+
+
+def run_hmmer(sequence_list,hmm_database="ALL",hmmerpath="", ncpu=None, bit_score_threshold=80, hmmer_species=None, lean=False,
+              hmm_database_size=None):
     """
     Run the sequences in sequence list against a precompiled hmm_database.
 
@@ -489,14 +819,22 @@ def run_hmmer(sequence_list,hmm_database="ALL",hmmerpath="", ncpu=None, bit_scor
     @param sequence_list: a list of (name, sequence) tuples. Both are strings
     @param hmm_database: The hmm database to use. Currently, all hmms are in the ALL database.
                          The code to develop new models is in build_pipeline in the git repo.
+                         The path to a database made by restricted_hmm_database can also be given.
     @param hmmerpath: The path to hmmer binaries if not in the path
     @param ncpu: The number of cpu's to allow hmmer to use.
+    @param lean: Do not collect hit tables. hmmscan is also told not to report domains under the bit score threshold so that
+                 less output has to be written and parsed.
+    @param hmm_database_size: The number of profiles to calculate e-values for (hmmscan -Z). Give the size of the full 
+                 database when searching a restricted database so that e-values are the same as for the full database.
     """
 
     # Check that hmm_database is available
     
-    assert hmm_database in ["ALL"], "Unknown HMM database %s"%hmm_database    
-    HMM = os.path.join( HMM_path, "%s.hmm"%hmm_database )
+    if hmm_database in ["ALL"]:
+        HMM = os.path.join( HMM_path, "%s.hmm"%hmm_database )
+    else:
+        assert os.path.isfile( hmm_database ), "Unknown HMM database %s"%hmm_database    
+        HMM = hmm_database
 
 
     # Create a fasta file for all the sequences. Label them with their sequence index
@@ -513,10 +851,14 @@ def run_hmmer(sequence_list,hmm_database="ALL",hmmerpath="", ncpu=None, bit_scor
     else:
         hmmscan = "hmmscan"
     try:
-        if ncpu is None:
-            command = [ hmmscan, "-o", output_filename, HMM,  fasta_filename]
-        else:
-            command = [ hmmscan, "-o", output_filename, "--cpu", str(ncpu), HMM,  fasta_filename]
+        command = [ hmmscan, "-o", output_filename ]
+        if ncpu is not None:
+            command += [ "--cpu", str(ncpu) ]
+        if lean: # Domains under the threshold are never used. Do not report them.
+            command += [ "--domT", str(bit_score_threshold) ]
+        if hmm_database_size:
+            command += [ "-Z", str(hmm_database_size) ]
+        command += [ HMM,  fasta_filename ]
         process = Popen( command, stdout=PIPE, stderr=PIPE  )
         _, pr_stderr = process.communicate()
 
@@ -524,7 +866,7 @@ def run_hmmer(sequence_list,hmm_database="ALL",hmmerpath="", ncpu=None, bit_scor
             _f = os.fdopen(output_filehandle) # This is to remove the filedescriptor from the os. I have had problems with it before.
             _f.close()
             raise HMMscanError(pr_stderr)
-        results = parse_hmmer_output(output_filehandle, bit_score_threshold=bit_score_threshold, hmmer_species=hmmer_species)
+        results = parse_hmmer_output(output_filehandle, bit_score_threshold=bit_score_threshold, hmmer_species=hmmer_species, lean=lean)
         
     finally:
         # clear up
@@ -538,6 +880,10 @@ def get_hmm_length( species, ctype ):
     Get the length of an hmm given a species and chain type. 
     This tells us how many non-insertion positions there could possibly be in a domain (127 or 128 positions under imgt)
     '''
+    bundle = get_bundle( HMM_path )
+    if bundle is not None:
+        length = bundle.hmm_length( species, ctype )
+        return 128 if length is None else length
     try:
         return len(list(all_germlines['J'][ctype][species].values())[0].rstrip('-'))
     except KeyError:
@@ -592,9 +938,17 @@ def number_sequence_from_alignment(state_vector, sequence, scheme="imgt", chain_
         raise AssertionError("Unimplemented numbering scheme %s for chain %s"%( scheme, chain_type))
 
 def number_sequences_from_alignment(sequences, alignments, scheme="imgt", allow=set(["H","K","L","A","B","G","D"]), 
-                                    assign_germline=False, allowed_species=None):
+                                    assign_germline=False, allowed_species=None, compact=False, lean=False, errors=None):
     '''
     Given a list of sequences and a corresponding list of alignments from run_hmmer apply a numbering scheme.
+
+    If errors is a list (with an entry for each sequence) a sequence that cannot be numbered does not stop the others. Its
+    error is put in its entry and it is returned as if no domain was found.
+
+    If compact is True each numbered domain is returned as a NumberedDomain and its details as a DomainDetails.
+
+    If lean is True the numbering is not validated and each alignment is released from the alignments list once it has
+    been numbered.
     '''
 
     # Iteration over the sequence alignments performing the desired numbering 
@@ -605,9 +959,12 @@ def number_sequences_from_alignment(sequences, alignments, scheme="imgt", allow=
 
         # Unpack
         hit_table, state_vectors, detailss = alignments[i] # We may have multiple domains per sequence (e.g. single chain fvs). 
+        if lean:
+            alignments[i] = None
 
         # Iterate over all the domains in the sequence that have been recognised (typcially only 1 with the current hmms available)
         hit_numbered, hit_details = [], []
+        failed = False
         for di in range( len( state_vectors ) ):
             state_vector = state_vectors[di]
             details      = detailss[di]
@@ -618,21 +975,34 @@ def number_sequences_from_alignment(sequences, alignments, scheme="imgt", allow=
             if state_vector and details["chain_type"] in allow: 
                 try:
                     # Do the numbering and validate (for development purposes)
-                    hit_numbered.append( validate_numbering(number_sequence_from_alignment(state_vector, sequences[i][1], 
-                                                            scheme=scheme, chain_type=details["chain_type"]), sequences[i] ) )
+                    if lean:
+                        hit_numbered.append( number_sequence_from_alignment(state_vector, sequences[i][1], 
+                                                                            scheme=scheme, chain_type=details["chain_type"]) )
+                    else:
+                        hit_numbered.append( validate_numbering(number_sequence_from_alignment(state_vector, sequences[i][1], 
+                                                                scheme=scheme, chain_type=details["chain_type"]), sequences[i] ) )
                     if assign_germline:
                         details["germlines"] = run_germline_assignment( state_vector, sequences[i][1], 
                                                                         details["chain_type"], allowed_species=allowed_species)
+                    if compact: # Pack the numbering into arrays as soon as it is made.
+                        details = DomainDetails( details )
+                        hit_numbered[-1] = NumberedDomain.from_numbering( *hit_numbered[-1], details=details )
                     hit_details.append( details )
                 except AssertionError as e: # Handle errors. Those I have implemented should be assertion.
+                    if errors is not None: # Record the error against this sequence and carry on with the others.
+                        errors[i], failed = _describe_error( e ), True
+                        break
                     print(str(e), file=sys.stderr)
                     raise e # Validation went wrong. Error message will go to stderr. Want this to be fatal during development.
                 except Exception as e:
+                    if errors is not None:
+                        errors[i], failed = _describe_error( e ), True
+                        break
                     print("Error: Something really went wrong that has not been handled", file=sys.stderr)
                     print(str(e), file=sys.stderr)
                     raise e
                 
-        if hit_numbered: 
+        if hit_numbered and not failed: 
             numbered.append( hit_numbered )
             alignment_details.append( hit_details )
         else: 
@@ -642,6 +1012,12 @@ def number_sequences_from_alignment(sequences, alignments, scheme="imgt", allow=
 
     return numbered, alignment_details, hit_tables
 
+def _describe_error( e ):
+    '''
+    The description of an error kept for a sequence that could not be numbered.
+    '''
+    return "%s: %s"%( type(e).__name__, e )
+
 def get_identity( state_sequence, germline_sequence ):
     """
     Get the partially matched sequence identity between two aligned sequences. 
@@ -660,6 +1036,19 @@ def get_identity( state_sequence, germline_sequence ):
     return float(m)/n
     
 
+def _germline_identities(state_sequence, gene_type, chain_type, species):
+    """
+    The identity of a state sequence to each germline of a gene type, chain type and species. In the order of all_germlines.
+
+    The precomputed germline matrices (see precomputed.py) are used if they are available and have the same germlines.
+    """
+    germlines = all_germlines[gene_type][chain_type][species]
+    bundle = get_bundle( HMM_path )
+    matrix = bundle.germline_matrix( gene_type, chain_type, species ) if bundle is not None else None
+    if matrix is not None and len( matrix[0] ) == len( germlines ) and all( a == b for a, b in zip( matrix[0], germlines ) ):
+        return list( zip( matrix[0], germline_identities( state_integer( state_sequence ), matrix ) ) )
+    return [ ( gene, get_identity( state_sequence, germline_sequence ) ) for gene, germline_sequence in germlines.items() ]
+
 def run_germline_assignment(state_vector, sequence, chain_type, allowed_species=None ):
     """
     Find the closest sequence identity match.
@@ -685,8 +1074,8 @@ def run_germline_assignment(state_vector, sequence, chain_type, allowed_species=
         seq_ids = {}
         for species in allowed_species:
             if species not in all_germlines["V"][ chain_type ]: continue # Previously bug.
-            for gene, germline_sequence in all_germlines["V"][ chain_type ][ species ].items():
-                seq_ids[ (species, gene) ] = get_identity( state_sequence , germline_sequence )
+            for gene, identity in _germline_identities( state_sequence, "V", chain_type, species ):
+                seq_ids[ (species, gene) ] = identity
         genes['v_gene' ][0] = max( seq_ids, key=lambda x: seq_ids[x] )
         genes['v_gene' ][1] = seq_ids[ genes['v_gene' ][0] ]
         
@@ -696,14 +1085,14 @@ def run_germline_assignment(state_vector, sequence, chain_type, allowed_species=
         if chain_type in all_germlines["J"]:
             if species in all_germlines["J"][chain_type]:
                 seq_ids = {}
-                for gene, germline_sequence in all_germlines["J"][ chain_type ][ species ].items():
-                    seq_ids[ (species, gene) ] = get_identity( state_sequence , germline_sequence )
+                for gene, identity in _germline_identities( state_sequence, "J", chain_type, species ):
+                    seq_ids[ (species, gene) ] = identity
                 genes['j_gene' ][0] = max( seq_ids, key=lambda x: seq_ids[x] )
                 genes['j_gene' ][1] = seq_ids[ genes['j_gene' ][0] ]
      
     return genes
 
-def check_for_j( sequences, alignments, scheme ):
+def check_for_j( sequences, alignments, scheme, lean=False, hmm_database="ALL", hmmerpath="", hmm_database_size=None ):
     '''
     As the length of CDR3 gets long (over 30ish) an alignment that does not include the J region becomes more favourable.
     This leads to really long CDR3s not being numberable. 
@@ -732,7 +1121,8 @@ def check_for_j( sequences, alignments, scheme ):
                 
                         # Try to identify a J region in the remaining sequence after the 104. A low bit score threshold is used.
                         _, re_states, re_details  = run_hmmer( [(sequences[i][0], sequences[i][1][cys_si+1:])], 
-                                                               bit_score_threshold=10 )[0] 
+                                                               bit_score_threshold=10, lean=lean, hmm_database=hmm_database,
+                                                               hmmerpath=hmmerpath, hmm_database_size=hmm_database_size )[0] 
 
                         # Check if a J region was detected in the remaining sequence.
                         if re_states and re_states[0][-1][0][0] >= 126 and re_states[0][0][0][0] <= 117: 
@@ -757,6 +1147,94 @@ def check_for_j( sequences, alignments, scheme ):
 
 
 
+def _search_hmms(sequences, database="ALL", chains=None, species=None, hmmer_species=None, hmmerpath="", ncpu=None, 
+                 bit_score_threshold=80, lean=False):
+    '''
+    Align sequences to the hmms of the given chain types and species (all if None). Sequences without a hit to the species 
+    are searched again against all species of the chain types.
+
+    @return: The alignments, the database of the chain types and the number of hmms in the full database (None if the full
+             database is searched).
+    '''
+    if chains is None and species is None:
+        species_database, chain_database, database_size = database, database, None
+    else:
+        species_database, chain_database, database_size = _restricted_hmm_databases_for( database, chains, species, hmmerpath )
+    if not sequences:
+        return [], chain_database, database_size
+
+    alignments = run_hmmer(sequences,hmm_database=species_database,hmmerpath=hmmerpath,ncpu=ncpu,bit_score_threshold=bit_score_threshold,
+                           hmmer_species=hmmer_species, lean=lean, hmm_database_size=database_size )   
+
+    # Search again for those sequences that had no hit to the allowed species. As when the whole database is used.
+    if species_database != chain_database:
+        missed = [ i for i in range( len(sequences) ) if not alignments[i][1] ]
+        if missed:
+            realignments = run_hmmer([ sequences[i] for i in missed ],hmm_database=chain_database,hmmerpath=hmmerpath,ncpu=ncpu,
+                                     bit_score_threshold=bit_score_threshold,hmmer_species=hmmer_species, lean=lean, 
+                                     hmm_database_size=database_size )
+            for i, alignment in zip( missed, realignments ):
+                alignments[i] = alignment
+    return alignments, chain_database, database_size
+
+def _prefiltered_search(sequences, classifier, chains, search, lean=False):
+    '''
+    Search each sequence against the hmms of the chain types it is routed to by the classifier. Rejected sequences are not
+    searched. Routed sequences without a hit are searched again against the hmms of all the chain types.
+
+    @param classifier: A KmerClassifier
+    @param chains: The chain types that can be searched. None for all.
+    @param search: _search_hmms with the other search options set.
+    '''
+    routes = classifier.classify_sequences( sequences )
+    alignments = [ None ]*len( sequences )
+    groups = {}
+    for i, route in enumerate( routes ):
+        if route:
+            if chains is not None:
+                route = route & frozenset( chains )
+            groups.setdefault( route, [] ).append( i )
+        else: # Rejected. As if hmmscan found no hits.
+            alignments[i] = ( None if lean else [ list(hit_table_columns) ], [], [] )
+
+    for route, indices in groups.items():
+        routed, _, _ = search( [ sequences[i] for i in indices ], chains=route or chains )
+        for i, alignment in zip( indices, routed ):
+            alignments[i] = alignment
+
+    missed = [ i for i in range( len(sequences) ) if routes[i] and not alignments[i][1] ]
+    realignments, chain_database, database_size = search( [ sequences[i] for i in missed ], chains=chains )
+    for i, alignment in zip( missed, realignments ):
+        alignments[i] = alignment
+    return alignments, chain_database, database_size
+
+def _fast_path_search(sequences, numberer, search, allow=None, allowed_species=None, lean=False):
+    '''
+    Number the canonical domains of the sequences from their anchors (see the fastpath module). The other sequences are
+    searched with the hmms.
+
+    @param numberer: An AnchorNumberer
+    @param search: A function that aligns a list of sequences to the hmms (e.g. _search_hmms with the options set).
+    @param allow: The chain types that can be numbered.
+    @param allowed_species: The species that can be assigned.
+    '''
+    alignments = [ None ]*len( sequences )
+    searched = []
+    for i, (_, sequence) in enumerate( sequences ):
+        result = numberer.state_vector( sequence )
+        if result is not None:
+            state_vector, details = result
+            if ( allow is None or details["chain_type"] in allow ) and ( 
+                 allowed_species is None or details["species"] in allowed_species ):
+                alignments[i] = ( None if lean else [ list(hit_table_columns) ], [ state_vector ], [ details ] )
+                continue
+        searched.append( i )
+
+    realignments, chain_database, database_size = search( [ sequences[i] for i in searched ] )
+    for i, alignment in zip( searched, realignments ):
+        alignments[i] = alignment
+    return alignments, chain_database, database_size
+
 ##################################
 # High level numbering functions #
 ##################################
@@ -764,7 +1242,8 @@ def check_for_j( sequences, alignments, scheme ):
 # Main function for ANARCI 
 # Name conflict with function, module and package is kept for legacy unless issues are reported in future. 
 def anarci(sequences, scheme="imgt", database="ALL", output=False, outfile=None, csv=False, allow=set(["H","K","L","A","B","G","D"]), 
-           hmmerpath="", ncpu=None, assign_germline=False, allowed_species=['human','mouse'], bit_score_threshold=80):
+           hmmerpath="", ncpu=None, assign_germline=False, allowed_species=['human','mouse'], bit_score_threshold=80, compact=False,
+           lean=False, restrict_database=False, prefilter=False, fast_path=False, alignment_store=None, errors=None):
     """
     The main function for anarci. Identify antibody and TCR domains, number them and annotate their germline and species. 
 
@@ -799,6 +1278,30 @@ def anarci(sequences, scheme="imgt", database="ALL", output=False, outfile=None,
                       default is used. N.B. hmmscan must be compiled with multithreading enabled for this option to have effect. 
                       Please consider using the run_anarci function for native multiprocessing with anarci.
     @param database:  The HMMER database that should be used. Normally not changed unless a custom db is created.
+    @param compact:   Return each numbered domain as a NumberedDomain (numbering held in fixed width arrays) and its details
+                      as a DomainDetails record. These behave like the legacy tuples and dictionaries but use far less 
+                      memory for large jobs. See the domains module.
+    @param lean:      Production mode. Hit tables are not collected (None is returned for each sequence) and the numbering
+                      is not validated. Only the top hit of each domain is kept in its details. Reduces both CPU and memory
+                      for high volume runs.
+    @param restrict_database: Only search the hmms of the allowed chain types and species instead of the whole database.
+                      Restricted databases are made and cached the first time they are used (see restricted_hmm_database).
+                      Sequences without a hit for the allowed species are searched again against all species of the allowed
+                      chain types. E-values are calculated as for the whole database.
+    @param prefilter: Classify the sequences by their k-mers before searching (see the prefilter module). Sequences with 
+                      no plausible domain are not searched and the others are only searched against the hmms of their 
+                      likely chain types. Sequences that get no hit are searched again against all chain types. True to use
+                      the default classifier or a KmerClassifier.
+    @param fast_path: Number antibody domains with canonical frameworks from their conserved anchors without searching the
+                      hmms (see the fastpath module). Other sequences are searched as normal. These domains have no hit 
+                      table entries, e-value or score. True to use the default numberer or an AnchorNumberer.
+    @param alignment_store: An AlignmentStore or the path of one (see the store module). Sequences already aligned with 
+                      this version of ANARCI and database and the same search options are numbered from their stored 
+                      alignment. Other sequences are 
+                      aligned and their alignments stored so that they can be renumbered later without aligning them.
+    @param errors:    A list with an entry for each sequence. If given, a sequence that cannot be numbered is returned as
+                      if no domain was found and its error is put in its entry instead of being raised. Errors in the search
+                      itself are still raised.
 
 
     @return: Three lists. Numbered, Alignment_details and Hit_tables.
@@ -825,18 +1328,58 @@ def anarci(sequences, scheme="imgt", database="ALL", output=False, outfile=None,
         _path, _ = os.path.split(outfile)
         assert (not _path) or os.path.exists(_path), 'Output directory %s does not exist'%_path
 
+    for record in sequences:
+        if isinstance( record, UnreadableRecord ):
+            raise AssertionError( record.error )
 
-    # Perform the alignments of the sequences to the hmm database
-    alignments = run_hmmer(sequences,hmm_database=database,hmmerpath=hmmerpath,ncpu=ncpu,bit_score_threshold=bit_score_threshold,hmmer_species=allowed_species )   
-     
-    # Check the numbering for likely very long CDR3s that will have been missed by the first pass.
-    # Modify alignments in-place
-    check_for_j( sequences, alignments, scheme )
+    # Sequences that have been aligned before are read from the alignment store. Only the others are aligned.
+    # The alignments of a store opened here are added to it and it is closed again.
+    store = None if alignment_store is None else open_alignment_store( alignment_store )
+    try:
+        if store is not None:
+            version = get_database_version( database, bit_score_threshold, allowed_species, lean=lean, 
+                                            restrict=allow if restrict_database else None, prefilter=bool( prefilter ), 
+                                            fast_path=bool( fast_path ) )
+            stored = store.alignments( sequences, version )
+            to_align = [ i for i in range( len(sequences) ) if stored[i] is None ]
+            all_sequences, sequences = sequences, [ sequences[i] for i in to_align ]
+
+        # Perform the alignments of the sequences to the hmm database
+        search = partial( _search_hmms, database=database, species=allowed_species if restrict_database else None, 
+                          hmmer_species=allowed_species, hmmerpath=hmmerpath, ncpu=ncpu, 
+                          bit_score_threshold=bit_score_threshold, lean=lean )
+        chains = allow if restrict_database else None
+        if prefilter:
+            classifier = get_classifier() if prefilter is True else prefilter
+            search_sequences = partial( _prefiltered_search, classifier=classifier, chains=chains, search=search, lean=lean )
+        else:
+            search_sequences = partial( search, chains=chains )
+        if fast_path:
+            numberer = get_numberer() if fast_path is True else fast_path
+            alignments, chain_database, database_size = _fast_path_search( sequences, numberer, search_sequences, allow=allow,
+                                                                           allowed_species=allowed_species, lean=lean )
+        else:
+            alignments, chain_database, database_size = search_sequences( sequences )
+         
+        # Check the numbering for likely very long CDR3s that will have been missed by the first pass.
+        # Modify alignments in-place
+        check_for_j( sequences, alignments, scheme, lean=lean, hmm_database=chain_database, hmmerpath=hmmerpath, 
+                     hmm_database_size=database_size )
+
+        if store is not None:
+            store.add( sequences, alignments, version )
+            for i, alignment in zip( to_align, alignments ):
+                stored[i] = alignment
+            sequences, alignments = all_sequences, stored
+    finally:
+        if store is not None and store is not alignment_store:
+            store.close()
 
     # Apply the desired numbering scheme to all sequences
     numbered, alignment_details, hit_tables = number_sequences_from_alignment(sequences, alignments, scheme=scheme, allow=allow, 
                                                                               assign_germline=assign_germline, 
-                                                                              allowed_species=allowed_species)
+                                                                              allowed_species=allowed_species,
+                                                                              compact=compact, lean=lean, errors=errors)
 
     # Output if necessary
     if output: 
@@ -854,7 +1397,119 @@ def anarci(sequences, scheme="imgt", database="ALL", output=False, outfile=None,
     return numbered, alignment_details, hit_tables
 
 # Wrapper to run anarci using multiple processes and automate fasta file reading.
-def run_anarci( seq, ncpu=1, **kwargs):
+def _copy_results(numbered, details, name):
+    '''
+    Copy the numbering and details of a sequence for a duplicate of it with a different name.
+    The numbering lists and details are copied so that the results of each record can be changed independently. 
+    '''
+    if numbered is None:
+        return None, None
+    copied_numbered, copied_details = [], []
+    for domain, domain_details in zip( numbered, details ):
+        domain_details = domain_details.copy()
+        domain_details["query_name"] = name
+        if isinstance( domain, NumberedDomain ):
+            domain = NumberedDomain( domain.positions, domain.insertions, domain.residues, domain.start, domain.end, domain_details )
+        else:
+            domain = ( list(domain[0]), domain[1], domain[2] )
+        copied_numbered.append( domain )
+        copied_details.append( domain_details )
+    return copied_numbered, copied_details
+
+def _anarci_isolated( sequences, **kwargs ):
+    '''
+    Run anarci on a chunk so that one bad record cannot fail the others. A record that cannot be numbered is returned as if
+    no domain was found and its error is returned in a fourth list (None for the records that were numbered).
+
+    If the chunk fails as a whole (e.g. hmmscan fails on one of its sequences) it is bisected so that only the offending 
+    records fail (see _bisect_failed).
+    '''
+    sequences = list( sequences )
+    errors = [ None ]*len( sequences )
+    unreadable = [ i for i in range( len(sequences) ) if isinstance( sequences[i], UnreadableRecord ) ]
+    if unreadable: # Run the other records without them.
+        numbered, alignment_details, hit_tables = [ None ]*len( sequences ), [ None ]*len( sequences ), [ None ]*len( sequences )
+        readable = [ i for i in range( len(sequences) ) if not isinstance( sequences[i], UnreadableRecord ) ]
+        if readable:
+            results = _anarci_isolated( [ sequences[i] for i in readable ], **kwargs )
+            for j, i in enumerate( readable ):
+                numbered[i], alignment_details[i], hit_tables[i], errors[i] = [ r[j] for r in results ]
+        for i in unreadable:
+            errors[i] = "%s: %s"%( type( sequences[i] ).__name__, sequences[i].error )
+        return numbered, alignment_details, hit_tables, errors
+    try:
+        numbered, alignment_details, hit_tables = anarci( sequences, errors=errors, **kwargs )
+        return numbered, alignment_details, hit_tables, errors
+    except Exception as e:
+        return _bisect_failed( sequences, _describe_error( e ), **kwargs )
+
+# A failed chunk stops being bisected once this many of its records have failed on their own with the same error before any
+# has been numbered. See _bisect_failed.
+max_isolated_failures = 3
+
+def _bisect_failed( sequences, error, tally=None, **kwargs ):
+    '''
+    Find the records of a chunk that failed as a whole with error. Each half of the chunk is run again and a half that 
+    fails is bisected in turn, so a bad record costs about 2*log2(n) runs of anarci instead of n. 
+
+    If max_isolated_failures records fail on their own with the same error before any has been numbered, the failure is
+    probably not caused by the records (e.g. hmmscan cannot be run). The halves still to be run are then run once each but 
+    not bisected. The records of a half that fails are all given its error.
+    '''
+    if tally is None:
+        tally = { "numbered":False, "error":None, "repeats":0 }
+    if len( sequences ) == 1:
+        if error == tally["error"]:
+            tally["repeats"] += 1
+        else:
+            tally["error"], tally["repeats"] = error, 1
+        return [ None ], [ None ], [ None ], [ error ]
+
+    numbered, alignment_details, hit_tables, errors = [], [], [], []
+    for half in ( sequences[:len(sequences)//2], sequences[len(sequences)//2:] ):
+        half_errors = [ None ]*len( half )
+        try:
+            result = tuple( anarci( half, errors=half_errors, **kwargs ) ) + ( half_errors, )
+            tally["numbered"] = True
+        except Exception as e:
+            if tally["numbered"] or tally["repeats"] < max_isolated_failures:
+                result = _bisect_failed( half, _describe_error( e ), tally=tally, **kwargs )
+            else:
+                result = [ None ]*len( half ), [ None ]*len( half ), [ None ]*len( half ), [ _describe_error( e ) ]*len( half )
+        numbered.extend( result[0] )
+        alignment_details.extend( result[1] )
+        hit_tables.extend( result[2] )
+        errors.extend( result[3] )
+    return numbered, alignment_details, hit_tables, errors
+
+def _record_errors( run_info, sequences, errors, offset=0 ):
+    '''
+    Add the records that could not be numbered to run_info. See run_anarci.
+    '''
+    failures = run_info.setdefault( 'errors', [] )
+    summary = run_info.setdefault( 'error_summary', {} )
+    for i, error in enumerate( errors ):
+        if error is not None:
+            error_type = error.split( ":", 1 )[0]
+            failures.append( { "index":offset+i, "name":sequences[i][0], "type":error_type, "error":error } )
+            summary[ error_type ] = summary.get( error_type, 0 ) + 1
+    run_info['failed'] = len( failures )
+
+def _anarci_shared( sequences, capture_errors=False, **kwargs ):
+    '''
+    Run anarci in a worker process and put the numbering in shared memory. Only a small descriptor of it is pickled back to
+    the parent. See domains.share_numbered.
+    '''
+    results = ( _anarci_isolated if capture_errors else anarci )( sequences, **kwargs )
+    return ( share_numbered( results[0] ), ) + tuple( results[1:] )
+
+def _collect_shared( result ):
+    '''
+    Rebuild the results of _anarci_shared in the parent and release the shared memory.
+    '''
+    return ( result[0].collect( result[1] ), ) + tuple( result[1:] )
+
+def run_anarci( seq, ncpu=1, deduplicate=False, run_info=None, shared_memory=False, capture_errors=False, **kwargs):
     '''
     Run the anarci numbering protocol for single or multiple sequences.
     
@@ -877,10 +1532,34 @@ def run_anarci( seq, ncpu=1, **kwargs):
                       means domain recognition is more permissive and can be useful for numbering heavily engineered molecules. 
                       However, too low and false positive recognition of other ig-like molecules will occur.
     @param hmmerpath: The path to hmmscan. If left unspecified then the PATH will be searched. 
-    @param ncpu:      The number of cpu's that hmmer should be allowed to use. If not specified then the hmmscan 
-                      default is used. N.B. hmmscan must be compiled with multithreading enabled for this option to have effect. 
-                      Please consider using the run_anarci function for native multiprocessing with anarci.
+    @param ncpu:      The number of worker processes to use. Each runs hmmscan with a single thread on its own chunk of the
+                      sequences. "auto" to plan the number of processes, hmmscan threads and the chunk size from the 
+                      number of sequences, the available cpus and the cost of each stage (see the planner module). The
+                      costs are measured on a sample of the sequences first for large jobs.
     @param database:  The HMMER database that should be used. Normally not changed unless a custom db is created.
+    @param compact:   Return NumberedDomain and DomainDetails objects instead of the legacy tuples and dictionaries. 
+                      Recommended for large jobs. 
+    @param deduplicate: Only number each distinct sequence once. The results are copied to every record with that sequence
+                      (with its own query_name). Hit tables are shared between the copies. Recommended for redundant
+                      inputs such as NGS data.
+    @param run_info:  An optional dictionary that statistics of the run are added to. e.g. the number of sequences, the 
+                      number of unique sequences and the number of duplicates when deduplicate is True. plan describes the
+                      processes, hmmscan threads and chunk size used, the estimated and the elapsed time.
+    @param shared_memory: Worker processes pass the numbering back to the parent as packed arrays in shared memory instead
+                      of pickling it. The results are compact (as compact=True). Recommended for large jobs with ncpu > 1.
+    @param capture_errors: A record that cannot be numbered does not fail the run. It is returned as if no domain was 
+                      found and its error is added to run_info. If a whole chunk fails (e.g. hmmscan fails) its records are
+                      run again one at a time so that only the offending records fail. run_info gets:
+                        o errors: A list of {index, name, type, error} dictionaries. One for each failed record.
+                        o error_summary: The number of failed records of each error type.
+                        o failed: The number of failed records.
+                      A summary is printed to stderr if any records failed.
+    @param lean:      Do not collect hit tables or validate the numbering. Recommended for high volume runs.
+    @param restrict_database: Only search the hmms of the allowed chain types and species. 
+    @param prefilter: Reject sequences and route them to the hmms of their chain type with a k-mer classifier first.
+    @param fast_path: Number antibody domains with canonical frameworks from their anchor residues without the hmm search.
+    @param alignment_store: Keep the alignments in an AlignmentStore (or at its path) and reuse those already there. The 
+                      sequences can then be renumbered under other schemes with AlignmentStore.renumber.
 
     @return: Four lists. Sequences, Numbered, Alignment_details and Hit_tables.
              Each list is in the same order. 
@@ -901,10 +1580,12 @@ def run_anarci( seq, ncpu=1, **kwargs):
     elif os.path.isfile( seq ): # Fasta file.
         # Read the sequences. All are read into memory currently...
         sequences = read_fasta( seq ) 
-        ncpu = int(max(1, ncpu )) 
+        if ncpu != "auto":
+            ncpu = int(max(1, ncpu )) 
     elif isinstance(seq, str): # Single sequence
         validate_sequence( seq )
-        ncpu=1
+        if ncpu != "auto":
+            ncpu=1
         sequences = [ ["Input sequence", seq ]]
 
     # Handle the arguments to anarci.
@@ -918,22 +1599,89 @@ def run_anarci( seq, ncpu=1, **kwargs):
         
     kwargs['ncpu'] = 1 # Set hmmscan ncpu to 1. HMMER has to be compiled appropriately for this to have an effect. 
     kwargs['output'] = False # Overide and write the compiled results here. 
+    _prepare_restricted_databases( kwargs )
+
+    # Collapse identical sequences. Only the first record with each sequence is numbered.
+    to_number = sequences
+    if deduplicate:
+        unique, index = {}, []
+        for _, sequence in sequences:
+            index.append( unique.setdefault( sequence, len(unique) ) )
+        first = [ None ]*len( unique )
+        for i in range( len(sequences)-1, -1, -1 ):
+            first[ index[i] ] = i
+        to_number = [ sequences[i] for i in first ]
+
+    if run_info is not None:
+        run_info['sequences'] = len( sequences )
+        if deduplicate:
+            run_info['unique_sequences'] = len( to_number )
+            run_info['duplicates'] = len( sequences ) - len( to_number )
+            run_info['duplication_rate'] = float( run_info['duplicates'] )/len( sequences ) if sequences else 0.0
+
+    # Split the work between processes and hmmscan threads.
+    if ncpu == "auto":
+        if not get_stage_costs()[1] and len( to_number ) >= 1000: # Large enough to be worth measuring the costs first.
+            measure_stage_costs( to_number, database=kwargs.get( 'database', "ALL" ), hmmerpath=kwargs.get( 'hmmerpath', "" ),
+                                 scheme=scheme_short_to_long.get( kwargs.get( 'scheme', "imgt" ).lower(), "imgt" ) )
+        plan = plan_run( len( to_number ) )
+        ncpu, kwargs['ncpu'], chunksize = plan['processes'], plan['hmmscan_threads'], plan['chunksize']
+    else:
+        chunksize = int( max( 1, math.ceil( float( len(to_number) )/ncpu ) ) )
+        plan = fixed_plan( len( to_number ), ncpu, chunksize )
+    if run_info is not None:
+        run_info['plan'] = plan
+    started = time.time()
 
-    anarci_partial = partial( anarci, **kwargs )        
-    chunksize = math.ceil( float( len(sequences) )/ncpu )
+    if shared_memory:
+        kwargs['compact'] = True
+    anarci_partial = partial( _anarci_isolated if capture_errors else anarci, **kwargs )        
 
     # Run the anarci function using a pool of workers. Using the map_async to get over the KeyboardInterrupt bug in python2.7
-    if ncpu > 1:
+    if ncpu > 1 and shared_memory:
+        prepare_shared_memory()
+        pool = Pool( ncpu )
+        results = pool.map_async( partial( _anarci_shared, capture_errors=capture_errors, **kwargs ), 
+                                  grouper( chunksize, to_number ) ).get()
+        pool.close()
+        results = [ _collect_shared( result ) for result in results ]
+    elif ncpu > 1:
         pool = Pool( ncpu )
-        results = pool.map_async( anarci_partial, grouper( chunksize, sequences ) ).get()
+        results = pool.map_async( anarci_partial, grouper( chunksize, to_number ) ).get()
         pool.close()
     else:
-        results = list(map( anarci_partial, grouper( chunksize, sequences ) ))
+        results = list(map( anarci_partial, grouper( chunksize, to_number ) ))
 
     # Reformat the results to flat lists.
     numbered = sum( (_[0] for _ in results), [] )
     alignment_details = sum( (_[1] for _ in results ), [] )
     hit_tables = sum( (_[2] for _ in results), [] )
+    if capture_errors:
+        errors = sum( (_[3] for _ in results), [] )
+    plan['elapsed_seconds'] = time.time() - started
+
+    # Fan the results of the unique sequences back out to every record in input order.
+    if deduplicate:
+        unique_numbered, unique_details, unique_hit_tables = numbered, alignment_details, hit_tables
+        numbered, alignment_details, hit_tables = [], [], []
+        for i in range( len(sequences) ):
+            u = index[i]
+            if first[u] == i:
+                numbered.append( unique_numbered[u] )
+                alignment_details.append( unique_details[u] )
+            else:
+                n, d = _copy_results( unique_numbered[u], unique_details[u], sequences[i][0] )
+                numbered.append( n )
+                alignment_details.append( d )
+            hit_tables.append( unique_hit_tables[u] )
+        if capture_errors:
+            errors = [ errors[ index[i] ] for i in range( len(sequences) ) ]
+
+    if capture_errors:
+        if run_info is None:
+            run_info = {}
+        _record_errors( run_info, sequences, errors )
+        _report_errors( run_info, len( sequences ) )
 
     # Output if necessary
     if output: 
@@ -949,9 +1697,143 @@ def run_anarci( seq, ncpu=1, **kwargs):
 
     # Return the results
     return sequences, numbered, alignment_details, hit_tables
+
+def _report_errors( run_info, n ):
+    '''
+    Print a summary of the records that could not be numbered to stderr.
+    '''
+    if not run_info.get( 'failed' ):
+        return
+    print("Warning: %d of %d sequences could not be numbered (%s)"%( run_info['failed'], n, 
+          ", ".join( "%s: %d"%_ for _ in sorted( run_info['error_summary'].items() ) ) ), file=sys.stderr)
+    for failure in run_info['errors'][:10]:
+        print("    %s: %s"%( failure["name"], failure["error"] ), file=sys.stderr)
+    if run_info['failed'] > 10:
+        print("    ... and %d more"%( run_info['failed'] - 10 ), file=sys.stderr)
+
+# Generator to run anarci over an input of any size a chunk at a time.
+def _count_fasta_records( fasta_name ):
+    """
+    The number of records in a fasta file (without parsing their sequences).
+    """
+    opener = gzip.open if fasta_name.endswith('.gz') else open
+    with opener( fasta_name, 'rt' ) as fh:
+        return sum( 1 for line in fh if line.startswith( ">" ) )
+
+# The largest chunk iter_anarci gives a process by default.
+default_chunksize = 1000
+
+def iter_anarci( seq, ncpu=1, chunksize=None, shared_memory=False, capture_errors=False, run_info=None, **kwargs ):
+    '''
+    Run the anarci numbering protocol over the input chunk by chunk and yield the results of each chunk as it completes.
+
+    Unlike run_anarci, neither the input nor the results are held in memory all at once. Results are yielded in the 
+    order of the input. When multiple processes are used at most 2*ncpu chunks are in flight at any time.
+
+    @param seq:       A list or tuple of (Id, Sequence) pairs, a fasta file, a single sequence or any iterable of 
+                      (Id, Sequence) pairs (e.g. a generator reading from stdin).
+    @param ncpu:      The number of worker processes to use. "auto" to plan the number of processes and hmmscan threads 
+                      (see run_anarci). An input of unknown size is planned as a large job.
+    @param chunksize: The number of sequences given to anarci at once. By default the input is divided equally between 
+                      the processes (as run_anarci) in chunks of at most default_chunksize (1000) sequences. The records 
+                      of a fasta file are counted first to do this. An input of unknown size is given in chunks of 
+                      default_chunksize.
+    @param shared_memory: Worker processes pass the numbering back as packed arrays in shared memory. The results are 
+                      compact (as compact=True).
+    @param capture_errors: Records that cannot be numbered do not stop the run. They are yielded as if no domain was found.
+                      See run_anarci.
+    @param run_info:  An optional dictionary. The plan of the run is added to it and with capture_errors the failed 
+                      records are added to it (see run_anarci) as their chunks are yielded.
+    
+    Other keyword arguments are passed to anarci (see run_anarci). Output arguments are ignored.
+
+    @return: A generator of (sequences, numbered, alignment_details, hit_tables) tuples. One for each chunk.
+    '''
+    # Parse the input sequence, fasta file or iterable. Fasta files are read lazily.
+    if isinstance(seq, list) or isinstance(seq,tuple):
+        sequences = iter( seq )
+    elif isinstance(seq, str) and os.path.isfile( seq ):
+        sequences = fasta_iter( seq )
+    elif isinstance(seq, str):
+        validate_sequence( seq )
+        sequences = iter( [ ("Input sequence", seq ) ] )
+    else:
+        sequences = iter( seq )
+
+    kwargs['ncpu'] = 1 # Set hmmscan ncpu to 1. Parallelism is over chunks.
+    kwargs['output'] = False 
+    if isinstance(seq, list) or isinstance(seq,tuple):
+        n = len( seq )
+    elif isinstance(seq, str) and os.path.isfile( seq ):
+        n = _count_fasta_records( seq ) if chunksize is None else None
+    elif isinstance(seq, str):
+        n = 1
+    else:
+        n = None
+    if chunksize is None:
+        if n:
+            processes = plan_run( n )['processes'] if ncpu == "auto" else ncpu
+            chunksize = min( default_chunksize, int( math.ceil( float(n)/processes ) ) )
+        else:
+            chunksize = default_chunksize
+    chunksize = max( 1, int( chunksize ) )
+    if ncpu == "auto":
+        plan = plan_run( n, chunksize=chunksize )
+        ncpu, kwargs['ncpu'] = plan['processes'], plan['hmmscan_threads']
+    else:
+        plan = fixed_plan( n, ncpu, chunksize )
+    if run_info is not None:
+        run_info['plan'] = plan
+    if shared_memory:
+        kwargs['compact'] = True
+    _prepare_restricted_databases( kwargs )
+    anarci_partial = partial( _anarci_isolated if capture_errors else anarci, **kwargs )
+    chunks = grouper( chunksize, sequences )
+    if capture_errors and run_info is None:
+        run_info = {}
+    done = [ 0 ] # The number of records yielded.
+
+    def result( chunk, results ):
+        if capture_errors:
+            _record_errors( run_info, chunk, results[3], offset=done[0] )
+        done[0] += len( chunk )
+        return (chunk,) + tuple( results[:3] )
+
+    if ncpu > 1:
+        if shared_memory:
+            prepare_shared_memory()
+            worker, collect = partial( _anarci_shared, capture_errors=capture_errors, **kwargs ), _collect_shared
+        else:
+            worker, collect = anarci_partial, tuple
+        pool = Pool( ncpu )
+        try:
+            pending = deque()
+            for chunk in chunks:
+                pending.append( (chunk, pool.apply_async( worker, (chunk,) )) )
+                if len( pending ) >= 2*ncpu: # Bound the number of chunks in memory.
+                    chunk, results = pending.popleft()
+                    yield result( chunk, collect( results.get() ) )
+            while pending:
+                chunk, results = pending.popleft()
+                yield result( chunk, collect( results.get() ) )
+        finally:
+            pool.terminate()
+    else:
+        for chunk in chunks:
+            yield result( chunk, anarci_partial( chunk ) )
+    if capture_errors:
+        _report_errors( run_info, done[0] )
                 
 
 
+def _prepare_restricted_databases( kwargs ):
+    '''
+    Make the restricted hmm databases (if requested) before the work is divided so that worker processes do not all make them.
+    '''
+    if kwargs.get( 'restrict_database' ):
+        _restricted_hmm_databases_for( kwargs.get( 'database', "ALL" ), kwargs.get( 'allow', set(["H","K","L","A","B","G","D"]) ),
+                                       kwargs.get( 'allowed_species', ['human','mouse'] ), kwargs.get( 'hmmerpath', "" ) )
+
 # Wrapper function for simple sequence in numbering and chain type out behaviour. 
 def number(sequence, scheme="imgt", database="ALL", allow=set(["H","K","L","A","B","G","D"]), allowed_species=['human','mouse']):
     """
@@ -0,0 +1,232 @@
+#    ANARCI - Antibody Numbering and Antigen Receptor ClassIfication
+#    Copyright (C) 2016 Oxford Protein Informatics Group (OPIG)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the BSD 3-Clause License.
+#
+#    You should have received a copy of the BSD 3-Clause Licence
+#    along with this program.  If not, see <https://opensource.org/license/bsd-3-clause/>.
+
+'''
+Micro-batching of single sequence numbering requests.
+
+Every call to anarci pays a fixed cost to start hmmscan and load the hmms whether it numbers one sequence or a thousand.
+Interactive callers (e.g. the requests of a web service) number one or two sequences at a time so they pay that cost
+every time. AnarciBatcher collects the requests that arrive close together into one anarci call:
+
+    batcher = AnarciBatcher(max_batch_size=64, max_wait=0.01, scheme="kabat")
+    numbered, details, hit_table = batcher.number("EVQLQQSGAEVVRSG...")     # From any thread. Blocks for the result.
+    future = batcher.submit("EVQLQQSGAEVVRSG...")                            # A concurrent.futures.Future
+    result = await batcher.number_async("EVQLQQSGAEVVRSG...")                # From a coroutine
+
+A batch is sent when it is full or when its first request has waited max_wait seconds, so no request waits more than
+max_wait for others to arrive. Each caller gets the results (or error) of their own sequence. stats() reports the batch sizes and
+the time requests spend queued and being numbered.
+'''
+
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from .anarci import anarci, validate_sequence
+
+_stop = object()
+
+
+class AnarciBatcher(object):
+    """
+    Collect concurrent numbering requests into batches for anarci.
+    """
+
+    def __init__(self, max_batch_size=64, max_wait=0.01, workers=1, history=10000, **kwargs):
+        """
+        @param max_batch_size: The largest number of sequences sent to anarci at once.
+        @param max_wait: The longest time in seconds that the first request of a batch waits for others to join it.
+        @param workers: The number of batches that can be numbered at the same time (each in its own thread and hmmscan).
+        @param history: The number of recent requests and batches that stats() is calculated over.
+
+        Other keyword arguments are passed to anarci (e.g. scheme, allow, assign_germline). output is not allowed.
+        """
+        assert max_batch_size >= 1, "max_batch_size must be at least 1"
+        assert max_wait >= 0, "max_wait cannot be negative"
+        assert not kwargs.get( "output" ), "Output is not supported when batching"
+        self.max_batch_size = int( max_batch_size )
+        self.max_wait = max_wait
+        self.kwargs = kwargs
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._requests = 0
+        self._batches = 0
+        self._errors = 0
+        self._batch_sizes = deque( maxlen=history )
+        self._queue_delays = deque( maxlen=history )
+        self._latencies = deque( maxlen=history )
+        self._batch_times = deque( maxlen=history )
+
+        self._threads = [ threading.Thread( target=self._run, name="AnarciBatcher-%d"%i ) for i in range( max( 1, workers ) ) ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, sequence, name=None):
+        """
+        Queue a sequence to be numbered.
+
+        @param sequence: The amino acid sequence.
+        @param name: The name of the sequence (the query_name of its details). Defaults to "Input sequence".
+
+        @return: A concurrent.futures.Future that is resolved with the (numbered, alignment_details, hit_table) of the
+                 sequence. i.e. its entries of the lists returned by anarci. An invalid sequence fails its future 
+                 without joining a batch.
+        """
+        future = Future()
+        with self._lock:
+            assert not self._closed, "The batcher has been closed"
+            try:
+                validate_sequence( sequence )
+            except AssertionError as e:
+                self._errors += 1
+                future.set_exception( e )
+                return future
+            self._queue.put( ( name or "Input sequence", sequence, future, time.time() ) )
+        return future
+
+    def number(self, sequence, name=None, timeout=None):
+        """
+        Number a sequence. Blocks until the batch it joins has been numbered.
+
+        @param timeout: The longest time to wait in seconds. concurrent.futures.TimeoutError is raised after it.
+        @return: The (numbered, alignment_details, hit_table) of the sequence.
+        """
+        return self.submit( sequence, name ).result( timeout )
+
+    async def number_async(self, sequence, name=None):
+        """
+        Number a sequence from a coroutine without blocking the event loop.
+
+        @return: The (numbered, alignment_details, hit_table) of the sequence.
+        """
+        import asyncio
+        return await asyncio.wrap_future( self.submit( sequence, name ) )
+
+    def _next_batch(self):
+        """
+        Wait for a request then collect others until the batch is full or the first request has waited max_wait.
+        """
+        first = self._queue.get()
+        if first is _stop:
+            self._queue.put( _stop ) # The other workers stop too.
+            return None
+        batch = [ first ]
+        deadline = first[3] + self.max_wait
+        while len( batch ) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                request = self._queue.get( timeout=remaining ) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is _stop:
+                self._queue.put( _stop ) # Let this batch finish. The stop is seen on the next call.
+                break
+            batch.append( request )
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # Callers that have given up (cancelled their future) are not numbered.
+            batch = [ request for request in batch if request[2].set_running_or_notify_cancel() ]
+            if not batch:
+                continue
+            started = time.time()
+            results = self._number( batch )
+            finished = time.time()
+            failed = 0
+            for (_, _, future, _), result in zip( batch, results ):
+                if isinstance( result, Exception ):
+                    future.set_exception( result )
+                    failed += 1
+                else:
+                    future.set_result( result )
+
+            with self._lock:
+                self._batches += 1
+                self._requests += len( batch ) - failed
+                self._errors += failed
+                self._batch_sizes.append( len( batch ) )
+                self._batch_times.append( finished - started )
+                for (_, _, _, queued), result in zip( batch, results ):
+                    if not isinstance( result, Exception ):
+                        self._queue_delays.append( started - queued )
+                        self._latencies.append( finished - queued )
+
+    def _number(self, batch):
+        """
+        Number a batch. If it fails as a whole each request is numbered on its own so that only the requests that cause the
+        failure get the error.
+
+        @return: The (numbered, alignment_details, hit_table) or the exception of each request.
+        """
+        try:
+            numbered, alignment_details, hit_tables = anarci( [ (name, sequence) for name, sequence, _, _ in batch ],
+                                                              **self.kwargs )
+            return [ ( numbered[i], alignment_details[i], hit_tables[i] ) for i in range( len(batch) ) ]
+        except Exception as e:
+            if len( batch ) == 1:
+                return [ e ]
+        return [ self._number( [ request ] )[0] for request in batch ]
+
+    def stats(self):
+        """
+        @return: A dictionary of metrics.
+                   o requests: The number of requests numbered.
+                   o batches: The number of batches numbered.
+                   o errors: The number of requests that failed.
+                   o queued: The number of requests waiting.
+                   o batch_size: The mean, 50th and 99th percentile and largest of the recent batch sizes.
+                   o queue_delay: The mean, 50th and 99th percentile and longest time (seconds) recent requests waited
+                                  before their batch was started.
+                   o latency: As queue_delay for the time from a request being submitted to its result.
+                   o batch_time: As queue_delay for the time anarci took for each batch.
+        """
+        with self._lock:
+            return { "requests":self._requests, "batches":self._batches, "errors":self._errors,
+                     "queued":self._queue.qsize(),
+                     "batch_size":_summary( self._batch_sizes ), "queue_delay":_summary( self._queue_delays ),
+                     "latency":_summary( self._latencies ), "batch_time":_summary( self._batch_times ) }
+
+    def close(self, wait=True):
+        """
+        Stop accepting requests. Requests already queued are still numbered.
+
+        @param wait: Wait for the queued requests to be numbered.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put( _stop )
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+def _summary(values):
+    if not values:
+        return { "mean":None, "p50":None, "p99":None, "max":None }
+    ordered = sorted( values )
+    n = len( ordered )
+    return { "mean":float( sum( ordered ) )/n, "p50":ordered[ min( n-1, n//2 ) ], "p99":ordered[ min( n-1, int( n*0.99 ) ) ],
+             "max":ordered[-1] }
@@ -0,0 +1,425 @@
+#    ANARCI - Antibody Numbering and Antigen Receptor ClassIfication
+#    Copyright (C) 2016 Oxford Protein Informatics Group (OPIG)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the BSD 3-Clause License.
+#
+#    You should have received a copy of the BSD 3-Clause Licence
+#    along with this program.  If not, see <https://opensource.org/license/bsd-3-clause/>.
+
+'''
+Compact result types for ANARCI.
+
+By default anarci returns the numbering of each domain as a list of ((index, insertion), amino_acid) tuples and the details
+of each domain as a dictionary. For large jobs these small python objects dominate the memory footprint. When anarci is
+called with compact=True the numbering of each domain is instead held as three fixed width arrays:
+
+  - positions:  the numbering index of each residue (int16)
+  - insertions: the insertion code of each residue as an index into schemes.alphabet (uint8)
+  - residues:   the amino acid (or '-' for a gap) of each residue as ascii (uint8)
+
+and the details of each domain are held in a record with __slots__.
+
+Both types behave like the legacy structures. A NumberedDomain can be indexed and unpacked as the (numbering, start, end)
+tuple and a DomainDetails can be used as the details dictionary. The legacy numbering list is only built when it is
+asked for.
+
+The numbering of many domains can also be packed into a single buffer (pack_numbered) and passed between processes in
+shared memory (share_numbered) so that worker processes do not have to pickle it.
+'''
+
+from array import array
+
+try:
+    from multiprocessing import shared_memory
+except ImportError: # Python < 3.8. Packed numbering is sent with the results instead.
+    shared_memory = None
+
+from .schemes import alphabet
+
+# Insertion codes are stored as their index in the alphabet. The last entry is the blank space for no insertion.
+_insertion_to_code = dict( (a, i) for i, a in enumerate(alphabet) )
+
+
+class DomainDetails(object):
+    """
+    The alignment details of a numbered domain.
+
+    Behaves as the details dictionary returned by anarci. Fields that have not been set are missing from the mapping
+    (e.g. germlines is only present if germline assignment was requested). Unexpected fields are kept in a dictionary.
+    """
+    fields = ( "id", "description", "evalue", "bitscore", "bias", "query_start", "query_end",
+               "species", "chain_type", "scheme", "query_name", "germlines" )
+    __slots__ = fields + ( "_extra", )
+
+    def __init__(self, details=None, **kwargs):
+        self._extra = None
+        if details:
+            for key, value in details.items():
+                self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+    # Mapping interface so that existing code using the details dictionary keeps working.
+    def __getitem__(self, key):
+        if key in self.fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.fields:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (DomainDetails, dict)):
+            return self.as_dict() == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return "DomainDetails(%r)"%self.as_dict()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [ f for f in self.fields if hasattr(self, f) ]
+        if self._extra:
+            keys += list(self._extra.keys())
+        return keys
+
+    def values(self):
+        return [ self[k] for k in self.keys() ]
+
+    def items(self):
+        return [ (k, self[k]) for k in self.keys() ]
+
+    def copy(self):
+        return DomainDetails(self.as_dict())
+
+    def as_dict(self):
+        """
+        Convert back to the legacy details dictionary.
+        """
+        return dict( self.items() )
+
+    def __getstate__(self):
+        return self.as_dict()
+
+    def __setstate__(self, state):
+        self._extra = None
+        for key, value in state.items():
+            self[key] = value
+
+
+class NumberedDomain(object):
+    """
+    The numbering of a single domain held as fixed width arrays.
+
+    Indexing, unpacking and len() behave as the legacy (numbering, start, end) tuple, i.e.
+
+        numbering, start, end = domain
+
+    still works. The legacy numbering list is built each time the numbering attribute is accessed so callers that need
+    it repeatedly should keep a reference to it.
+    """
+    __slots__ = ( "positions", "insertions", "residues", "start", "end", "details" )
+
+    def __init__(self, positions, insertions, residues, start, end, details=None):
+        assert len(positions) == len(insertions) == len(residues), "Numbering arrays must be the same length"
+        self.positions  = positions
+        self.insertions = insertions
+        self.residues   = residues
+        self.start      = start
+        self.end        = end
+        self.details    = details
+
+    @classmethod
+    def from_numbering(cls, numbering, start, end, details=None):
+        """
+        Build a compact domain from a legacy numbering list.
+
+        @param numbering: A list of ((index, insertion), amino_acid) tuples as returned by the numbering schemes.
+        @param start: The index of the first numbered residue in the sequence.
+        @param end: The index of the last numbered residue in the sequence.
+        @param details: Optional details of the domain (a dictionary or a DomainDetails).
+        """
+        positions, insertions, residues = array('h'), array('B'), array('B')
+        for (index, insertion), aa in numbering:
+            positions.append( index )
+            try:
+                insertions.append( _insertion_to_code[insertion] )
+            except KeyError:
+                raise AssertionError("Unrecognised insertion code '%s' at position %d"%(insertion, index))
+            residues.append( ord(aa) )
+        if details is not None and not isinstance(details, DomainDetails):
+            details = DomainDetails(details)
+        return cls(positions, insertions, residues, start, end, details)
+
+    @property
+    def numbering(self):
+        """
+        The legacy list of ((index, insertion), amino_acid) tuples.
+        """
+        return [ ((p, alphabet[i]), chr(a)) for p, i, a in zip(self.positions, self.insertions, self.residues) ]
+
+    @property
+    def sequence(self):
+        """
+        The numbered residues as a string (gaps removed).
+        """
+        return bytes(self.residues).decode("ascii").replace("-", "")
+
+    def as_tuple(self):
+        """
+        Convert back to the legacy (numbering, start, end) tuple.
+        """
+        return self.numbering, self.start, self.end
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.as_tuple()[i]
+        i = range(3)[i] # Normalise negative indices. Raises IndexError as a tuple would.
+        if i == 0:
+            return self.numbering
+        return self.start if i == 1 else self.end
+
+    def __len__(self):
+        return 3
+
+    def __iter__(self):
+        return iter(self.as_tuple())
+
+    def __eq__(self, other):
+        if isinstance(other, NumberedDomain):
+            return (self.start, self.end) == (other.start, other.end) and self.positions == other.positions and \
+                   self.insertions == other.insertions and self.residues == other.residues
+        if isinstance(other, (tuple, list)):
+            return self.as_tuple() == tuple(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return "NumberedDomain(%d residues, start=%s, end=%s)"%(len(self.positions), self.start, self.end)
+
+    def __getstate__(self):
+        # Array buffers may be views on shared memory. Always pickle the raw bytes.
+        return ( bytes(self.positions), bytes(self.insertions), bytes(self.residues), self.start, self.end, self.details )
+
+    def __setstate__(self, state):
+        positions, insertions, residues, self.start, self.end, self.details = state
+        self.positions, self.insertions, self.residues = array('h'), array('B'), array('B')
+        self.positions.frombytes(positions)
+        self.insertions.frombytes(insertions)
+        self.residues.frombytes(residues)
+
+
+def compact_numbered(numbered, alignment_details):
+    """
+    Convert legacy anarci results into compact results.
+
+    @param numbered: The numbered list as returned by anarci.
+    @param alignment_details: The alignment details list as returned by anarci.
+
+    @return: The numbered and alignment_details lists holding NumberedDomain and DomainDetails objects.
+    """
+    compact, compact_details = [], []
+    for i in range(len(numbered)):
+        if numbered[i] is None:
+            compact.append( None )
+            compact_details.append( None )
+            continue
+        domains, details = [], []
+        for j in range(len(numbered[i])):
+            d = DomainDetails( alignment_details[i][j] )
+            domains.append( NumberedDomain.from_numbering( numbered[i][j][0], numbered[i][j][1], numbered[i][j][2], d ) )
+            details.append( d )
+        compact.append( domains )
+        compact_details.append( details )
+    return compact, compact_details
+
+
+def expand_numbered(numbered, alignment_details=None):
+    """
+    Convert compact anarci results back into the legacy nested lists and dictionaries.
+
+    @param numbered: The numbered list as returned by anarci with compact=True.
+    @param alignment_details: Optionally, the alignment details list as returned by anarci with compact=True.
+
+    @return: The legacy numbered list if only numbered is given. Otherwise the legacy numbered and alignment_details lists.
+    """
+    legacy = [ None if n is None else [ d.as_tuple() if isinstance(d, NumberedDomain) else d for d in n ] for n in numbered ]
+    if alignment_details is None:
+        return legacy
+    legacy_details = [ None if ds is None else [ d.as_dict() if isinstance(d, DomainDetails) else d for d in ds ]
+                       for ds in alignment_details ]
+    return legacy, legacy_details
+
+
+def pack_numbered(numbered):
+    """
+    Pack the numbering of a list of compact results into a single buffer.
+
+    The buffer holds the number of sequences, domains and residues, the number of domains of each sequence (-1 for None),
+    the length, start and end of each domain and then the positions, insertions and residues of all the domains.
+
+    @param numbered: The numbered list as returned by anarci with compact=True.
+    @return: The buffer as bytes.
+    """
+    counts, table = array('i'), array('i')
+    positions, insertions, residues = array('h'), array('B'), array('B')
+    for domains in numbered:
+        if domains is None:
+            counts.append( -1 )
+            continue
+        counts.append( len(domains) )
+        for domain in domains:
+            if not isinstance(domain, NumberedDomain):
+                domain = NumberedDomain.from_numbering( *domain )
+            table.extend( ( len(domain.positions), domain.start, domain.end ) )
+            positions.extend( domain.positions )
+            insertions.extend( domain.insertions )
+            residues.extend( domain.residues )
+    header = array('q', ( len(counts), len(table)//3, len(positions) ))
+    return b"".join( ( header.tobytes(), counts.tobytes(), table.tobytes(), positions.tobytes(), insertions.tobytes(),
+                       residues.tobytes() ) )
+
+
+def unpack_numbered(data, alignment_details=None):
+    """
+    Rebuild compact results from a buffer made by pack_numbered.
+
+    @param data: The buffer (bytes or a memoryview).
+    @param alignment_details: Optionally, the alignment details list of the results. Each domain is given its details.
+    @return: The numbered list holding NumberedDomain objects.
+    """
+    header = array('q')
+    header.frombytes( data[:header.itemsize*3] )
+    nsequences, ndomains, nresidues = header
+    offset = header.itemsize*3
+
+    def take(typecode, n):
+        values = array(typecode)
+        values.frombytes( data[offset:offset+values.itemsize*n] )
+        return values, offset+values.itemsize*n
+
+    counts, offset = take( 'i', nsequences )
+    table, offset = take( 'i', 3*ndomains )
+    positions, offset = take( 'h', nresidues )
+    insertions, offset = take( 'B', nresidues )
+    residues, offset = take( 'B', nresidues )
+
+    numbered, d, r = [], 0, 0
+    for i, count in enumerate( counts ):
+        if count < 0:
+            numbered.append( None )
+            continue
+        domains = []
+        for j in range( count ):
+            length, start, end = table[3*d:3*d+3]
+            details = alignment_details[i][j] if alignment_details is not None else None
+            domains.append( NumberedDomain( positions[r:r+length], insertions[r:r+length], residues[r:r+length], start, end,
+                                            details ) )
+            d += 1
+            r += length
+        numbered.append( domains )
+    return numbered
+
+
+class SharedNumbering(object):
+    """
+    A small descriptor of packed numbering in shared memory. It is what is pickled between processes instead of the
+    numbering itself. Where shared memory is not available the packed buffer is carried by the descriptor.
+    """
+    __slots__ = ( "name", "size", "data" )
+
+    def __init__(self, name=None, size=0, data=None):
+        self.name = name
+        self.size = size
+        self.data = data
+
+    def __getstate__(self):
+        return ( self.name, self.size, self.data )
+
+    def __setstate__(self, state):
+        self.name, self.size, self.data = state
+
+    def collect(self, alignment_details=None):
+        """
+        Rebuild the numbering and release the shared memory. Can only be called once.
+
+        @param alignment_details: Optionally, the alignment details list of the results. Each domain is given its details.
+        @return: The numbered list holding NumberedDomain objects.
+        """
+        if self.name is None:
+            return unpack_numbered( self.data, alignment_details )
+        segment = shared_memory.SharedMemory( name=self.name )
+        try:
+            data = bytes( segment.buf[:self.size] ) # One copy out of shared memory. The arrays are sliced from it.
+        finally:
+            segment.close()
+            segment.unlink()
+        return unpack_numbered( data, alignment_details )
+
+
+def prepare_shared_memory():
+    """
+    Start the shared memory resource tracker before worker processes are made so that the workers share it with the parent.
+    Segments made by a worker are then released when the parent collects them (or when the parent exits) rather than when
+    the worker exits.
+    """
+    if shared_memory is not None:
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+
+
+def share_numbered(numbered):
+    """
+    Pack the numbering of a list of compact results into shared memory.
+
+    @param numbered: The numbered list as returned by anarci with compact=True.
+    @return: A SharedNumbering. The process it is sent to must call collect to release the memory.
+    """
+    data = pack_numbered( numbered )
+    if shared_memory is None:
+        return SharedNumbering( data=data )
+    segment = shared_memory.SharedMemory( create=True, size=max( 1, len(data) ) )
+    try:
+        segment.buf[:len(data)] = data
+    finally:
+        segment.close()
+    return SharedNumbering( segment.name, len(data) )
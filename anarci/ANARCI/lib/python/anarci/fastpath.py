@@ -0,0 +1,406 @@
+#    ANARCI - Antibody Numbering and Antigen Receptor ClassIfication
+#    Copyright (C) 2016 Oxford Protein Informatics Group (OPIG)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the BSD 3-Clause License.
+#
+#    You should have received a copy of the BSD 3-Clause Licence
+#    along with this program.  If not, see <https://opensource.org/license/bsd-3-clause/>.
+
+'''
+Anchor based fast path numbering for canonical antibody variable domains.
+
+Most antibody domains have intact frameworks with the conserved anchor residues
+
+  - Cys 23 (end of FR1)
+  - Trp 41 (FR2)
+  - Cys 104 (end of FR3)
+  - the [WF]G.G motif at 118-121 (start of FR4, from the J gene)
+
+For these the hmm alignment is the germline framework alignment: the framework residues match the IMGT states without
+insertions or deletions other than those of the germline. The fast path finds the anchors, places each framework against
+the framework profiles of the germlines (the residues seen at each IMGT position) and builds the IMGT state vector
+directly. The CDRs are placed between the frameworks. The numbering schemes renumber the CDRs by their length.
+
+The species is the one whose hmm gives the best score to the alignment.
+
+A sequence is only accepted if every framework is found once with high identity to the germline profiles, the CDRs are of
+typical length, there is no sign of a second domain and the species is clear. Otherwise None is returned and the sequence
+should be numbered with the hmm search (see anarci). compare_fast_path is a differential test of the fast path against the
+hmm search.
+'''
+
+import re
+
+from .germlines import all_germlines
+
+# IMGT regions. The states of each framework and the CDRs between them.
+framework_regions = [ ( "FR1", 1, 26, 23, "C" ), ( "FR2", 39, 55, 41, "W" ), ( "FR3", 66, 104, 104, "C" ) ]
+cdr_regions = [ ( "CDR1", 27, 38 ), ( "CDR2", 56, 65 ), ( "CDR3", 105, 117 ) ]
+_j_motif = re.compile( "(?=[WF]G.G)" )
+_transitions = { ('m','m'):0, ('m','i'):1, ('m','d'):2, ('i','m'):3, ('i','i'):4, ('d','m'):5, ('d','d'):6 }
+
+
+class _Framework(object):
+    """
+    The residues seen at each IMGT state of a framework for one germline gap pattern.
+    """
+    __slots__ = ( "states", "profile", "anchor" )
+
+    def __init__(self, states, profile, anchor):
+        self.states = states    # The IMGT state of each residue (states deleted in the germlines are missing)
+        self.profile = profile  # The set of residues seen at each of those states
+        self.anchor = anchor    # The index of the anchor residue in states
+
+    def identity(self, sequence, start):
+        """
+        The fraction of residues from start that are seen in the germlines at their state. The lower of the two halves of 
+        the framework is used so that an insertion or deletion near either end is not hidden by the rest.
+        """
+        matches = [ 1 if aa in residues else 0 for residues, aa in zip( self.profile, sequence[start:start+len(self.states)] ) ]
+        half = len( self.states )//2
+        return min( float( sum( matches[:half] ) )/half, float( sum( matches[half:] ) )/( len( self.states ) - half ) )
+
+
+def _frameworks(aligned_germlines, first, last, anchor=None, min_germlines=5):
+    """
+    Build the framework profiles of the gap patterns of a region shared by at least min_germlines germlines.
+    """
+    patterns = {}
+    for aligned in aligned_germlines:
+        segment = aligned[first-1:last]
+        states = tuple( first+i for i, aa in enumerate( segment ) if aa != "-" )
+        if states:
+            patterns.setdefault( states, [] ).append( [ aa for aa in segment if aa != "-" ] )
+    frameworks = []
+    for states, segments in patterns.items():
+        if len( segments ) < min_germlines or (anchor is not None and anchor not in states):
+            continue
+        profile = [ set( residues ) for residues in zip( *segments ) ]
+        frameworks.append( _Framework( states, profile, states.index( anchor ) if anchor is not None else 0 ) )
+    return frameworks
+
+
+class AnchorNumberer(object):
+    """
+    Build IMGT state vectors for canonical antibody domains from their conserved anchors.
+    """
+
+    def __init__(self, chain_types=("H","K","L"), species=("human","mouse"), min_identity=0.8, min_margin=0.1,
+                 max_cdr3_length=18, min_species_margin=1.5, k=5, max_trailing_kmers=10, germlines=None, hmm_profiles=None):
+        """
+        @param chain_types: The chain types that can be numbered by the fast path.
+        @param species: The species whose germlines make the framework profiles. None for all species.
+        @param min_identity: The minimum identity of each framework to the germline profiles.
+        @param min_margin: The minimum identity margin of the best placement of each framework over any other placement.
+        @param max_cdr3_length: The longest CDR3 (IMGT 105-117) numbered by the fast path. The hmm alignment of long CDR3s
+                          is less predictable.
+        @param min_species_margin: The minimum margin (in nats) of the hmm path score of the best species over the next. 
+                          Closer calls use the hmm search.
+        @param k: The k-mer length used to choose the chain type and species.
+        @param max_trailing_kmers: Sequences that share this many germline k-mers after the domain may have another domain
+                          and use the hmm search.
+        @param germlines: The germline alignments to use. Defaults to the germlines ANARCI was built with.
+        @param hmm_profiles: The hmm profiles used to choose the species. Defaults to the profiles of the ALL database.
+        """
+        if germlines is None:
+            germlines = all_germlines
+        if hmm_profiles is None:
+            from .anarci import read_hmm_profiles
+            hmm_profiles = read_hmm_profiles()
+        self.min_identity = min_identity
+        self.min_margin = min_margin
+        self.max_cdr3_length = max_cdr3_length
+        self.min_species_margin = min_species_margin
+        self.k = k
+        self.max_trailing_kmers = max_trailing_kmers
+
+        self.frameworks = {}
+        self.min_cdr_lengths = {}
+        self.j_profiles = {}
+        self.j_lengths = {}
+        self.groups = []
+        self.species_models = []
+        index = {}
+        for chain_type in chain_types:
+            if chain_type not in germlines['V'] or chain_type not in germlines['J']:
+                continue
+            v_genes, j_genes = [], []
+            for s in germlines['V'][chain_type]:
+                if species is not None and s not in species:
+                    continue
+                if s not in germlines['J'][chain_type] or "%s_%s"%(s, chain_type) not in hmm_profiles:
+                    continue
+                group = len( self.groups )
+                self.groups.append( ( chain_type, s ) )
+                v_genes += list( germlines['V'][chain_type][s].values() )
+                j = list( germlines['J'][chain_type][s].values() )
+                j_genes += j
+                # 128 is only aligned by the hmms of species with J genes that reach it.
+                self.j_lengths[ group ] = 11 if any( len( aligned.rstrip("-") ) >= 128 for aligned in j ) else 10
+                self.species_models.append( _read_hmm_model( hmm_profiles[ "%s_%s"%(s, chain_type) ] ) )
+                for aligned in germlines['V'][chain_type][s].values():
+                    sequence = aligned.replace( "-", "" )
+                    for i in range( len(sequence) - k + 1 ):
+                        index.setdefault( sequence[i:i+k], set() ).add( group )
+            if not v_genes:
+                continue
+            self.frameworks[chain_type] = [ _frameworks( v_genes, first, last, anchor )
+                                            for _, first, last, anchor, _ in framework_regions ]
+            # The shortest germline CDR1 and CDR2. The frameworks either side of shorter CDRs are not well defined.
+            self.min_cdr_lengths[chain_type] = [ min( len( aligned[first-1:last].replace( "-", "" ) ) for aligned in v_genes )
+                                                 for _, first, last in cdr_regions[:2] ]
+            # The residues seen at each state of FR4 (118-128)
+            self.j_profiles[chain_type] = [ set( residues ) - set( "-" ) for residues in zip( *[ j[117:128] for j in j_genes ] ) ]
+        # k-mer -> the indices of the (chain type, species) groups with a germline containing it
+        self.index = dict( (kmer, tuple(groups)) for kmer, groups in index.items() )
+
+    def _votes(self, sequence):
+        k = self.k
+        votes = [ 0 ]*len( self.groups )
+        for kmer in set( sequence[i:i+k] for i in range( len(sequence) - k + 1 ) ):
+            for g in self.index.get( kmer, () ):
+                votes[g] += 1
+        return votes
+
+    def _place(self, frameworks, sequence, anchor_residue, start, end):
+        """
+        Place a framework in sequence[start:end] on an anchor residue.
+
+        @return: The best framework and the index of its first residue. None if it is not found or is ambiguous.
+        """
+        placements = []
+        for framework in frameworks:
+            for i in range( start, end ):
+                if sequence[i] != anchor_residue:
+                    continue
+                first = i - framework.anchor
+                if first < start or first + len( framework.states ) > end:
+                    continue
+                placements.append( ( framework.identity( sequence, first ), first, framework ) )
+        if not placements:
+            return None
+        placements.sort( key=lambda p: p[0], reverse=True )
+        best = placements[0]
+        if best[0] < self.min_identity:
+            return None
+        for other in placements[1:]: # Any other placement that changes the numbering must be clearly worse.
+            if ( other[1] != best[1] or other[2].states != best[2].states ) and best[0] - other[0] < self.min_margin:
+                return None
+        return best
+
+    def state_vector(self, sequence):
+        """
+        Build the IMGT state vector of a sequence.
+
+        @return: The state vector and the details of the domain or None if the sequence should use the hmm search.
+        """
+        votes = self._votes( sequence )
+        if not votes or max( votes ) == 0:
+            return None
+        chain_type = self.groups[ max( range( len(votes) ), key=lambda g: votes[g] ) ][0]
+
+        # Place the frameworks in order. Each must follow the previous and leave room for the CDR between them.
+        placed, start = [], 0
+        for (name, first_state, last_state, anchor, residue), frameworks in zip( framework_regions, self.frameworks[chain_type] ):
+            if name == "FR1":
+                search_end = min( len(sequence), 60 ) # Longer n-terminal extensions (e.g. a domain before) use the hmm search.
+            else:
+                search_end = len( sequence )
+            placement = self._place( frameworks, sequence, residue, start, search_end )
+            if placement is None:
+                return None
+            identity, first, framework = placement
+            if placed: # The CDR between this and the previous framework must be at least as long as in the germlines and fit
+                       # the IMGT CDR without insertions.
+                cdr_length = first - start
+                _, cdr_first, cdr_last = cdr_regions[ len(placed)-1 ]
+                if cdr_length < self.min_cdr_lengths[chain_type][ len(placed)-1 ] or cdr_length > cdr_last - cdr_first + 1:
+                    return None
+            placed.append( ( first, framework, identity ) )
+            start = first + len( framework.states )
+
+        # Find the J motif after the Cys 104.
+        cdr3_start = start
+        motifs = [ m.start() for m in _j_motif.finditer( sequence, cdr3_start ) if m.start() - cdr3_start <= self.max_cdr3_length ]
+        if len( motifs ) != 1:
+            return None
+        j_first = motifs[0]
+        # The J gene to 127 must be complete. 128 is numbered if there is a residue and the J genes of the species reach it.
+        j_profile = self.j_profiles[chain_type]
+        if len( sequence ) - j_first < 10:
+            return None
+        j_identity = sum( 1 for residues, aa in zip( j_profile[:10], sequence[j_first:] ) if aa in residues )/10.0
+        if j_identity < self.min_identity:
+            return None
+        end = j_first + 10
+        if max( self._votes( sequence[end:] ) or [0] ) >= self.max_trailing_kmers: # Another domain after (e.g. a scFv).
+            return None
+
+        # Build the state vector.
+        state_vector = []
+        for r, ( first, framework, _ ) in enumerate( placed ):
+            _, region_first, region_last, _, _ = framework_regions[r]
+            _add_framework( state_vector, framework.states, region_first, region_last, first )
+            cdr_end = placed[r+1][0] if r+1 < len(placed) else j_first
+            _, cdr_first, cdr_last = cdr_regions[r]
+            _add_cdr( state_vector, cdr_first, cdr_last, list( range( first + len(framework.states), cdr_end ) ) )
+        for i in range( 10 ):
+            state_vector.append( ( (118 + i, 'm'), j_first + i ) )
+
+        # Choose the species whose hmm scores the alignment best. Then number 128 if its J genes reach it.
+        scores = sorted( ( _path_score( self.species_models[g], state_vector, sequence ), g ) 
+                         for g in range( len(self.groups) ) if self.groups[g][0] == chain_type )
+        if len( scores ) > 1 and scores[-1][0] - scores[-2][0] < self.min_species_margin:
+            return None
+        best_group = scores[-1][1]
+        species = self.groups[ best_group ][1]
+        if self.j_lengths[ best_group ] == 11 and end < len( sequence ):
+            state_vector.append( ( (128, 'm'), end ) )
+            end += 1
+
+        details = { "id":"%s_%s"%(species, chain_type), "description":"anchor fast path", "evalue":None, "bitscore":None,
+                    "bias":None, "query_start":placed[0][0], "query_end":end, "species":species,
+                    "chain_type":chain_type,
+                    "anchor_identity":min( [ p[2] for p in placed ] + [ j_identity ] ) }
+        return state_vector, details
+
+
+def _read_hmm_model(profile):
+    """
+    Read the match emission and transition scores of each state of an hmm profile (as natural log probabilities).
+    """
+    lines = profile.splitlines()
+    i = [ n for n, line in enumerate( lines ) if line.startswith( "HMM " ) ][0]
+    alphabet = lines[i].split()[1:]
+    emissions, transitions = {}, {}
+    i += 2
+    while not lines[i].split()[0].isdigit(): # The begin state transitions are the last line before state 1
+        i += 1
+    transitions[0] = [ -float( x ) if x != "*" else float( "-inf" ) for x in lines[i-1].split() ]
+    while i < len( lines ) and lines[i].split()[0].isdigit():
+        fields = lines[i].split()
+        state = int( fields[0] )
+        emissions[state] = dict( zip( alphabet, [ -float( x ) for x in fields[1:len(alphabet)+1] ] ) )
+        emissions[state][None] = sum( emissions[state].values() )/len( alphabet ) # For non-standard residues (e.g. X)
+        transitions[state] = [ -float( x ) if x != "*" else float( "-inf" ) for x in lines[i+2].split() ]
+        i += 3
+    return emissions, transitions
+
+
+def _path_score(model, state_vector, sequence):
+    """
+    Score the path of a state vector through an hmm. Insert emissions are left out as they are close to the background.
+    """
+    emissions, transitions = model
+    score = 0.0
+    previous_state, previous_type = 0, 'm'
+    for (state, state_type), si in state_vector:
+        if state_type == 'm':
+            score += emissions[state].get( sequence[si], emissions[state][None] )
+        score += transitions[previous_state][ _transitions[ (previous_type, state_type) ] ]
+        previous_state, previous_type = state, state_type
+    return score
+
+
+def _add_framework(state_vector, states, region_first, region_last, first):
+    """
+    Add the states of a framework. States deleted in the germline are delete states.
+    """
+    si = first
+    present = set( states )
+    for state in range( region_first, region_last+1 ):
+        if state in present:
+            state_vector.append( ( (state, 'm'), si ) )
+            si += 1
+        else:
+            state_vector.append( ( (state, 'd'), None ) )
+
+
+def _add_cdr(state_vector, cdr_first, cdr_last, indices):
+    """
+    Add the states of a CDR. Residues fill the CDR from both ends with the gaps in the middle. Residues beyond the length of
+    the CDR are insertions in the middle.
+    """
+    n_states = cdr_last - cdr_first + 1
+    n = len( indices )
+    left = ( min( n, n_states ) + 1 )//2
+    right = min( n, n_states ) - left
+    states = []
+    for i in range( left ):
+        states.append( ( (cdr_first + i, 'm'), indices[i] ) )
+    for i in range( left, n - right ): # Insertions after the last left state
+        states.append( ( (cdr_first + left - 1, 'i'), indices[i] ) )
+    for state in range( cdr_first + left, cdr_last - right + 1 ):
+        states.append( ( (state, 'd'), None ) )
+    for i in range( right ):
+        states.append( ( (cdr_last - right + 1 + i, 'm'), indices[n - right + i] ) )
+    state_vector.extend( states )
+
+
+_default_numberer = None
+
+def get_numberer():
+    """
+    Get the fast path numberer built from the germlines ANARCI was built with. It is built the first time it is asked for.
+    """
+    global _default_numberer
+    if _default_numberer is None:
+        _default_numberer = AnchorNumberer()
+    return _default_numberer
+
+
+def compare_fast_path(sequences, scheme="imgt", numberer=None, **kwargs):
+    """
+    Differential test of the fast path against the hmm search.
+
+    Every sequence is numbered with the hmm search and the sequences accepted by the fast path are numbered with it too.
+
+    @param sequences: A list of (name, sequence) tuples.
+    @param scheme: The numbering scheme to compare.
+    @param numberer: The AnchorNumberer to test. Defaults to get_numberer()
+
+    Other keyword arguments are passed to run_anarci for the hmm search (e.g. ncpu).
+
+    @return: A dictionary of statistics.
+               o sequences: The number of sequences.
+               o accepted: The number of sequences accepted by the fast path.
+               o identical: The number of accepted sequences with identical numbering (and start and end).
+               o different: The names of accepted sequences with different numbering.
+               o chain_type_different: The names of accepted sequences with a different chain type.
+               o species_different: The number of accepted sequences assigned a different species.
+    """
+    from .anarci import run_anarci, number_sequence_from_alignment
+
+    if numberer is None:
+        numberer = get_numberer()
+    kwargs['output'] = False
+    kwargs['fast_path'] = False
+    kwargs.setdefault( 'allow', set( numberer.frameworks ) ) # Only the chain types the fast path can number.
+    _, numbered, alignment_details, _ = run_anarci( sequences, scheme=scheme, **kwargs )
+
+    report = { "sequences":len(sequences), "accepted":0, "identical":0, "different":[], "chain_type_different":[],
+               "species_different":0 }
+    for i, (name, sequence) in enumerate( sequences ):
+        result = numberer.state_vector( sequence )
+        if result is None:
+            continue
+        report["accepted"] += 1
+        state_vector, details = result
+        if numbered[i] is None or len( numbered[i] ) != 1:
+            report["different"].append( name )
+            continue
+        try:
+            fast = number_sequence_from_alignment( state_vector, sequence, scheme=scheme, chain_type=details["chain_type"] )
+        except AssertionError:
+            report["different"].append( name )
+            continue
+        if details["chain_type"] != alignment_details[i][0]["chain_type"]:
+            report["chain_type_different"].append( name )
+        if details["species"] != alignment_details[i][0]["species"]:
+            report["species_different"] += 1
+        if tuple( fast ) == tuple( numbered[i][0] ):
+            report["identical"] += 1
+        else:
+            report["different"].append( name )
+    return report
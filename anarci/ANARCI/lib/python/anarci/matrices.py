@@ -0,0 +1,343 @@
+#    ANARCI - Antibody Numbering and Antigen Receptor ClassIfication
+#    Copyright (C) 2016 Oxford Protein Informatics Group (OPIG)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the BSD 3-Clause License.
+#
+#    You should have received a copy of the BSD 3-Clause Licence
+#    along with this program.  If not, see <https://opensource.org/license/bsd-3-clause/>.
+
+'''
+Streaming export of numbered sequences as aligned numbering matrices (Apache Arrow / Parquet).
+
+The matrices are the same as those written by csv_output: one row per numbered domain and one column per numbered
+position, with the hmm hit and germline details in the leading columns. Unlike csv_output, results are written chunk by
+chunk as they arrive (e.g. from iter_anarci) so the full result set never has to be in memory.
+
+Output is a directory partitioned by chain class. Kappa and lambda chains are written together as light chains (KL).
+The partition key is not chain_type so that it does not clash with the chain_type column of each row.
+
+    <outroot>/chain_class=H/part-00000.parquet
+    <outroot>/chain_class=H/part-00001.parquet
+    <outroot>/chain_class=H/_columns.json
+    <outroot>/chain_class=KL/...
+
+The set of position columns grows as new insertion positions are seen. A new part file is started whenever the columns
+change. When the writer is closed the parts are rewritten with the final column set of the whole output (missing
+positions are gaps, '-'), so every part has the same schema and the output can be read with standard dataset readers
+(e.g. pyarrow.parquet.read_table(outroot)). _columns.json records the ordered columns of the positions seen in the
+partition, which read_numbering_matrix selects.
+
+pyarrow is required for this module. It is an optional dependency of ANARCI.
+'''
+
+import os
+import json
+
+# Kappa and lambda chains are written to the same partition (as in csv_output)
+_lc = {'K':'KL','L':'KL'}
+chain_partitions = ['H','KL','A','B','G','D']
+
+meta_fields = ['Id','domain_no','hmm_species','chain_type','e-value','score','seqstart_index','seqend_index',
+               'identity_species','v_gene','v_identity','j_gene','j_identity']
+
+extensions = { "parquet":"parquet", "arrow":"arrow" }
+
+
+def _import_pyarrow():
+    """
+    Import pyarrow lazily so that the rest of ANARCI does not depend on it.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("pyarrow is required for Arrow/Parquet output. Install it with: pip install pyarrow")
+    return pyarrow
+
+
+def _position_name(p):
+    return ('%d%s'%p).strip()
+
+
+def _float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _germline(details, gene):
+    """
+    Unpack the (species, gene), identity of an assigned germline. Missing assignments give empty values.
+    """
+    germline, identity = details.get('germlines',{}).get( gene, [None,None] )
+    if germline is None:
+        return '', '', None
+    return germline[0], germline[1], identity
+
+
+class _Partition(object):
+    """
+    State for the numbering matrix of a single chain type.
+    """
+    __slots__ = ( "directory", "ranks", "rows", "positions", "written_positions", "writer", "nparts", "nrows",
+                  "part_positions" )
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.ranks = {}         # Insertion order of each position. i.e. is it A B C or C B A (e.g. imgt 111 and 112)
+        self.rows = []          # Buffered (meta values, position -> residue dict) rows
+        self.positions = None   # Cached ordering of the positions
+        self.written_positions = None # The positions of the open part file
+        self.writer = None
+        self.nparts = 0
+        self.nrows = 0
+        self.part_positions = [] # The positions each part file was written with
+
+    def add(self, meta, numbering):
+        l = -1
+        r = 0
+        for p, _ in numbering:
+            if p[0] != l:
+                l = p[0]
+                r = 0
+            else:
+                r +=1
+            if p not in self.ranks:
+                self.positions = None
+                self.ranks[p] = r
+            elif r > self.ranks[p]:
+                self.positions = None
+                self.ranks[p] = r
+        self.rows.append( (meta, dict(numbering)) )
+
+    def ordered_positions(self):
+        if self.positions is None:
+            self.positions = sorted( self.ranks, key = lambda p: (p[0], self.ranks[p]) )
+        return self.positions
+
+
+class NumberingMatrixWriter(object):
+    """
+    Write numbered sequences to chain partitioned Arrow or Parquet numbering matrices as they are produced.
+
+    e.g.
+        with NumberingMatrixWriter("numbered") as writer:
+            for sequences, numbered, details, _ in iter_anarci("sequences.fasta", ncpu=4):
+                writer.write(sequences, numbered, details)
+    """
+
+    def __init__(self, outroot, format="parquet", buffer_rows=10000, compression="zstd"):
+        """
+        @param outroot: The directory to write to. Partitions are written to <outroot>/chain_class=<chain class>
+        @param format: "parquet" or "arrow" (Arrow IPC file format).
+        @param buffer_rows: The number of rows buffered for a chain type before they are written as a row group (batch).
+        @param compression: Parquet compression codec. Ignored for arrow.
+        """
+        assert format in extensions, "Unrecognised output format %s. Choose from %s"%(format, ", ".join(extensions))
+        self.pa = _import_pyarrow()
+        self.outroot = outroot
+        self.format = format
+        self.buffer_rows = max(1, int(buffer_rows))
+        self.compression = compression
+        self.partitions = {}
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, sequences, numbered, alignment_details):
+        """
+        Add a chunk of results.
+
+        @param sequences: List of name, sequence tuples
+        @param numbered: Numbered sequences in the same order as the sequences list.
+        @param alignment_details: List of alignment details in the same order as the sequences list.
+        """
+        assert not self.closed, "Writer has been closed"
+        for i in range( len(sequences) ): # Iterate over entries
+            if numbered[i] is None: continue
+
+            for j in range( len(numbered[i]) ): # Iterate over domains.
+                details = alignment_details[i][j]
+                c = details['chain_type']
+                c = _lc.get(c, c) # Consider lambda and kappa together.
+                partition = self.partitions.get( c )
+                if partition is None:
+                    partition = self.partitions[c] = _Partition( os.path.join( self.outroot, "chain_class=%s"%c ) )
+
+                species, vgene, vid = _germline( details, 'v_gene' )
+                _, jgene, jid = _germline( details, 'j_gene' )
+                meta = ( sequences[i][0], j, details.get('species',''), details.get('chain_type',''),
+                         _float_or_none( details.get('evalue') ), _float_or_none( details.get('bitscore') ),
+                         numbered[i][j][1], numbered[i][j][2], species, vgene, vid, jgene, jid )
+                partition.add( meta, numbered[i][j][0] )
+                if len( partition.rows ) >= self.buffer_rows:
+                    self._flush( partition )
+
+    def _schema(self, positions):
+        pa = self.pa
+        types = [ pa.string(), pa.int16(), pa.string(), pa.string(), pa.float64(), pa.float64(), pa.int32(), pa.int32(),
+                  pa.string(), pa.string(), pa.float64(), pa.string(), pa.float64() ]
+        fields = [ pa.field(name, t) for name, t in zip( meta_fields, types ) ]
+        fields += [ pa.field( _position_name(p), pa.string() ) for p in positions ]
+        return pa.schema( fields )
+
+    def _part_filename(self, partition, n):
+        return os.path.join( partition.directory, "part-%05d.%s"%(n, extensions[self.format]) )
+
+    def _new_writer(self, filename, schema):
+        if self.format == "parquet":
+            return self.pa.parquet.ParquetWriter( filename, schema, compression=self.compression )
+        return self.pa.ipc.new_file( filename, schema )
+
+    def _open(self, partition, schema, positions):
+        if not os.path.isdir( partition.directory ):
+            os.makedirs( partition.directory )
+        filename = self._part_filename( partition, partition.nparts )
+        partition.nparts += 1
+        partition.part_positions.append( positions )
+        return self._new_writer( filename, schema )
+
+    def _all_positions(self):
+        """
+        The ordered positions of all partitions.
+        """
+        ranks = {}
+        for partition in self.partitions.values():
+            for p, r in partition.ranks.items():
+                ranks[p] = max( r, ranks.get( p, r ) )
+        return sorted( ranks, key = lambda p: (p[0], ranks[p]) )
+
+    def _unify(self, partition, positions):
+        """
+        Rewrite the parts of a partition that were not written with the given positions with them.
+        Parts are rewritten one at a time (a row group or batch at a time) so memory stays bounded.
+        """
+        schema = self._schema( positions )
+        for n, written in enumerate( partition.part_positions ):
+            if written == positions:
+                continue
+            filename = self._part_filename( partition, n )
+            writer = self._new_writer( filename + ".tmp", schema )
+            try:
+                if self.format == "parquet":
+                    source = self.pa.parquet.ParquetFile( filename )
+                    tables = ( source.read_row_group( g ) for g in range( source.num_row_groups ) )
+                else:
+                    source = self.pa.ipc.open_file( filename )
+                    tables = ( self.pa.Table.from_batches( [ source.get_batch( b ) ] ) for b in range( source.num_record_batches ) )
+                for table in tables:
+                    for name in schema.names:
+                        if name not in table.column_names:
+                            table = table.append_column( name, self.pa.array( ['-']*table.num_rows, type=self.pa.string() ) )
+                    writer.write_table( table.select( schema.names ).cast( schema ) )
+            finally:
+                writer.close()
+            os.replace( filename + ".tmp", filename )
+            partition.part_positions[n] = positions
+
+    def _flush(self, partition):
+        """
+        Write the buffered rows of a partition. A new part file is started if new positions have been seen.
+        """
+        if not partition.rows:
+            return
+        positions = partition.ordered_positions()
+        schema = self._schema( positions )
+        if partition.writer is None or partition.written_positions != positions:
+            if partition.writer is not None:
+                partition.writer.close()
+            partition.writer = self._open( partition, schema, positions )
+            partition.written_positions = positions
+
+        rows = partition.rows
+        columns = [ [ row[0][k] for row in rows ] for k in range( len(meta_fields) ) ]
+        columns += [ [ row[1].get( p, '-' ) for row in rows ] for p in positions ]
+        table = self.pa.Table.from_arrays( [ self.pa.array( col, type=f.type ) for col, f in zip( columns, schema ) ], schema=schema )
+        partition.writer.write_table( table )
+        partition.nrows += len( rows )
+        partition.rows = []
+
+    def flush(self):
+        """
+        Write all buffered rows.
+        """
+        for c in chain_partitions:
+            if c in self.partitions:
+                self._flush( self.partitions[c] )
+
+    def close(self):
+        """
+        Write all buffered rows, close the part files and record the column set of each partition.
+        """
+        if self.closed:
+            return
+        self.flush()
+        positions = self._all_positions()
+        for partition in self.partitions.values():
+            if partition.writer is not None:
+                partition.writer.close()
+                partition.writer = None
+            self._unify( partition, positions )
+            if not os.path.isdir( partition.directory ):
+                os.makedirs( partition.directory )
+            with open( os.path.join( partition.directory, "_columns.json" ), "w" ) as outfile:
+                json.dump( { "fields": meta_fields + [ _position_name(p) for p in partition.ordered_positions() ],
+                             "rows": partition.nrows, "parts": partition.nparts }, outfile )
+        self.closed = True
+
+
+def matrix_output(results, outroot, format="parquet", **kwargs):
+    """
+    Write a stream of anarci results to chain partitioned numbering matrices.
+
+    @param results: An iterable of (sequences, numbered, alignment_details, ...) tuples. e.g. from iter_anarci.
+    @param outroot: The directory to write to.
+    @param format: "parquet" or "arrow"
+
+    Other keyword arguments are passed to NumberingMatrixWriter.
+
+    @return: A dictionary of the number of rows written for each chain type.
+    """
+    with NumberingMatrixWriter( outroot, format=format, **kwargs ) as writer:
+        for chunk in results:
+            writer.write( chunk[0], chunk[1], chunk[2] )
+    return dict( (c, p.nrows) for c, p in writer.partitions.items() )
+
+
+def read_numbering_matrix(outroot, chain_type):
+    """
+    Read the numbering matrix of a chain type written by NumberingMatrixWriter into a single pyarrow Table.
+
+    Part files are unified to the final column set. Positions that did not exist when a part was written are gaps ('-').
+
+    @param outroot: The directory written to.
+    @param chain_type: One of H, KL, A, B, G, D (K and L are accepted for KL)
+    """
+    pa = _import_pyarrow()
+    c = _lc.get(chain_type, chain_type)
+    directory = os.path.join( outroot, "chain_class=%s"%c )
+    with open( os.path.join( directory, "_columns.json" ) ) as infile:
+        fields = json.load( infile )["fields"]
+
+    tables = []
+    for filename in sorted( os.listdir( directory ) ):
+        path = os.path.join( directory, filename )
+        if filename.endswith( ".parquet" ):
+            table = pa.parquet.read_table( path )
+        elif filename.endswith( ".arrow" ):
+            with pa.ipc.open_file( path ) as reader:
+                table = reader.read_all()
+        else:
+            continue
+        for name in fields:
+            if name not in table.column_names:
+                table = table.append_column( name, pa.array( ['-']*table.num_rows, type=pa.string() ) )
+        tables.append( table.select( fields ) )
+    return pa.concat_tables( tables )
@@ -0,0 +1,179 @@
+#    ANARCI - Antibody Numbering and Antigen Receptor ClassIfication
+#    Copyright (C) 2016 Oxford Protein Informatics Group (OPIG)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the BSD 3-Clause License.
+#
+#    You should have received a copy of the BSD 3-Clause Licence
+#    along with this program.  If not, see <https://opensource.org/license/bsd-3-clause/>.
+
+'''
+Plan how a run uses the cpus of the machine.
+
+A run can be parallelised with worker processes (each running hmmscan on its own chunk of sequences) and with the
+threads of each hmmscan (--cpu). Worker processes scale almost perfectly but each costs a little to start and each chunk
+pays the fixed cost of starting hmmscan. hmmscan threads cost nothing to start but scale poorly. So a small job is best
+run in a single process with a multithreaded hmmscan and a large job with a process for each core.
+
+plan_run estimates the run time of each split from the cost of each stage and picks the fastest:
+
+    plan = plan_run( 5000 )
+    plan["processes"], plan["hmmscan_threads"], plan["chunksize"]
+
+The default costs were measured on a typical machine. measure_stage_costs measures them on this machine (it is done
+automatically by run_anarci with ncpu="auto" for large jobs).
+'''
+
+import os
+import math
+import time
+import multiprocessing
+
+# The cost of each stage in seconds.
+#   o startup:  Starting hmmscan and reading the hmm database. Paid by each chunk.
+#   o search:   Searching one sequence with a single hmmscan thread.
+#   o number:   Numbering one sequence from its alignment.
+#   o process:  Starting a worker process and sending it its work.
+#   o thread_fraction: The fraction of the search that hmmscan threads share (Amdahl's law). The rest is serial.
+default_stage_costs = { "startup":0.17, "search":0.013, "number":0.0002, "process":0.05, "thread_fraction":0.6 }
+
+# hmmscan gains little from more threads than this (and its threads are not free to start).
+max_hmmscan_threads = 8
+
+_stage_costs = dict( default_stage_costs )
+_measured = False
+
+
+def available_cpus():
+    """
+    The number of cpus this process can use.
+    """
+    try:
+        return len( os.sched_getaffinity( 0 ) )
+    except AttributeError: # Not available on this platform
+        return multiprocessing.cpu_count()
+
+
+def get_stage_costs():
+    """
+    @return: The stage costs used by plan_run and whether they were measured on this machine.
+    """
+    return dict( _stage_costs ), _measured
+
+
+def set_stage_costs(costs, measured=True):
+    """
+    Set the stage costs used by plan_run. Costs that are not given are unchanged.
+    """
+    global _measured
+    for stage in costs:
+        assert stage in default_stage_costs, "Unknown stage %s"%stage
+    _stage_costs.update( costs )
+    _measured = measured
+
+
+def _noop(_):
+    return None
+
+
+def measure_stage_costs(sequences, database="ALL", hmmerpath="", scheme="imgt", sample=20):
+    """
+    Measure the stage costs on this machine by searching and numbering a sample of sequences. The costs are kept for the
+    rest of the session (see set_stage_costs).
+
+    @param sequences: A list of (name, sequence) tuples. The first sample of them are used. They should be typical of the
+                      job to be planned.
+    @param database:  The hmm database that will be searched.
+    @param hmmerpath: The path to hmmscan.
+    @param scheme:    The numbering scheme that will be used.
+    @param sample:    The number of sequences to measure with.
+
+    @return: The measured costs.
+    """
+    from .anarci import run_hmmer, number_sequences_from_alignment
+    sequences = list( sequences[:sample] )
+    assert len( sequences ) >= 2, "At least two sequences are needed to measure the stage costs"
+
+    # The time to search one sequence and the sample separates the cost of starting hmmscan from that of each search.
+    start = time.time()
+    run_hmmer( sequences[:1], hmm_database=database, hmmerpath=hmmerpath, ncpu=1 )
+    one = time.time() - start
+    start = time.time()
+    alignments = run_hmmer( sequences, hmm_database=database, hmmerpath=hmmerpath, ncpu=1 )
+    many = time.time() - start
+    search = max( 0.0, ( many - one )/( len(sequences) - 1 ) )
+    startup = max( 0.0, one - search )
+
+    start = time.time()
+    number_sequences_from_alignment( sequences, alignments, scheme=scheme, allow=set(["H","K","L","A","B","G","D"])
+                                     if scheme in ( "imgt", "aho" ) else set(["H","K","L"]) )
+    number = ( time.time() - start )/len( sequences )
+
+    start = time.time()
+    pool = multiprocessing.Pool( 2 )
+    pool.map( _noop, range( 2 ) )
+    pool.close()
+    pool.join()
+    process = ( time.time() - start )/2
+
+    costs = { "startup":startup, "search":search, "number":number, "process":process }
+    set_stage_costs( costs )
+    return costs
+
+
+def estimate_time(n, processes, threads, chunksize, costs=None):
+    """
+    Estimate the time to number n sequences in chunks of chunksize with a number of worker processes each running hmmscan
+    with a number of threads.
+    """
+    costs = costs or _stage_costs
+    chunks = int( math.ceil( float(n)/chunksize ) )
+    speedup = 1.0/( 1 - costs["thread_fraction"] + costs["thread_fraction"]/threads )
+    per_chunk = costs["startup"] + chunksize*( costs["search"]/speedup + costs["number"] )
+    rounds = int( math.ceil( float(chunks)/processes ) )
+    return ( costs["process"]*processes if processes > 1 else 0.0 ) + rounds*per_chunk
+
+
+def plan_run(n, cores=None, chunksize=None, costs=None):
+    """
+    Choose the number of worker processes, hmmscan threads and the chunk size for a run.
+
+    @param n:         The number of sequences. None if it is not known (e.g. a stream). The plan is then for a large job.
+    @param cores:     The number of cpus to use. Defaults to those available to this process.
+    @param chunksize: The chunk size if it is fixed (e.g. iter_anarci). Otherwise the sequences are divided equally
+                      between the processes (as run_anarci).
+    @param costs:     The stage costs. Defaults to the measured or default costs (see measure_stage_costs).
+
+    @return: A dictionary of the plan. processes, hmmscan_threads, chunksize, sequences, cores, estimated_seconds and
+             the costs it was made with.
+    """
+    cores = max( 1, cores or available_cpus() )
+    costs = costs or dict( _stage_costs )
+    if n is None: # Unbounded. Keep every core busy with its own process.
+        return { "sequences":None, "cores":cores, "processes":cores, "hmmscan_threads":1, "chunksize":chunksize,
+                 "estimated_seconds":None, "costs":costs, "costs_measured":_measured }
+
+    n = max( 1, n )
+    best = None
+    for processes in range( 1, min( cores, n ) + 1 ):
+        size = chunksize or int( math.ceil( float(n)/processes ) )
+        if chunksize and processes > int( math.ceil( float(n)/chunksize ) ): # More processes than chunks.
+            break
+        for threads in range( 1, min( cores//processes, max_hmmscan_threads ) + 1 ):
+            estimate = estimate_time( n, processes, threads, size, costs )
+            # Prefer fewer processes and then fewer threads unless they are measurably slower.
+            if best is None or estimate < best[0]*0.98:
+                best = ( estimate, processes, threads, size )
+    estimate, processes, threads, size = best
+    return { "sequences":n, "cores":cores, "processes":processes, "hmmscan_threads":threads, "chunksize":size,
+             "estimated_seconds":estimate, "costs":costs, "costs_measured":_measured }
+
+
+def fixed_plan(n, processes, chunksize, threads=1):
+    """
+    Describe a run whose processes, hmmscan threads and chunk size were given rather than planned. As plan_run.
+    """
+    costs = dict( _stage_costs )
+    return { "sequences":n, "cores":available_cpus(), "processes":processes, "hmmscan_threads":threads, 
+             "chunksize":chunksize, "estimated_seconds":estimate_time( n, processes, threads, chunksize, costs ) if n else None,
+             "costs":costs, "costs_measured":_measured }
@@ -0,0 +1,210 @@
+#    ANARCI - Antibody Numbering and Antigen Receptor ClassIfication
+#    Copyright (C) 2016 Oxford Protein Informatics Group (OPIG)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the BSD 3-Clause License.
+#
+#    You should have received a copy of the BSD 3-Clause Licence
+#    along with this program.  If not, see <https://opensource.org/license/bsd-3-clause/>.
+
+'''
+The lookup tables that only depend on the hmms and germlines ANARCI was built with, precomputed at build time.
+
+The build pipeline (build_pipeline/build.py) writes ALL.precomputed next to ALL.hmm. It holds
+
+  - the length of the hmm of each species and chain type (get_hmm_length)
+  - the germline sequences of each gene type, chain type and species as fixed width state sequences and gap masks, in
+    the order of germlines.py, for germline assignment (run_germline_assignment)
+
+The file is a short header (magic, format version and the length of a JSON index) followed by the index and the packed
+germline blocks. It is opened with mmap so a process only reads the blocks of the germlines it assigns and workers share
+the pages. The index records the size, modification time and sha1 of the ALL.hmm it was built against. The bundle is
+not used (and everything is computed from germlines.py as before) if it is missing, has another format version or was
+built against another ALL.hmm.
+
+This module only uses the standard library so that the build pipeline can load it from its file.
+'''
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+
+magic = b"ANARCIPC"
+bundle_format = 1
+_header = struct.Struct( "<8sII" ) # magic, format, length of the index
+
+# The germline state sequences are the 128 IMGT states.
+n_states = 128
+
+
+def _file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open( path, "rb" ) as f:
+        for block in iter( lambda: f.read( 1<<20 ), b"" ):
+            sha1.update( block )
+    return sha1.hexdigest()
+
+
+def hmm_lengths(germlines):
+    """
+    The length of the hmm of each species and chain type: the number of states the J genes reach (127 or 128).
+    """
+    lengths = {}
+    for chain_type in germlines['J']:
+        for species, genes in germlines['J'][chain_type].items():
+            lengths[ "%s_%s"%(species, chain_type) ] = len( list( genes.values() )[0].rstrip('-') )
+    return lengths
+
+
+def write_bundle(path, germlines, hmm_file):
+    """
+    Write the precomputed bundle.
+
+    @param path: The file to write.
+    @param germlines: The all_germlines dictionary of germlines.py.
+    @param hmm_file: The ALL.hmm the bundle is built against.
+    """
+    index = { "format":bundle_format, "hmm_lengths":hmm_lengths( germlines ), "germlines":{} }
+    stat = os.stat( hmm_file )
+    index["hmm"] = { "size":stat.st_size, "mtime_ns":stat.st_mtime_ns, "sha1":_file_sha1( hmm_file ) }
+
+    blocks, offset = [], 0
+    for gene_type in ( 'V', 'J' ):
+        for chain_type, species_genes in germlines[gene_type].items():
+            for species, genes in species_genes.items():
+                names = list( genes )
+                sequences = [ genes[name] for name in names ]
+                for sequence in sequences:
+                    assert len( sequence ) == n_states, "Germline %s is not %d states long"%( sequence, n_states )
+                residues = "".join( sequences ).encode( "ascii" )
+                masks = bytes( bytearray( 1 if aa == "-" else 0 for sequence in sequences for aa in sequence ) )
+                index["germlines"][ "%s|%s|%s"%(gene_type, chain_type, species) ] = {
+                    "offset":offset, "names":names, "lengths":[ n_states - s.count("-") for s in sequences ] }
+                blocks += [ residues, masks ]
+                offset += len( residues ) + len( masks )
+
+    encoded = json.dumps( index, sort_keys=True ).encode()
+    # Write and rename so that a reader never sees a partial bundle.
+    with open( path + ".tmp", "wb" ) as f:
+        f.write( _header.pack( magic, bundle_format, len( encoded ) ) )
+        f.write( encoded )
+        for block in blocks:
+            f.write( block )
+    os.replace( path + ".tmp", path )
+    return path
+
+
+class PrecomputedBundle(object):
+    """
+    A precomputed bundle opened with mmap.
+    """
+
+    def __init__(self, path):
+        with open( path, "rb" ) as f:
+            self._map = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+        found, version, length = _header.unpack_from( self._map, 0 )
+        assert found == magic, "%s is not a precomputed bundle"%path
+        assert version == bundle_format, "%s has format %d not %d"%( path, version, bundle_format )
+        self.index = json.loads( self._map[ _header.size:_header.size+length ].decode() )
+        self._data = _header.size + length
+        self._matrices = {}
+
+    def matches(self, hmm_file):
+        """
+        Check that the bundle was built against an hmm file. The sha1 is only calculated if the size matches and the
+        modification time does not.
+        """
+        recorded = self.index["hmm"]
+        stat = os.stat( hmm_file )
+        if stat.st_size != recorded["size"]:
+            return False
+        if stat.st_mtime_ns == recorded["mtime_ns"]:
+            return True
+        return _file_sha1( hmm_file ) == recorded["sha1"]
+
+    def hmm_length(self, species, chain_type):
+        """
+        @return: The length of the hmm of a species and chain type or None if it has none.
+        """
+        return self.index["hmm_lengths"].get( "%s_%s"%(species, chain_type) )
+
+    def germline_matrix(self, gene_type, chain_type, species):
+        """
+        The germlines of a gene type, chain type and species packed for germline_identities.
+
+        @return: The gene names, the state sequences and gap masks as integers (one byte a state) and the number of
+                 states of each germline that are not gaps. None if there are no germlines.
+        """
+        key = "%s|%s|%s"%(gene_type, chain_type, species)
+        if key not in self._matrices:
+            entry = self.index["germlines"].get( key )
+            if entry is None:
+                self._matrices[key] = None
+            else:
+                names = entry["names"]
+                start = self._data + entry["offset"]
+                masks = start + len( names )*n_states
+                self._matrices[key] = ( names,
+                    [ int.from_bytes( self._map[ start+i*n_states:start+(i+1)*n_states ], "big" ) for i in range( len(names) ) ],
+                    [ int.from_bytes( self._map[ masks+i*n_states:masks+(i+1)*n_states ], "big" ) for i in range( len(names) ) ],
+                    entry["lengths"] )
+        return self._matrices[key]
+
+    def close(self):
+        self._map.close()
+
+
+# Each byte of x is 0x80 after this if it was not zero.
+_low7 = int.from_bytes( b"\x7f"*n_states, "big" )
+_high = int.from_bytes( b"\x80"*n_states, "big" )
+
+def _nonzero_bytes(x):
+    return bin( ( ( ( x & _low7 ) + _low7 ) | x ) & _high ).count( "1" )
+
+
+def state_integer(state_sequence):
+    """
+    Pack a state sequence (as made by run_germline_assignment) for germline_identities.
+    """
+    return int.from_bytes( state_sequence.upper().encode( "ascii", "replace" ), "big" )
+
+
+def germline_identities(state, matrix):
+    """
+    The identity of a packed state sequence to each germline of a matrix. As get_identity: the fraction of the states that
+    are not gaps in the germline that have the germline residue.
+    """
+    names, residues, masks, lengths = matrix
+    identities = []
+    for germline, mask, n in zip( residues, masks, lengths ):
+        if not n:
+            identities.append( 0 )
+        else:
+            # Bytes that differ from the germline or are gaps in it are not zero.
+            identities.append( float( n_states - _nonzero_bytes( ( state ^ germline ) | mask ) )/n )
+    return identities
+
+
+_bundles = {}
+
+def get_bundle(hmm_path):
+    """
+    Get the precomputed bundle built against the ALL.hmm in a directory.
+
+    @return: The bundle or None if there is none or it was not built against this ALL.hmm.
+    """
+    if hmm_path not in _bundles:
+        bundle = None
+        path = os.path.join( hmm_path, "ALL.precomputed" )
+        if os.path.isfile( path ):
+            try:
+                bundle = PrecomputedBundle( path )
+                if not bundle.matches( os.path.join( hmm_path, "ALL.hmm" ) ):
+                    bundle.close()
+                    bundle = None
+            except ( AssertionError, ValueError, KeyError, OSError, struct.error ): # Not a bundle this version can read
+                bundle = None
+        _bundles[hmm_path] = bundle
+    return _bundles[hmm_path]
@@ -0,0 +1,165 @@
+#    ANARCI - Antibody Numbering and Antigen Receptor ClassIfication
+#    Copyright (C) 2016 Oxford Protein Informatics Group (OPIG)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the BSD 3-Clause License.
+#
+#    You should have received a copy of the BSD 3-Clause Licence
+#    along with this program.  If not, see <https://opensource.org/license/bsd-3-clause/>.
+
+'''
+A k-mer pre-classifier for ANARCI.
+
+Normally every sequence given to anarci is searched against every hmm. The classifier takes a cheap first look at each
+sequence using the k-mers (words of k residues) of the germline V and J genes of each chain type:
+
+  - Sequences that share too few k-mers with the germlines of every chain type are rejected and are not searched.
+  - Other sequences are routed to the hmms of the chain types they share the most k-mers with.
+
+Routed sequences that do not get a hit against their chain types are searched again against all hmms (see anarci) so a
+wrong route only costs time. A wrong rejection loses a domain. evaluate_prefilter measures both against the full search.
+'''
+
+from .germlines import all_germlines
+
+
+class KmerClassifier(object):
+    """
+    Classify sequences by the k-mers they share with the germline genes of each chain type.
+    """
+
+    def __init__(self, k=5, min_kmers=10, route_fraction=0.5, germlines=None):
+        """
+        @param k: The k-mer length.
+        @param min_kmers: The number of distinct k-mers a sequence must share with the germlines of a chain type not to be
+                          rejected.
+        @param route_fraction: Route to every chain type that shares at least this fraction of the k-mers of the best
+                          chain type.
+        @param germlines: The germline alignments to use. Defaults to the germlines ANARCI was built with.
+        """
+        self.k = k
+        self.min_kmers = min_kmers
+        self.route_fraction = route_fraction
+        if germlines is None:
+            germlines = all_germlines
+
+        self.chain_types = sorted( set( germlines['V'] ) | set( germlines['J'] ) )
+        index = {}
+        for gene_type in ( 'V', 'J' ):
+            for i, chain_type in enumerate( self.chain_types ):
+                for genes in germlines[gene_type].get( chain_type, {} ).values():
+                    for aligned in genes.values():
+                        sequence = aligned.replace( "-", "" )
+                        for j in range( len(sequence) - k + 1 ):
+                            index.setdefault( sequence[j:j+k], set() ).add( i )
+        # k-mer -> the indices of the chain types with a germline containing it
+        self.index = dict( (kmer, tuple( sorted(chains) )) for kmer, chains in index.items() )
+
+    def counts(self, sequence):
+        """
+        Count the distinct k-mers of a sequence shared with the germlines of each chain type.
+
+        @return: A list of counts in the order of chain_types
+        """
+        k, index = self.k, self.index
+        counts = [ 0 ]*len( self.chain_types )
+        for kmer in set( sequence[j:j+k] for j in range( len(sequence) - k + 1 ) ):
+            for i in index.get( kmer, () ):
+                counts[i] += 1
+        return counts
+
+    def scores(self, sequence):
+        """
+        @return: A dictionary of the number of distinct k-mers shared with the germlines of each chain type.
+        """
+        return dict( zip( self.chain_types, self.counts( sequence ) ) )
+
+    def classify(self, sequence):
+        """
+        Classify a sequence.
+
+        @return: The set of chain types the sequence should be searched against. An empty set if it is rejected.
+        """
+        counts = self.counts( sequence )
+        best = max( counts ) if counts else 0
+        if best < self.min_kmers:
+            return set()
+        return set( c for c, n in zip( self.chain_types, counts ) if n >= self.route_fraction*best )
+
+    def classify_sequences(self, sequences):
+        """
+        Classify a list of (name, sequence) tuples. Identical sequences are only classified once.
+
+        @return: A list of sets of chain types in the order of sequences.
+        """
+        classified = {}
+        routes = []
+        for _, sequence in sequences:
+            if sequence not in classified:
+                classified[sequence] = frozenset( self.classify( sequence ) )
+            routes.append( classified[sequence] )
+        return routes
+
+
+_default_classifier = None
+
+def get_classifier():
+    """
+    Get the classifier built from the germlines ANARCI was built with. It is built the first time it is asked for.
+    """
+    global _default_classifier
+    if _default_classifier is None:
+        _default_classifier = KmerClassifier()
+    return _default_classifier
+
+
+def evaluate_prefilter(sequences, classifier=None, **kwargs):
+    """
+    Measure the rejections and routing of a classifier against the full hmm search.
+
+    @param sequences: A list of (name, sequence) tuples.
+    @param classifier: The classifier to evaluate. Defaults to get_classifier()
+
+    Other keyword arguments are passed to run_anarci for the full search (e.g. ncpu).
+
+    @return: A dictionary of statistics.
+               o sequences: The number of sequences.
+               o numbered: The number of sequences numbered by the full search.
+               o rejected: The number of sequences rejected by the classifier.
+               o false_rejections: The names of rejected sequences that the full search numbered.
+               o routed_correctly: The number of numbered sequences whose route contained the chain type of every domain.
+               o misrouted: The names of numbered sequences whose route missed the chain type of a domain. These fall
+                            back to the full search.
+               o rejection_recall: The fraction of unnumbered sequences that were rejected.
+               o routing_accuracy: routed_correctly as a fraction of the numbered sequences that were not rejected.
+    """
+    from .anarci import run_anarci
+
+    if classifier is None:
+        classifier = get_classifier()
+    routes = classifier.classify_sequences( sequences )
+    kwargs['output'] = False
+    kwargs['prefilter'] = False
+    _, numbered, alignment_details, _ = run_anarci( sequences, **kwargs )
+
+    report = { "sequences":len(sequences), "numbered":0, "rejected":0, "false_rejections":[], "routed_correctly":0,
+               "misrouted":[] }
+    for i in range( len(sequences) ):
+        if not routes[i]:
+            report["rejected"] += 1
+        if numbered[i] is None:
+            continue
+        report["numbered"] += 1
+        if not routes[i]:
+            report["false_rejections"].append( sequences[i][0] )
+        elif all( details["chain_type"] in routes[i] for details in alignment_details[i] ):
+            report["routed_correctly"] += 1
+        else:
+            report["misrouted"].append( sequences[i][0] )
+
+    unnumbered = report["sequences"] - report["numbered"]
+    correctly_rejected = report["rejected"] - len( report["false_rejections"] )
+    report["rejection_recall"] = float( correctly_rejected )/unnumbered if unnumbered else 1.0
+    routed = report["numbered"] - len( report["false_rejections"] )
+    report["routing_accuracy"] = float( report["routed_correctly"] )/routed if routed else 1.0
+    return report
@@ -0,0 +1,254 @@
+#    ANARCI - Antibody Numbering and Antigen Receptor ClassIfication
+#    Copyright (C) 2016 Oxford Protein Informatics Group (OPIG)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the BSD 3-Clause License.
+#
+#    You should have received a copy of the BSD 3-Clause Licence
+#    along with this program.  If not, see <https://opensource.org/license/bsd-3-clause/>.
+
+'''
+A persistent store of hmm alignments.
+
+Aligning sequences to the hmms is the expensive part of ANARCI. Numbering a sequence from its alignment (state vector) is
+cheap. The store keeps the alignment of each sequence so that it can be numbered again under another scheme (or after a
+fix to a scheme) without aligning it again.
+
+    store = AlignmentStore("alignments.db")
+    run_anarci("sequences.fasta", ncpu=4, alignment_store=store)        # Align, store and number
+    sequences, numbered, details, _ = store.renumber(scheme="kabat")      # Number again from the store
+
+Alignments are kept by the hash of their sequence together with the version of ANARCI, the hmm database and the search
+options (e.g. prefilter or fast_path) that made them (see get_database_version). anarci only reuses stored alignments of
+the current version. A sequence aligned under several versions keeps an alignment for each. renumber uses the latest 
+alignment of each sequence or those of a chosen version (see versions). Sequence ids are kept separately, in the order they were first 
+stored, so the same sequence under many ids is aligned and stored once. An id used for several sequences (e.g. repeated
+read ids) keeps each of them.
+
+The store is a SQLite database. It can be shared by the processes of run_anarci.
+'''
+
+import json
+import sqlite3
+import hashlib
+
+
+def sequence_hash(sequence):
+    """
+    The key of a sequence in the store.
+    """
+    return hashlib.sha1( sequence.encode() ).hexdigest()
+
+
+def _dump_alignment(alignment):
+    hit_table, state_vectors, details = alignment
+    return json.dumps( hit_table ), json.dumps( state_vectors ), json.dumps( [ dict( d.items() ) for d in details ] )
+
+
+def _load_alignment(hit_table, state_vectors, details):
+    state_vectors = [ [ ( (state, state_type), si ) for (state, state_type), si in state_vector ]
+                      for state_vector in json.loads( state_vectors ) ]
+    return json.loads( hit_table ), state_vectors, json.loads( details )
+
+
+class AlignmentStore(object):
+    """
+    Keep the hmm alignments of sequences in a SQLite database.
+    """
+
+    def __init__(self, path, timeout=60):
+        """
+        @param path: The database file. It is made if it does not exist.
+        @param timeout: The number of seconds to wait for another process that is writing to the store.
+        """
+        self.path = path
+        self.timeout = timeout
+        self._connect()
+
+    def _connect(self):
+        self.connection = sqlite3.connect( self.path, timeout=self.timeout )
+        self.connection.execute( "PRAGMA journal_mode=WAL" ) # Readers do not block the writer (e.g. run_anarci workers)
+        with self.connection:
+            self.connection.execute( "CREATE TABLE IF NOT EXISTS alignments ( hash TEXT, sequence TEXT, version TEXT, "
+                                     "hit_table TEXT, state_vectors TEXT, details TEXT, PRIMARY KEY ( hash, version ) )" )
+            self.connection.execute( "CREATE TABLE IF NOT EXISTS names ( name TEXT, hash TEXT, PRIMARY KEY ( name, hash ) )" )
+
+    # The connection cannot be pickled. The store is opened again by each process it is sent to.
+    def __getstate__(self):
+        return { "path":self.path, "timeout":self.timeout }
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.timeout = state["timeout"]
+        self._connect()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute( "SELECT COUNT(*) FROM alignments" ).fetchone()[0]
+
+    def versions(self):
+        """
+        @return: A dictionary of the number of stored alignments of each version.
+        """
+        return dict( self.connection.execute( "SELECT version, COUNT(*) FROM alignments GROUP BY version" ) )
+
+    def add(self, sequences, alignments, version):
+        """
+        Store the alignments of sequences.
+
+        @param sequences: A list of (name, sequence) tuples.
+        @param alignments: The (hit_table, state_vectors, details) alignment of each sequence from run_hmmer (after
+                           check_for_j).
+        @param version: The version of ANARCI and the hmm database that made the alignments.
+        """
+        rows = []
+        for (name, sequence), alignment in zip( sequences, alignments ):
+            rows.append( ( sequence_hash( sequence ), sequence, version ) + _dump_alignment( alignment ) )
+        with self.connection:
+            self.connection.executemany( "INSERT OR REPLACE INTO alignments VALUES (?, ?, ?, ?, ?, ?)", rows )
+            self.connection.executemany( "INSERT OR IGNORE INTO names VALUES (?, ?)",
+                                         [ ( name, row[0] ) for (name, _), row in zip( sequences, rows ) ] )
+
+    def alignments(self, sequences, version=None):
+        """
+        Get the stored alignments of sequences. The names of the sequences are recorded for those that are found.
+
+        @param sequences: A list of (name, sequence) tuples.
+        @param version: Only return alignments made by this version. None for the latest alignment of any version.
+
+        @return: A list of alignments in the order of sequences. None for those that are not stored.
+        """
+        found = {}
+        hashes = list( set( sequence_hash( sequence ) for _, sequence in sequences ) )
+        for i in range( 0, len( hashes ), 500 ): # Within the SQLite limit on the number of parameters.
+            batch = hashes[i:i+500]
+            for h, hit_table, state_vectors, details in self._select( "hash, hit_table, state_vectors, details", batch,
+                                                                      version ):
+                found[h] = ( hit_table, state_vectors, details )
+
+        alignments, names = [], []
+        for name, sequence in sequences:
+            h = sequence_hash( sequence )
+            if h in found:
+                alignments.append( _load_alignment( *found[h] ) ) # Each sequence gets its own copy.
+                names.append( ( name, h ) )
+            else:
+                alignments.append( None )
+        if names:
+            with self.connection:
+                self.connection.executemany( "INSERT OR IGNORE INTO names VALUES (?, ?)", names )
+        return alignments
+
+    def _select(self, columns, hashes, version):
+        """
+        Select columns of the alignments of hashes made by version. With version None every alignment of a hash is 
+        selected, the latest last.
+        """
+        query = "SELECT %s FROM alignments WHERE hash IN (%s)"%( columns, ",".join( "?"*len(hashes) ) )
+        if version is None:
+            return self.connection.execute( query + " ORDER BY rowid", hashes )
+        return self.connection.execute( query + " AND version = ?", list( hashes ) + [ version ] )
+
+    def names(self):
+        """
+        @return: The ids of all the stored sequences. An id used for several sequences is given once for each.
+        """
+        return [ name for name, in self.connection.execute( "SELECT name FROM names ORDER BY rowid" ) ]
+
+    def _entries(self, ids):
+        """
+        The (name, hash) entries of ids in the order of ids. An id used for several sequences has an entry for each.
+        """
+        if ids is None:
+            return list( self.connection.execute( "SELECT name, hash FROM names ORDER BY rowid" ) )
+        ids = list( ids )
+        found = {}
+        unique = list( set( ids ) )
+        for i in range( 0, len( unique ), 500 ):
+            batch = unique[i:i+500]
+            query = "SELECT name, hash FROM names WHERE name IN (%s) ORDER BY rowid"%",".join( "?"*len(batch) )
+            for name, h in self.connection.execute( query, batch ):
+                found.setdefault( name, [] ).append( ( name, h ) )
+        entries, seen = [], set()
+        for name in ids:
+            assert name in found, "Sequence %s is not in the alignment store"%name
+            if name not in seen: # A repeated id is given all its sequences once.
+                entries.extend( found[name] )
+                seen.add( name )
+        return entries
+
+    def iter_renumber(self, ids=None, scheme="imgt", chunksize=1000, version=None, **kwargs):
+        """
+        Number stored sequences again from their alignments. Nothing is aligned.
+
+        @param ids: The ids of the sequences to number. None for all stored sequences. Every sequence stored under an id is
+                    numbered.
+        @param scheme: The numbering scheme.
+        @param chunksize: The number of sequences numbered in each chunk.
+        @param version: Number the alignments made by this version (see versions and get_database_version). Sequences
+                        without one are skipped (or an error if they were asked for by id). None for the latest alignment
+                        of each sequence.
+
+        Other keyword arguments are passed to number_sequences_from_alignment (e.g. allow, assign_germline, compact).
+
+        @return: A generator of (sequences, numbered, alignment_details, hit_tables) tuples. One for each chunk.
+        """
+        from .anarci import number_sequences_from_alignment, scheme_short_to_long
+        try:
+            scheme = scheme_short_to_long[scheme.lower()]
+        except KeyError:
+            raise AssertionError("Unrecognised or unimplemented scheme: %s"%scheme)
+        entries = self._entries( ids )
+
+        for i in range( 0, len( entries ), chunksize ):
+            chunk = entries[i:i+chunksize]
+            stored = {}
+            hashes = list( set( h for _, h in chunk ) )
+            for j in range( 0, len( hashes ), 500 ):
+                batch = hashes[j:j+500]
+                for row in self._select( "hash, sequence, hit_table, state_vectors, details", batch, version ):
+                    stored[ row[0] ] = row[1:]
+            sequences, alignments = [], []
+            for name, h in chunk:
+                if h not in stored:
+                    assert ids is None, "Sequence %s has no alignment of version %s in the alignment store"%( name, version )
+                    continue
+                sequence, hit_table, state_vectors, details = stored[h]
+                sequences.append( ( name, sequence ) )
+                alignments.append( _load_alignment( hit_table, state_vectors, details ) )
+            if not sequences:
+                continue
+            numbered, alignment_details, hit_tables = number_sequences_from_alignment( sequences, alignments, scheme=scheme,
+                                                                                       **kwargs )
+            yield sequences, numbered, alignment_details, hit_tables
+
+    def renumber(self, ids=None, scheme="imgt", **kwargs):
+        """
+        Number stored sequences again from their alignments. See iter_renumber (e.g. for the version to number).
+
+        @return: Four lists as run_anarci. Sequences, Numbered, Alignment_details and Hit_tables.
+        """
+        sequences, numbered, alignment_details, hit_tables = [], [], [], []
+        for chunk in self.iter_renumber( ids, scheme=scheme, **kwargs ):
+            sequences.extend( chunk[0] )
+            numbered.extend( chunk[1] )
+            alignment_details.extend( chunk[2] )
+            hit_tables.extend( chunk[3] )
+        return sequences, numbered, alignment_details, hit_tables
+
+
+def open_alignment_store(store):
+    """
+    @param store: An AlignmentStore or the path of one.
+    """
+    if isinstance( store, AlignmentStore ):
+        return store
+    return AlignmentStore( store )
@@ -17,8 +17,8 @@ class CustomInstallCommand(install):
        # Build HMMs from IMGT germlines
        os.chdir("build_pipeline")
        print('INFO: Downloading germlines from IMGT and building HMMs...')
-       print("INFO: running 'RUN_pipeline.sh', this will take a couple a minutes.")
-       proc = subprocess.Popen(["bash", "RUN_pipeline.sh"], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+       print("INFO: running 'build.py'. Only the stages that are out of date are run. The first build will take a couple a minutes.")
+       proc = subprocess.Popen([sys.executable, "build.py"], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
        o, e = proc.communicate()
 
        print(o.decode())
@@ -26,17 +26,12 @@ class CustomInstallCommand(install):
        
        # Copy HMMs where ANARCI can find them
        shutil.copy( "curated_alignments/germlines.py", ANARCI_LOC )
-       os.mkdir(os.path.join(ANARCI_LOC, "dat"))
-       shutil.copytree( "HMMs", os.path.join(ANARCI_LOC, "dat/HMMs/") )
+       if os.path.isdir(os.path.join(ANARCI_LOC, "dat/HMMs/")):
+           shutil.rmtree(os.path.join(ANARCI_LOC, "dat/HMMs/"))
+       shutil.copytree( "HMMs", os.path.join(ANARCI_LOC, "dat/HMMs/"), ignore=shutil.ignore_patterns("parts") )
       
-      # Remove data from HMMs generation
-       try:
-           shutil.rmtree("curated_alignments/")
-           shutil.rmtree("muscle_alignments/")
-           shutil.rmtree("HMMs/")
-           shutil.rmtree("IMGT_sequence_files/")
-       except OSError:
-           pass
+       # The data from the HMM generation (and build_state.json) is kept so that the next install only rebuilds the
+       # stages whose inputs have changed. Run 'python build.py --force' in build_pipeline to build from scratch.
 
 setup(name='anarci',
      version='1.3',
@@ -3,13 +3,16 @@ from http import HTTPStatus
 from typing import Annotated, Optional, Dict, Any
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Response, Form, Query
 from fastapi.params import Param, Path
+from starlette.concurrency import run_in_threadpool
 from auth import authenticate
 from api_exceptions import not_found_exception
-from backend import NGSBackend, TDPBackend
+from backend import AsyncNGSBackend, AsyncTDPBackend
 from benchling.exceptions import NoAssayRunFoundForNGSRun
 from schemas import ClonePoolPrimerInfo, ClonePrimerInfo, MutationAnalysis, MutationPurityAnalysis, NGSRunInfo
 from schemas import PrimerInfo, MutationInfo, PurityAnalysis, RepertoireAnalysis, StatusResponse, User
-from dependencies import ngs_backend, ts_backend
+from dependencies import cache_manager, async_ngs_backend, async_ts_backend
+from caching import CacheManager
+from clients import client_registry
 
 router = APIRouter(responses={404: {"description": "Not found"}})
 
@@ -17,9 +20,17 @@ router = APIRouter(responses={404: {"description": "Not found"}})
 async def get_info() -> StatusResponse:
     return StatusResponse(info="OK - API WRAPPER IS RUNNING!")
 
+@router.get("/client-stats", response_model=None)
+async def get_client_stats() -> list[Dict[str, Any]]:
+    return client_registry.stats()
+
+@router.get("/cache-stats", response_model=None)
+async def get_cache_stats(cache: CacheManager = Depends(cache_manager)) -> Dict[str, Any]:
+    return await run_in_threadpool(cache.stats)
+
 @router.get("/get-ts-fileinfo/{file_id}", response_model=None)
-async def get_ts_fileinfo(file_id: str, backend: TDPBackend = Depends(ts_backend)):
-    fileinfo, status = backend.retrieve_file_info(
+async def get_ts_fileinfo(file_id: str, backend: AsyncTDPBackend = Depends(async_ts_backend)):
+    fileinfo, status = await backend.retrieve_file_info(
         file_id = file_id
     )
     if not status.is_success:
@@ -27,9 +38,9 @@ async def get_ts_fileinfo(file_id: str, backend: TDPBackend = Depends(ts_backend
     return fileinfo
 
 @router.post("/upload-ts-file", response_model=None, status_code=HTTPStatus.CREATED)
-async def upload_ts_file(file: UploadFile = File(...), labels: str = Query(...), backend: TDPBackend = Depends(ts_backend)):
+async def upload_ts_file(file: UploadFile = File(...), labels: str = Query(...), backend: AsyncTDPBackend = Depends(async_ts_backend)):
     file_data = await file.read()
-    fileid, status = backend.upload_raw_file(
+    fileid, status = await backend.upload_raw_file(
         file_name = str(file.filename), 
         file_data = file_data, 
         content_type = str(file.content_type),
@@ -40,8 +51,8 @@ async def upload_ts_file(file: UploadFile = File(...), labels: str = Query(...),
     return Response(content = fileid, status_code = status.value, media_type = "application/json")
 
 @router.post("/upload-ts-metadata", response_model=None, status_code=HTTPStatus.CREATED)
-async def upload_ts_meta(json_data: Dict[str, Any], labels: str = Query(...), backend: TDPBackend = Depends(ts_backend)):
-    fileid, status = backend.upload_json_meta(json_data = json_data, labels = json.loads(labels))
+async def upload_ts_meta(json_data: Dict[str, Any], labels: str = Query(...), backend: AsyncTDPBackend = Depends(async_ts_backend)):
+    fileid, status = await backend.upload_json_meta(json_data = json_data, labels = json.loads(labels))
     if not status.is_success:
         raise HTTPException(status_code=status.value)
     return Response(content = fileid, status_code = status.value, media_type = "application/json")
@@ -49,52 +60,52 @@ async def upload_ts_meta(json_data: Dict[str, Any], labels: str = Query(...), ba
 
 @router.get("/primer-information/{pp_id}", response_model=list[ClonePrimerInfo])
 async def get_primer_info(pp_id: Annotated[str, Path(pattern="^NGS_PP")], 
-                          backend: NGSBackend = Depends(ngs_backend)) -> list[ClonePrimerInfo]:
-    return backend.get_primer_info(pp_id=pp_id)
+                          backend: AsyncNGSBackend = Depends(async_ngs_backend)) -> list[ClonePrimerInfo]:
+    return await backend.get_primer_info(pp_id=pp_id)
 
 
 @router.get("/mutation-information/{ngs_run_id}", response_model=list[MutationInfo])
 async def get_mutation_info(
     ngs_run_id: Annotated[str, Path(pattern="^NGS_RUN")],
-    backend: NGSBackend = Depends(ngs_backend),
+    backend: AsyncNGSBackend = Depends(async_ngs_backend),
 ) -> list[MutationInfo]:
-    return backend.get_mutation_info(ngs_run_id=ngs_run_id)
+    return await backend.get_mutation_info(ngs_run_id=ngs_run_id)
 
 
 @router.post("/purity-analysis", response_model=list[PurityAnalysis], status_code=HTTPStatus.CREATED)
-async def upload_purity_analysis(purity_analysis: list[PurityAnalysis], backend: NGSBackend = Depends(ngs_backend)):
+async def upload_purity_analysis(purity_analysis: list[PurityAnalysis], backend: AsyncNGSBackend = Depends(async_ngs_backend)):
     try:
-        return backend.save_purity_analysis(purity_analysis=purity_analysis)
+        return await backend.save_purity_analysis(purity_analysis=purity_analysis)
     except NoAssayRunFoundForNGSRun:
         raise not_found_exception
 
 @router.post("/repertoire-analysis", response_model=list[RepertoireAnalysis], status_code=HTTPStatus.CREATED)
-async def upload_repertoire_analysis(repertoire_analysis: list[RepertoireAnalysis], backend: NGSBackend = Depends(ngs_backend)):
+async def upload_repertoire_analysis(repertoire_analysis: list[RepertoireAnalysis], backend: AsyncNGSBackend = Depends(async_ngs_backend)):
     try:
-        return backend.save_repertoire_analysis(repertoire_analysis=repertoire_analysis)
+        return await backend.save_repertoire_analysis(repertoire_analysis=repertoire_analysis)
     except NoAssayRunFoundForNGSRun:
         raise not_found_exception
 
 @router.post("/purity-mutation-analysis", response_model=list[MutationPurityAnalysis], status_code=HTTPStatus.CREATED)
-async def upload_purity_mutation_analysis(mutation_analysis: list[MutationPurityAnalysis], backend: NGSBackend = Depends(ngs_backend)):
+async def upload_purity_mutation_analysis(mutation_analysis: list[MutationPurityAnalysis], backend: AsyncNGSBackend = Depends(async_ngs_backend)):
     try:
-        return backend.save_purity_mutation_analysis(mutation_analysis=mutation_analysis)
+        return await backend.save_purity_mutation_analysis(mutation_analysis=mutation_analysis)
     except NoAssayRunFoundForNGSRun:
         raise not_found_exception
 
 @router.get("/clone-pool-primer-information/{ngs_run_id}/{pp_id}")
 async def get_clone_pool_primer_info(pp_id: Annotated[str, Path(pattern="^NGS_PP")],
                                      ngs_run_id: Annotated[str, Path(pattern="^NGS_RUN")], 
-                                     backend: NGSBackend = Depends(ngs_backend)) -> list[ClonePoolPrimerInfo]:
-    return backend.get_clone_pool_primer_info(pp_id=pp_id, ngs_run_id=ngs_run_id)
+                                     backend: AsyncNGSBackend = Depends(async_ngs_backend)) -> list[ClonePoolPrimerInfo]:
+    return await backend.get_clone_pool_primer_info(pp_id=pp_id, ngs_run_id=ngs_run_id)
 
 @router.get("/sample-type/{pp_id}")
 async def get_sample_type(pp_id: Annotated[str, Path(pattern="^NGS_PP")],
-                          backend: NGSBackend = Depends(ngs_backend)) -> str:
-    return backend.get_sample_type(pp_id=pp_id)
+                          backend: AsyncNGSBackend = Depends(async_ngs_backend)) -> str:
+    return await backend.get_sample_type(pp_id=pp_id)
 
 @router.get("/ngs-run-information/{ngs_run_id}/{pp_id}")
 async def get_ngs_run_info(pp_id: Annotated[str, Path(pattern="^NGS_PP")],
                             ngs_run_id: Annotated[str, Path(pattern="^NGS_RUN")], 
-                                backend: NGSBackend = Depends(ngs_backend)) -> Dict[str, Any]:
-    return backend.get_ngs_run_info(pp_id=pp_id, ngs_run_id=ngs_run_id)
+                                backend: AsyncNGSBackend = Depends(async_ngs_backend)) -> Dict[str, Any]:
+    return await backend.get_ngs_run_info(pp_id=pp_id, ngs_run_id=ngs_run_id)
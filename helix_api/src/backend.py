@@ -4,17 +4,14 @@ from http import HTTPStatus
 from caching import CacheManager
 from config import get_settings, get_tdp_settings
 from fastapi import UploadFile
-from benchling_sdk.auth.client_credentials_oauth2 import ClientCredentialsOAuth2
-from benchling_sdk.benchling import Benchling
+from starlette.concurrency import run_in_threadpool
+from clients import client_registry
 
 class BenchlingBackend:
 
     def __init__(self):
         settings=get_settings()
-        auth_method = ClientCredentialsOAuth2(
-            client_id=settings.client_id, client_secret=settings.client_secret
-        )
-        self.benchling = Benchling(url=settings.base_url, auth_method=auth_method)
+        self.benchling = client_registry.get(settings).benchling
         self.settings = settings
 
 class NGSBackend(BenchlingBackend):
@@ -58,4 +55,56 @@ class TDPBackend:
 
     def upload_json_meta(self, json_data: Dict[str, Any], labels: Dict) -> tuple[str, HTTPStatus]:
         pass
-    
\ No newline at end of file
+
+class AsyncNGSBackend:
+    """AsyncNGSBackend
+    The methods of an NGSBackend as coroutines. The Benchling SDK is synchronous, so each call runs in the worker
+    thread pool and the event loop keeps serving other requests while it waits on Benchling.
+
+    """
+
+    def __init__(self, backend: NGSBackend):
+        self.backend = backend
+
+    async def get_primer_info(self, pp_id: str) -> list[ClonePrimerInfo]:
+        return await run_in_threadpool(self.backend.get_primer_info, pp_id=pp_id)
+
+    async def get_clone_pool_primer_info(self, pp_id: str, ngs_run_id: str) -> list[ClonePoolPrimerInfo]:
+        return await run_in_threadpool(self.backend.get_clone_pool_primer_info, pp_id=pp_id, ngs_run_id=ngs_run_id)
+
+    async def get_sample_type(self, pp_id: str) -> str:
+        return await run_in_threadpool(self.backend.get_sample_type, pp_id=pp_id)
+
+    async def get_mutation_info(self, ngs_run_id: str) -> list[MutationInfo]:
+        return await run_in_threadpool(self.backend.get_mutation_info, ngs_run_id=ngs_run_id)
+
+    async def get_ngs_run_info(self, pp_id: str, ngs_run_id: str) -> Dict[str, Any]:
+        return await run_in_threadpool(self.backend.get_ngs_run_info, pp_id=pp_id, ngs_run_id=ngs_run_id)
+
+    async def save_purity_analysis(self, purity_analysis: list[PurityAnalysis]) -> list[PurityAnalysis]:
+        return await run_in_threadpool(self.backend.save_purity_analysis, purity_analysis=purity_analysis)
+
+    async def save_repertoire_analysis(self, repertoire_analysis: list[RepertoireAnalysis]) -> list[RepertoireAnalysis]:
+        return await run_in_threadpool(self.backend.save_repertoire_analysis, repertoire_analysis=repertoire_analysis)
+
+    async def save_purity_mutation_analysis(self, mutation_analysis: list[MutationPurityAnalysis]) -> list[MutationPurityAnalysis]:
+        return await run_in_threadpool(self.backend.save_purity_mutation_analysis, mutation_analysis=mutation_analysis)
+
+class AsyncTDPBackend:
+    """AsyncTDPBackend
+    The methods of a TDPBackend as coroutines, run in the worker thread pool as AsyncNGSBackend.
+
+    """
+
+    def __init__(self, backend: TDPBackend):
+        self.backend = backend
+
+    async def retrieve_file_info(self, file_id: str) -> tuple[Dict, HTTPStatus]:
+        return await run_in_threadpool(self.backend.retrieve_file_info, file_id=file_id)
+
+    async def upload_raw_file(self, file_name: str, file_data: bytes, content_type: str, labels: Dict) -> tuple[Dict, HTTPStatus]:
+        return await run_in_threadpool(self.backend.upload_raw_file, file_name=file_name, file_data=file_data,
+                                       content_type=content_type, labels=labels)
+
+    async def upload_json_meta(self, json_data: Dict[str, Any], labels: Dict) -> tuple[str, HTTPStatus]:
+        return await run_in_threadpool(self.backend.upload_json_meta, json_data=json_data, labels=labels)
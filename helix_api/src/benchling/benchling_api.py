@@ -2,10 +2,15 @@ from typing import Dict, Any, Optional
 
 import pandas as pd
 from backend import BenchlingBackend
+from caching import CacheManager, get_cache_manager
 from benchling.schemas import BaseEntityGet, BaseEntityPost, SequenceAAPost, SequenceDNAPost
 
 class BenchlingAPIBackend(BenchlingBackend):
 
+    def __init__(self, cache_manager: Optional[CacheManager] = None):
+        super().__init__()
+        self.cache_manager = cache_manager or get_cache_manager()
+
     def get_query(self, endpoint: str, additional_headers: Optional[Dict[str, Any]] = None) -> Dict[str, Any] | None:
         """get_query 
         Execute Benchling GET query
@@ -47,7 +52,11 @@ class BenchlingAPIBackend(BenchlingBackend):
     
     def get_dropdown_id(self, type: str, name: Optional[str] = None):
         id = getattr(self.settings, f"dropdown_id_{type}")
-        response = self.get_query(f"dropdowns/{id}")
+        response = self.cache_manager.get_cached_or_execute(
+            method_name='benchling.dropdowns.get',
+            args={'endpoint': f"dropdowns/{id}"},
+            callable=self.get_query
+        )
         if response is not None:
             options = pd.DataFrame(response["options"])
             if name is not None:
@@ -46,7 +46,6 @@ class NGSBenchlingBackend(NGSBackend):
         return result
 
     def get_clone_pool_primer_info(self, pp_id: str, ngs_run_id: str) -> list[ClonePoolPrimerInfo]:
-        self.cache_manager.reset()
         pcr_plates = self.get_pcr_plates(pp_id=pp_id)
         amplicon_value = self.choose_amplicon_value_for_ngs_run(ngs_run_id=ngs_run_id)
         primers_forward = []
@@ -110,7 +109,6 @@ class NGSBenchlingBackend(NGSBackend):
         return oligos
 
     def get_primer_info(self, pp_id: str) -> list[PrimerInfo]:
-        self.cache_manager.reset()
         pcr_plates: list[NGSPPPlate] = self.run_and_measure_time("===FETCHING PCR PLATES===", 
                                                lambda: self.get_pcr_plates(pp_id=pp_id))
         fwd_rev_sample_list: list[PCRPlateMatch] = self.run_and_measure_time(
@@ -171,7 +169,6 @@ class NGSBenchlingBackend(NGSBackend):
         result: list[MutationInfo] = []
 
         ## fetch assay run(s)
-        self.cache_manager.reset()
         assay_runs = self.get_assay_runs_for_ngs_run(ngs_run_id=ngs_run_id, schema_id=self.settings.schema_id_mutation_analysis)
         if not assay_runs:
             return result
@@ -222,10 +219,10 @@ class NGSBenchlingBackend(NGSBackend):
 
     def get_pcr_pool_for_run(self, ngs_run_id: str) -> Optional[Field]:
         run_entity = self.cache_manager.get_cached_or_execute(
-            method_name=' benchling.custom_entities.list.first',
+            method_name='benchling.custom_entities.list.first',
             args={'name_includes': ngs_run_id},
-            callable=self.benchling.custom_entities.list
-        ).first()
+            callable=lambda **kwargs: self.benchling.custom_entities.list(**kwargs).first()
+        )
         if not run_entity:
             return None
         return run_entity.fields[self.get_pcr_pools_field_name()]
@@ -233,10 +230,10 @@ class NGSBenchlingBackend(NGSBackend):
     def get_pcr_plates(self, pp_id: str) -> list[NGSPPPlate]:
 
         pcr_plate = self.cache_manager.get_cached_or_execute(
-            method_name=" benchling.custom_entities.list.first",
+            method_name="benchling.custom_entities.list.first",
             args={"name": pp_id, "schema_id": self.settings.schema_id_pcr_pool},
-            callable=self.benchling.custom_entities.list,
-        ).first()
+            callable=lambda **kwargs: self.benchling.custom_entities.list(**kwargs).first(),
+        )
         
         if not pcr_plate:
             return []
@@ -260,7 +257,7 @@ class NGSBenchlingBackend(NGSBackend):
         custom_entities = self.cache_manager.get_cached_or_execute(
             method_name='benchling.plates.list',
             args={'ids': plate_ids},
-            callable = self.benchling.plates.list
+            callable = lambda **kwargs: list(self.benchling.plates.list(**kwargs))
         )
 
         for plate_page in custom_entities:
@@ -285,12 +282,11 @@ class NGSBenchlingBackend(NGSBackend):
         return True
 
     def get_clone_primer_plate_info(self, plate_id: str) -> list[FwdRevClonePrimerInfo]:
-        plates = self.cache_manager.get_cached_or_execute(
+        plate = self.cache_manager.get_cached_or_execute(
             method_name='benchling.plates.list.first',
             args={'ids':[ plate_id ]},
-            callable=self.benchling.plates.list
+            callable=lambda **kwargs: self.benchling.plates.list(**kwargs).first()
         )
-        plate = plates.first()
         if not plate:
             return []
 
@@ -369,9 +365,9 @@ class NGSBenchlingBackend(NGSBackend):
 
     def get_sample_plate_info(self, plate_id: str) -> list[SamplePrimerInfo]:
         plate = self.cache_manager.get_cached_or_execute(
-            method_name=' benchling.plates.list.first',
+            method_name='benchling.plates.list.first',
             args={'ids': [plate_id]},
-            callable = self.benchling.plates.list).first()
+            callable = lambda **kwargs: self.benchling.plates.list(**kwargs).first())
         if not plate:
             return []
 
@@ -436,16 +432,29 @@ class NGSBenchlingBackend(NGSBackend):
         return analysis        
 
     def save_purity_analysis(self, purity_analysis: list[PurityAnalysis]) -> list[PurityAnalysis]:
-        self.cache_manager.reset()
         return self.save_analysis(purity_analysis, self.create_blob_purity_analysis, 
                                   config_file_name="NGS Pipeline Purity Analysis Output", schema_id=self.settings.schema_id_individual_clones)
 
     def get_assay_runs_for_ngs_run(self, ngs_run_id: str, schema_id: str) -> list[AssayRun]:
+        assay_runs = self.find_assay_runs_for_ngs_run(ngs_run_id=ngs_run_id, schema_id=schema_id)
+        if not assay_runs:
+            ## the run may have been created since the runs were cached
+            self.cache_manager.invalidate('benchling.assay_runs.list', args={'schema_id': schema_id})
+            assay_runs = self.find_assay_runs_for_ngs_run(ngs_run_id=ngs_run_id, schema_id=schema_id)
+
+        if not assay_runs:
+            return []
+
+        assay_runs.sort(key=lambda x: x.created_at, reverse=True)
+
+        return assay_runs
+
+    def find_assay_runs_for_ngs_run(self, ngs_run_id: str, schema_id: str) -> list[AssayRun]:
         assay_runs: list[AssayRun] = []
         for runs in self.cache_manager.get_cached_or_execute(
             method_name='benchling.assay_runs.list',
             args={'schema_id': schema_id},
-            callable = self.benchling.assay_runs.list
+            callable = lambda **kwargs: list(self.benchling.assay_runs.list(**kwargs))
         ):
             print("Checking runs")
             for run in runs:
@@ -454,12 +463,6 @@ class NGSBenchlingBackend(NGSBackend):
                 found_ngs_run_id = run.fields["ngs_run" if schema_id == self.settings.schema_id_clone_pool else "ngs_sequencing_run"].text_value or ""
                 if found_ngs_run_id == ngs_run_id:
                     assay_runs.append(run)
-
-        if not assay_runs:
-            return []
-
-        assay_runs.sort(key=lambda x: x.created_at, reverse=True)
-
         return assay_runs
 
     def choose_amplicon_value_for_ngs_run(self, ngs_run_id: str) -> Optional[bool]:
@@ -479,20 +482,17 @@ class NGSBenchlingBackend(NGSBackend):
         return None
 
     def save_repertoire_analysis(self, repertoire_analysis: list[RepertoireAnalysis]) -> list[RepertoireAnalysis]:
-        self.cache_manager.reset()
         return self.save_analysis(repertoire_analysis, self.create_blob_repertoire_analysis, 
                                   config_file_name="NGS Pipeline Repertoire Output", schema_id=self.settings.schema_id_clone_pool)
 
     def save_purity_mutation_analysis(self, mutation_analysis: list[MutationPurityAnalysis]) -> list[MutationPurityAnalysis]:
         ## only need to resolve assay run id once (same for both uploads)
         ## upload 1/2
-        self.cache_manager.reset()
         analysis = self.save_analysis(analysis=mutation_analysis, 
                                 create_blob_func=self.create_blob_purity_analysis2, 
                                 config_file_name="NGS Pipeline Purity Analysis Output",
                                 schema_id=self.settings.schema_id_mutation_analysis)  
         ## upload 2/2
-        self.cache_manager.reset()  ## 404 error when not resetting cache
         analysis = self.save_analysis(analysis=analysis, 
                                 create_blob_func=self.create_blob_mutation_analysis, 
                                 config_file_name="NGS Pipeline Mutation Analysis Output",
@@ -512,12 +512,11 @@ class NGSBenchlingBackend(NGSBackend):
         
     def get_ngs_run_info(self, pp_id: str, ngs_run_id: str) -> Dict[str, Any]:
         ## fetch data
-        self.cache_manager.reset()
         sample_info = self.cache_manager.get_cached_or_execute(
             method_name="benchling.custom_entities.list.first",
             args={"name": pp_id, "schema_id": self.settings.schema_id_pcr_pool},
-            callable=self.benchling.custom_entities.list,
-        ).first()
+            callable=lambda **kwargs: self.benchling.custom_entities.list(**kwargs).first(),
+        )
         sample_type = self.get_sample_type(pp_id)
         if sample_type == "Clone_Pool":
             ngs_run = self.get_assay_runs_for_ngs_run(ngs_run_id, schema_id = self.settings.schema_id_clone_pool)
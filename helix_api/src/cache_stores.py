@@ -0,0 +1,410 @@
+import importlib
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Optional
+from urllib.parse import unquote, urlparse
+
+# Model classes that may be restored from a shared store.
+_model_packages = ("benchling_api_client.", "benchling_sdk.")
+_compress_above = 1024   # bytes
+
+
+def _to_plain(value: Any) -> Any:
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, list):
+        return [_to_plain(v) for v in value]
+    if isinstance(value, tuple):
+        return {"__tuple__": [_to_plain(v) for v in value]}
+    if isinstance(value, dict):
+        return {str(k): _to_plain(v) for k, v in value.items()}
+    cls = type(value)
+    if cls.__module__.startswith(_model_packages) and hasattr(value, "to_dict") and hasattr(cls, "from_dict"):
+        return {"__model__": f"{cls.__module__}:{cls.__qualname__}", "value": value.to_dict()}
+    raise TypeError(f"Cannot store {cls.__name__} in a shared cache")
+
+
+def _from_plain(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_from_plain(v) for v in value]
+    if isinstance(value, dict):
+        if "__model__" in value:
+            module_name, name = value["__model__"].split(":")
+            if not module_name.startswith(_model_packages):
+                raise ValueError(f"Refusing to restore {value['__model__']}")
+            return getattr(importlib.import_module(module_name), name).from_dict(value["value"])
+        if "__tuple__" in value:
+            return tuple(_from_plain(v) for v in value["__tuple__"])
+        return {k: _from_plain(v) for k, v in value.items()}
+    return value
+
+
+def encode_value(value: Any) -> bytes:
+    """encode_value
+    Serialize a cached result for a shared store. Benchling models are stored as their API representation (`to_dict`)
+    tagged with their class and restored with `from_dict`, which is compact and, unlike pickle, keeps their UNSET
+    fields intact. Large values are compressed.
+
+    :raises TypeError: if the value contains objects that are not plain data or Benchling models
+
+    """
+    data = json.dumps(_to_plain(value), separators=(",", ":")).encode()
+    if len(data) > _compress_above:
+        return b"z" + zlib.compress(data, 1)
+    return b"j" + data
+
+
+def decode_value(data: bytes) -> Any:
+    if data[:1] == b"z":
+        return _from_plain(json.loads(zlib.decompress(data[1:])))
+    return _from_plain(json.loads(data[1:]))
+
+
+class CacheStore:
+    """CacheStore
+    Where a CacheManager keeps its results. Keys are strings that start with the method name (see
+    `CacheManager.method_prefix`). `blocking` stores do I/O, so async callers use them from a worker thread.
+
+    """
+    blocking = True
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        pass
+
+    def set(self, key: str, value: Any, ttl: float):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+    def delete_prefix(self, prefix: str):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self) -> dict[str, Any]:
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryCacheStore(CacheStore):
+    """MemoryCacheStore
+    Results kept as objects in this process, evicting the least recently used beyond `max_entries`.
+
+    """
+    blocking = False
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.cache: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return False, None
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self.cache[key]
+                self.expirations += 1
+                return False, None
+            self.cache.move_to_end(key)
+            return True, value
+
+    def set(self, key: str, value: Any, ttl: float):
+        with self.lock:
+            self.cache[key] = (time.monotonic() + ttl, value)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str):
+        with self.lock:
+            self.cache.pop(key, None)
+
+    def delete_prefix(self, prefix: str):
+        with self.lock:
+            for key in [k for k in self.cache if k.startswith(prefix)]:
+                del self.cache[key]
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            return {"store": "memory", "entries": len(self.cache), "max_entries": self.max_entries,
+                    "evictions": self.evictions, "expirations": self.expirations}
+
+
+class SQLiteCacheStore(CacheStore):
+    """SQLiteCacheStore
+    Results kept in a SQLite file shared by the worker processes of one host. Keys are stored under `namespace`, so
+    the environments of a host can share the file without reading each other's results. Entries expire by wall
+    clock time and the least recently used beyond `max_entries` are evicted.
+
+    """
+
+    def __init__(self, path: str, max_entries: int = 1024, namespace: str = "helix"):
+        self.path = path
+        self.max_entries = max_entries
+        self.namespace = namespace + ":"
+        self.local = threading.local()
+        self.evictions = 0
+        self.expirations = 0
+        connection = self.connection()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS cache "
+                               "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        key = self.namespace + key
+        connection = self.connection()
+        row = connection.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+        now = time.time()
+        with connection:
+            if row[1] <= now:
+                connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.expirations += 1
+                return False, None
+            connection.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return True, decode_value(row[0])
+
+    def set(self, key: str, value: Any, ttl: float):
+        key = self.namespace + key
+        data = encode_value(value)
+        now = time.time()
+        connection = self.connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                               (key, data, now + ttl, now))
+            excess = connection.execute("SELECT count(*) FROM cache").fetchone()[0] - self.max_entries
+            if excess > 0:
+                connection.execute("DELETE FROM cache WHERE key IN "
+                                   "(SELECT key FROM cache ORDER BY accessed LIMIT ?)", (excess,))
+                self.evictions += excess
+
+    def delete(self, key: str):
+        connection = self.connection()
+        with connection:
+            connection.execute("DELETE FROM cache WHERE key = ?", (self.namespace + key,))
+
+    def delete_prefix(self, prefix: str):
+        prefix = self.namespace + prefix
+        connection = self.connection()
+        with connection:
+            connection.execute("DELETE FROM cache WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+    def clear(self):
+        self.delete_prefix("")
+
+    def stats(self) -> dict[str, Any]:
+        entries = self.connection().execute("SELECT count(*) FROM cache WHERE substr(key, 1, ?) = ?",
+                                            (len(self.namespace), self.namespace)).fetchone()[0]
+        return {"store": "sqlite", "path": self.path, "namespace": self.namespace, "entries": entries, "max_entries": self.max_entries,
+                "evictions": self.evictions, "expirations": self.expirations}
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+class RespError(Exception):
+    pass
+
+
+class RespConnection:
+    """RespConnection
+    A minimal client of the Redis protocol (RESP2), enough for the cache: any server speaking it (Redis, Valkey,
+    KeyDB or a local stand-in) can hold the results.
+
+    """
+
+    def __init__(self, host: str, port: int, db: int = 0, password: Optional[str] = None, timeout: float = 2.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.reader = self.sock.makefile("rb")
+        if password:
+            self.execute("AUTH", password)
+        if db:
+            self.execute("SELECT", str(db))
+
+    def execute(self, *args: Any) -> Any:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self.sock.sendall(b"".join(parts))
+        return self.read_reply()
+
+    def read_reply(self) -> Any:
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the cache server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RespError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        raise RespError(f"Unexpected reply {line!r}")
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RespCacheStore(CacheStore):
+    """RespCacheStore
+    Results kept on a Redis protocol server shared by all workers and pods, under `namespace`. Expiry uses the
+    server's key TTLs; the size is bounded by the server (maxmemory with an LRU policy), not `max_entries`.
+
+    The cache is an optimisation, so when the server cannot be reached lookups miss and results are not stored, and
+    the server is not tried again for `retry_after` seconds.
+
+    """
+
+    def __init__(self, url: str, namespace: str = "helix", timeout: float = 2.0, retry_after: float = 10.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.strip("/") or 0)
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.namespace = namespace + ":"
+        self.local = threading.local()
+        self.errors = 0
+        self.unavailable_until = 0.0
+
+    def execute(self, *args: Any) -> Any:
+        connection = getattr(self.local, "connection", None)
+        try:
+            if connection is None:
+                connection = RespConnection(self.host, self.port, self.db, self.password, self.timeout)
+                self.local.connection = connection
+            return connection.execute(*args)
+        except (OSError, ConnectionError):
+            if connection is not None:
+                connection.close()
+            self.local.connection = None
+            raise
+
+    def execute_or_none(self, *args: Any) -> Any:
+        if time.monotonic() < self.unavailable_until:
+            return None
+        try:
+            return self.execute(*args)
+        except RespError as e:
+            self.errors += 1
+            print("===CACHE STORE ERROR: " + str(e) + "===")
+            return None
+        except (OSError, ConnectionError) as e:
+            self.errors += 1
+            self.unavailable_until = time.monotonic() + self.retry_after
+            print("===CACHE STORE UNAVAILABLE: " + str(e) + "===")
+            return None
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        data = self.execute_or_none("GET", self.namespace + key)
+        if data is None:
+            return False, None
+        return True, decode_value(data)
+
+    def set(self, key: str, value: Any, ttl: float):
+        self.execute_or_none("SET", self.namespace + key, encode_value(value), "PX", max(1, int(ttl * 1000)))
+
+    def delete(self, key: str):
+        self.execute_or_none("DEL", self.namespace + key)
+
+    def delete_prefix(self, prefix: str):
+        pattern = "".join("\\" + c if c in "*?[]\\" else c for c in self.namespace + prefix) + "*"
+        cursor = b"0"
+        while True:
+            reply = self.execute_or_none("SCAN", cursor, "MATCH", pattern, "COUNT", 500)
+            if reply is None:
+                return
+            cursor, keys = reply
+            if keys:
+                self.execute_or_none("DEL", *keys)
+            if cursor in (b"0", "0"):
+                return
+
+    def clear(self):
+        self.delete_prefix("")
+
+    def stats(self) -> dict[str, Any]:
+        stats: dict[str, Any] = {"store": "resp", "server": f"{self.host}:{self.port}/{self.db}",
+                                 "namespace": self.namespace, "errors": self.errors}
+        info = self.execute_or_none("INFO", "stats")
+        if isinstance(info, bytes):
+            for line in info.decode().splitlines():
+                name, _, value = line.partition(":")
+                if name in ("evicted_keys", "expired_keys", "keyspace_hits", "keyspace_misses"):
+                    stats[name] = int(value)
+        return stats
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+def create_cache_store(settings) -> CacheStore:
+    """create_cache_store
+    The cache store selected by `settings.cache_store`: "memory" (per process), "sqlite" (per host) or "resp" (a
+    Redis protocol server)
+
+    """
+    if settings.cache_store == "sqlite":
+        path = settings.cache_path or os.path.join(tempfile.gettempdir(), "helix_api_cache.sqlite3")
+        return SQLiteCacheStore(path, max_entries=settings.cache_max_entries,
+                                namespace=f"{settings.cache_namespace}:{settings.base_url}")
+    if settings.cache_store == "resp":
+        return RespCacheStore(settings.cache_url, namespace=f"{settings.cache_namespace}:{settings.base_url}")
+    if settings.cache_store != "memory":
+        raise ValueError(f"Unknown cache store {settings.cache_store}")
+    return MemoryCacheStore(max_entries=settings.cache_max_entries)
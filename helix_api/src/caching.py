@@ -1,23 +1,226 @@
-from typing import Any, Callable, TypeVar
+import asyncio
+import inspect
+import json
+import threading
+from concurrent.futures import Future
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Optional, TypeVar, Union
+
+from cache_stores import CacheStore, MemoryCacheStore, create_cache_store
+from config import get_settings
+
+# Seconds a cached result of each method stays valid. Schemas and dropdowns rarely change; plates and assay runs are
+# edited in the lab while the NGS pipeline runs, so they are only shared between calls close together.
+method_ttls: dict[str, float] = {
+    'benchling.schemas.get_entity_schema_by_id': 3600,
+    'benchling.dropdowns.get': 3600,
+    'benchling.dna_oligos.get_by_id': 900,
+    'benchling.aa_sequences.get_by_id': 900,
+    'benchling.dna_sequences.get_by_id': 900,
+    'benchling.custom_entities.list.first': 300,
+    'benchling.containers.get_by_id': 60,
+    'benchling.plates.list': 60,
+    'benchling.plates.list.first': 60,
+    'benchling.assay_runs.list': 30,
+}
 
 
 class CacheManager:
-    cache: dict[tuple, Any] = dict()
+    """CacheManager
+    A cache of the results of Benchling calls, shared by all requests. Results expire after the ttl of their method
+    (`method_ttls`, or `default_ttl` for other methods). They are kept in a CacheStore (see cache_stores.py): by
+    default a bounded LRU in this process, or one shared by the workers of a host or of the whole deployment.
+
+    Cached results are shared, so callables must return materialized values (lists or models), not page iterators.
+
+    Concurrent misses of the same key are coalesced: the first caller executes the callable and the others, sync or
+    async, wait up to `wait_timeout` seconds for its result (or exception) instead of calling Benchling again.
+
+    """
     T = TypeVar('T')
 
+    def __init__(self, cache_store: Optional[CacheStore] = None, default_ttl: float = 60,
+                 ttls: Optional[dict[str, float]] = None, wait_timeout: Optional[float] = 120):
+        self.cache_store = cache_store or MemoryCacheStore()
+        self.default_ttl = default_ttl
+        self.wait_timeout = wait_timeout
+        self.ttls = dict(method_ttls)
+        self.ttls.update(ttls or {})
+        self.lock = threading.RLock()
+        self.in_flight: dict[tuple, Future] = dict()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
     def create_key(self, method_name: str, args: dict[str,str]) -> tuple:
         return (method_name,) + tuple([f"{k}={str(v)}" for k,v in args.items() ])
 
+    def ttl(self, method_name: str) -> float:
+        return self.ttls.get(method_name, self.default_ttl)
+
+    def store_key(self, key: tuple) -> str:
+        return json.dumps(list(key))
+
+    def method_prefix(self, method_name: str) -> str:
+        return json.dumps([method_name])[:-1]
+
+    def lookup(self, key: tuple) -> tuple[bool, Any]:
+        try:
+            found, value = self.cache_store.get(self.store_key(key))
+        except Exception as e:
+            # e.g. a result stored by another version of the models
+            print("===CACHED RESULT UNREADABLE: " + str(e) + "===")
+            found, value = False, None
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found, value
+
+    def store(self, key: tuple, value: Any):
+        try:
+            self.cache_store.set(self.store_key(key), value, self.ttl(key[0]))
+        except Exception as e:
+            # e.g. a value that cannot be serialized or a locked sqlite store; the result is still returned
+            print("===NOT CACHED: " + str(e) + "===")
+
+    def claim(self, key: tuple) -> tuple[bool, Any, Optional[Future], bool]:
+        """claim
+        Look up a key and, on a miss, either join the call already in flight for it or become the caller that
+        executes it
+
+        :return: whether the value was cached, the cached value, the future of the call in flight and whether the
+            caller owns the call (and must `complete` it)
+        :rtype: tuple[bool, Any, Optional[Future], bool]
+
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return False, None, future, False
+        # The store may be remote, so it is not read under the lock.
+        found, value = self.lookup(key)
+        if found:
+            return True, value, None, False
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return False, None, future, False
+            future = Future()
+            future.set_running_or_notify_cancel()
+            self.in_flight[key] = future
+            return False, None, future, True
+
+    def complete(self, key: tuple, future: Future, value: Any = None, error: Optional[BaseException] = None):
+        try:
+            if error is None:
+                self.store(key, value)
+        finally:
+            # Waiters must never be left blocked on a call that has finished.
+            with self.lock:
+                del self.in_flight[key]
+            if error is None:
+                future.set_result(value)
+            else:
+                future.set_exception(error)
+
+    def abandon(self, key: tuple, claim: asyncio.Future):
+        """abandon
+        Release a claim whose caller was cancelled before it could execute the callable. Waiters that joined it get
+        the cancellation instead of waiting for a result that never comes.
+
+        """
+        if claim.cancelled() or claim.exception() is not None:
+            return
+        found, value, future, owner = claim.result()
+        if owner:
+            self.complete(key, future, error=asyncio.CancelledError())
+
     def get_cached_or_execute(self, method_name: str, args: dict[str, Any], callable: Callable[..., T]) -> T:
         key = self.create_key(method_name=method_name, args=args)
 
-        if key in self.cache:
-            print("===ALREADY CACHED===")
-            return self.cache[key]
-        print("===NOT CACHED YET===")
-        to_cache = callable(**args)
-        self.cache[key] = to_cache
+        found, value, future, owner = self.claim(key)
+        if found:
+            return value
+        if not owner:
+            return future.result(self.wait_timeout)
+        try:
+            to_cache = callable(**args)
+        except BaseException as e:
+            self.complete(key, future, error=e)
+            raise
+        self.complete(key, future, value=to_cache)
         return to_cache
 
+    async def get_cached_or_execute_async(self, method_name: str, args: dict[str, Any],
+                                          callable: Callable[..., Union[T, Awaitable[T]]]) -> T:
+        """get_cached_or_execute_async
+        As `get_cached_or_execute` without blocking the event loop: a sync callable runs in a worker thread and
+        callers of a key in flight await its result.
+
+        """
+        key = self.create_key(method_name=method_name, args=args)
+
+        if self.cache_store.blocking:
+            # The claim thread cannot be stopped, so a claim it makes after the caller is cancelled is released.
+            claim = asyncio.ensure_future(asyncio.to_thread(self.claim, key))
+            try:
+                found, value, future, owner = await asyncio.shield(claim)
+            except asyncio.CancelledError:
+                claim.add_done_callback(lambda claim: self.abandon(key, claim))
+                raise
+        else:
+            found, value, future, owner = self.claim(key)
+        if found:
+            return value
+        if not owner:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.wait_timeout)
+        try:
+            if inspect.iscoroutinefunction(callable):
+                to_cache = await callable(**args)
+            else:
+                to_cache = await asyncio.to_thread(callable, **args)
+        except BaseException as e:
+            self.complete(key, future, error=e)
+            raise
+        if self.cache_store.blocking:
+            await asyncio.to_thread(self.complete, key, future, value=to_cache)
+        else:
+            self.complete(key, future, value=to_cache)
+        return to_cache
+
+    def invalidate(self, method_name: str, args: Optional[dict[str, Any]] = None):
+        """invalidate
+        Drop the cached results of a method, or only the result for `args`
+
+        """
+        if args is not None:
+            self.cache_store.delete(self.store_key(self.create_key(method_name=method_name, args=args)))
+        else:
+            self.cache_store.delete_prefix(self.method_prefix(method_name))
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "coalesced": self.coalesced,
+                "in_flight": len(self.in_flight),
+            }
+        stats.update(self.cache_store.stats())
+        return stats
+
     def reset(self):
-        self.cache.clear()
\ No newline at end of file
+        self.cache_store.clear()
+
+
+@lru_cache
+def get_cache_manager() -> CacheManager:
+    settings = get_settings()
+    return CacheManager(cache_store=create_cache_store(settings), default_ttl=settings.cache_default_ttl,
+                        ttls=settings.cache_ttls, wait_timeout=settings.cache_wait_timeout)
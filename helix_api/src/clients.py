@@ -0,0 +1,157 @@
+import asyncio
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+import httpx
+from benchling_sdk.auth.client_credentials_oauth2 import ClientCredentialsOAuth2
+from benchling_sdk.benchling import Benchling
+from config import Settings
+
+
+class RefreshingClientCredentialsOAuth2(ClientCredentialsOAuth2):
+    """RefreshingClientCredentialsOAuth2
+    OAuth2 client credentials whose token can be renewed ahead of its expiry, so that requests do not wait for the
+    token exchange when the token runs out.
+
+    """
+
+    def __init__(self, client_id: str, client_secret: str, httpx_client: httpx.Client):
+        super().__init__(client_id=client_id, client_secret=client_secret, httpx_client=httpx_client)
+        self.tokens_vended = 0
+
+    def vend_new_token(self, base_url: str):
+        super().vend_new_token(base_url)
+        self.tokens_vended += 1
+
+    def refresh_if_expiring(self, base_url: str, margin: float) -> bool:
+        """refresh_if_expiring
+        Vend a new token if there is none or it has to be renewed within `margin` seconds
+
+        :return: whether a new token was vended
+        :rtype: bool
+
+        """
+        with self._lock:
+            deadline = datetime.now(timezone.utc) + timedelta(seconds=margin)
+            if self._token is not None and deadline < self._token.refresh_time:
+                return False
+            self.vend_new_token(base_url)
+            return True
+
+    def token_expires_in(self) -> Optional[float]:
+        token = self._token
+        if token is None:
+            return None
+        return (token.refresh_time - datetime.now(timezone.utc)).total_seconds()
+
+
+class BenchlingClient:
+    """BenchlingClient
+    An authenticated Benchling client of one environment, sharing one keep-alive connection pool between the API
+    calls and the token requests.
+
+    """
+
+    def __init__(self, settings: Settings):
+        self.base_url = settings.base_url
+        self.requests = 0
+        self.httpx_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=settings.max_connections,
+                max_keepalive_connections=settings.max_keepalive_connections,
+                keepalive_expiry=settings.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(settings.request_timeout, connect=settings.connect_timeout),
+            event_hooks={"request": [self._count_request]},
+        )
+        self.auth_method = RefreshingClientCredentialsOAuth2(
+            client_id=settings.client_id, client_secret=settings.client_secret, httpx_client=self.httpx_client
+        )
+        self.benchling = Benchling(url=settings.base_url, auth_method=self.auth_method, httpx_client=self.httpx_client)
+
+    def _count_request(self, request: httpx.Request):
+        self.requests += 1
+
+    def stats(self) -> Dict[str, Any]:
+        pool = getattr(self.httpx_client._transport, "_pool", None)
+        connections = list(getattr(pool, "connections", []))
+        return {
+            "base_url": self.base_url,
+            "requests": self.requests,
+            "tokens_vended": self.auth_method.tokens_vended,
+            "token_expires_in": self.auth_method.token_expires_in(),
+            "connections": len(connections),
+            "idle_connections": sum(1 for c in connections if c.is_idle()),
+            "active_connections": sum(1 for c in connections if not c.is_idle() and not c.is_closed()),
+        }
+
+    def close(self):
+        self.httpx_client.close()
+
+
+class BenchlingClientRegistry:
+    """BenchlingClientRegistry
+    The Benchling clients of the application, one per environment (base url and client id). The registry is opened
+    and closed with the application (see `main.lifespan`); while it is open a background task renews the tokens
+    before they expire.
+
+    """
+
+    def __init__(self):
+        self._clients: Dict[tuple, BenchlingClient] = dict()
+        self._lock = threading.Lock()
+        self._refresher: Optional[asyncio.Task] = None
+
+    def get(self, settings: Settings) -> BenchlingClient:
+        key = (settings.base_url, settings.client_id)
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = BenchlingClient(settings)
+            return self._clients[key]
+
+    def refresh_tokens(self, margin: float):
+        with self._lock:
+            clients = list(self._clients.values())
+        for client in clients:
+            try:
+                client.auth_method.refresh_if_expiring(client.base_url, margin)
+            except Exception as e:
+                # The next request vends the token itself.
+                print("===TOKEN REFRESH FAILED FOR " + client.base_url + ": " + str(e) + "===")
+
+    async def _refresh_periodically(self, interval: float, margin: float):
+        while True:
+            await asyncio.to_thread(self.refresh_tokens, margin)
+            await asyncio.sleep(interval)
+
+    def start(self, settings: Settings):
+        self.get(settings)
+        if self._refresher is None:
+            self._refresher = asyncio.create_task(
+                self._refresh_periodically(settings.token_refresh_interval, settings.token_refresh_margin)
+            )
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+        self.close()
+
+    def stats(self) -> list[Dict[str, Any]]:
+        with self._lock:
+            return [client.stats() for client in self._clients.values()]
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+
+client_registry = BenchlingClientRegistry()
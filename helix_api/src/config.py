@@ -1,9 +1,28 @@
 import os
+from typing import Dict
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     client_id: str = os.getenv("BENCHLING_CLIENT_ID", "")
     client_secret: str = os.getenv("BENCHLING_CLIENT_SECRET", "") 
+    # connection pool and token renewal of the shared Benchling client (see clients.py)
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    keepalive_expiry: float = 60.0   # seconds an idle connection is kept open
+    connect_timeout: float = 5.0
+    request_timeout: float = 30.0
+    token_refresh_interval: float = 30.0   # seconds between checks of the token
+    token_refresh_margin: float = 120.0   # renew tokens that expire within this many seconds
+    worker_threads: int = 40   # threads the routes run Benchling and TetraScience calls in
+    # results of Benchling calls shared between requests (see caching.py and cache_stores.py)
+    cache_store: str = "memory"   # "memory" (per process), "sqlite" (per host) or "resp" (Redis protocol server)
+    cache_path: str = ""   # sqlite file, defaults to helix_api_cache.sqlite3 in the temp directory
+    cache_url: str = "redis://localhost:6379/0"   # resp server
+    cache_namespace: str = "helix"   # key prefix in the sqlite and resp stores, followed by the base url
+    cache_max_entries: int = 1024   # memory and sqlite stores
+    cache_default_ttl: float = 60.0   # seconds, for methods without their own ttl
+    cache_ttls: Dict[str, float] = {}   # override the ttl of a method, e.g. {"benchling.plates.list": 120}
+    cache_wait_timeout: float = 120.0   # seconds a caller waits for the same call in flight in another request
 
 class DEVSettings(Settings):
     base_url: str = "https://bayer-dev.benchling.com" 
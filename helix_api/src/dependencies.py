@@ -1,15 +1,17 @@
 from backend import (
+    AsyncNGSBackend,
+    AsyncTDPBackend,
     NGSBackend,
     BenchlingBackend,
     TDPBackend
 )
 from benchling.benchling_api import BenchlingAPIBackend
 from benchling.ngs_backend import NGSBenchlingBackend
-from caching import CacheManager
+from caching import CacheManager, get_cache_manager
 from tetrascience.tdp_backend import TDPUploadBackend
 
 def cache_manager() -> CacheManager:
-    return CacheManager()
+    return get_cache_manager()
 
 def ngs_backend() -> NGSBackend:
     return NGSBenchlingBackend(cache_manager=cache_manager())
@@ -20,3 +22,9 @@ def benchling_api_backend() -> BenchlingBackend:
 def ts_backend() -> TDPBackend:
     return TDPUploadBackend()
 
+def async_ngs_backend() -> AsyncNGSBackend:
+    return AsyncNGSBackend(ngs_backend())
+
+def async_ts_backend() -> AsyncTDPBackend:
+    return AsyncTDPBackend(ts_backend())
+
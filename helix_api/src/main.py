@@ -1,5 +1,19 @@
+from contextlib import asynccontextmanager
+import anyio.to_thread
 from fastapi import FastAPI
+from caching import get_cache_manager
+from clients import client_registry
+from config import get_settings
 import api
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    settings = get_settings()
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.worker_threads
+    client_registry.start(settings)
+    yield
+    await client_registry.stop()
+    get_cache_manager().cache_store.close()
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(api.router)
\ No newline at end of file